@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Continuous acquisition of sweeps in a background thread.
+
+The producer thread triggers single sweeps on a channel, waits for them to complete and fetches the data,
+while the consumers process earlier sweeps. The frames are handed over through a bounded queue:
+
+with Acquisition(znb.get_channel(1), maxsize=8) as acq:
+    for frame in acq:
+        stimulus, traces = frame.data
+        ...
+
+@author: Lukas Sandström
+"""
+
+import collections
+import Queue
+import sys
+import threading
+import timeit
+
+
+class AcquisitionFrame(object):
+    def __init__(self, n, timestamp, data):
+        self.n = n  # The sequence number of the sweep, from 0
+        self.timestamp = timestamp  # timeit.default_timer() when the sweep was completed
+        self.data = data  # The value returned by the fetch function
+
+
+class Acquisition(object):
+    """
+    Triggers sweeps on a channel from a producer thread, and queues the fetched data for the consumers.
+    The channel is put in single sweep mode, INITiate<Ch>:CONTinuous OFF. Sweep completion is detected with
+    Instrument.start_and_wait(), so commands from other threads can be interleaved with the producer's.
+    """
+
+    BLOCK = "block"  # The producer waits for the consumers when the queue is full
+    DROP_OLDEST = "drop_oldest"  # The oldest frame in the queue is discarded when the queue is full
+
+    def __init__(self, channel, maxsize=4, policy=BLOCK, fetch=None, count=None, sweep_timeout=10.0):
+        """
+        :param channel: The channel which is swept, see ZNB.get_channel()
+        :param maxsize: The maximum number of frames in the queue
+        :param policy: BLOCK or DROP_OLDEST, what to do when the queue is full
+        :param fetch: A function fetch(channel) returning the data of a frame, Channel.fetch_all_traces() if None
+        :param count: The number of sweeps to acquire, unlimited if None
+        :param sweep_timeout: Timeout in seconds for each sweep
+        """
+        if policy not in (self.BLOCK, self.DROP_OLDEST):
+            raise ValueError("Invalid queue policy: " + str(policy))
+        self.channel = channel
+        self.instrument = channel.instrument
+        self.maxsize = maxsize
+        self.policy = policy
+        self.fetch = fetch if fetch is not None else lambda ch: ch.fetch_all_traces()
+        self.count = count
+        self.sweep_timeout = sweep_timeout
+
+        self.produced = 0  # The number of sweeps acquired
+        self.dropped = 0  # The number of frames discarded by the DROP_OLDEST policy
+        self.start_time = None
+        self.stop_time = None
+
+        self._frames = collections.deque()
+        self._cond = threading.Condition()
+        self._stop_requested = False
+        self._finished = False
+        self._exc_info = None
+        self._thread = None
+
+    def start(self):
+        """
+        Start the producer thread.
+
+        :return: self
+        """
+        self.start_time = timeit.default_timer()
+        self._thread = threading.Thread(target=self._run, name="Acquisition")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self, drain=False):
+        """
+        Stop the acquisition after the current sweep, and wait for the producer thread to finish.
+        Frames already in the queue can still be read with get().
+
+        :param drain: Discard the queued frames
+        """
+        with self._cond:
+            self._stop_requested = True
+            if drain:
+                self._frames.clear()
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop(drain=True)
+
+    @property
+    def elapsed(self):
+        """
+        The acquisition time in seconds
+        """
+        if self.start_time is None:
+            return 0.0
+        end = self.stop_time if self.stop_time is not None else timeit.default_timer()
+        return end - self.start_time
+
+    @property
+    def sweeps_per_second(self):
+        """
+        The sustained sweep rate, including the data transfers and any time spent waiting for the consumers.
+        """
+        elapsed = self.elapsed
+        return self.produced / elapsed if elapsed else 0.0
+
+    def _run(self):
+        try:
+            self.instrument.INITiate(self.channel.n).CONTinuous().w(False)
+            while not self._stop_requested and (self.count is None or self.produced < self.count):
+                self._sweep()
+                frame = AcquisitionFrame(self.produced, timeit.default_timer(), self.fetch(self.channel))
+                self.produced += 1
+                self._put(frame)
+        except BaseException:
+            self._exc_info = sys.exc_info()
+        finally:
+            self.stop_time = timeit.default_timer()
+            with self._cond:
+                self._finished = True
+                self._cond.notify_all()
+
+    def _sweep(self):
+        """
+        Trigger a single sweep and wait for it to complete.
+        """
+        inst = self.instrument
+        inst.start_and_wait(inst.INITiate(self.channel.n).IMMediate(), timeout=self.sweep_timeout)
+
+    def _put(self, frame):
+        with self._cond:
+            while len(self._frames) >= self.maxsize:
+                if self.policy == self.DROP_OLDEST:
+                    self._frames.popleft()
+                    self.dropped += 1
+                elif self._stop_requested:
+                    return
+                else:
+                    self._cond.wait()
+            self._frames.append(frame)
+            self._cond.notify_all()
+
+    def get(self, timeout=None):
+        """
+        Get the next frame, waiting for it to be acquired if the queue is empty.
+
+        :param timeout: Timeout in seconds, wait indefinitely if None
+        :return: The frame, or None when the acquisition has finished and all frames have been read
+        :rtype: AcquisitionFrame
+        :raises Queue.Empty: on timeout
+        """
+        deadline = None if timeout is None else timeit.default_timer() + timeout
+        with self._cond:
+            while not self._frames:
+                if self._finished:
+                    if self._exc_info:  # Re-raise the error from the producer thread
+                        exc_info, self._exc_info = self._exc_info, None
+                        raise exc_info[0], exc_info[1], exc_info[2]
+                    return None
+                if deadline is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - timeit.default_timer()
+                    if remaining <= 0:
+                        raise Queue.Empty()
+                    self._cond.wait(remaining)
+            frame = self._frames.popleft()
+            self._cond.notify_all()
+            return frame
+
+    def __iter__(self):
+        """
+        Iterate over the frames until the acquisition has finished.
+        """
+        while True:
+            frame = self.get()
+            if frame is None:
+                return
+            yield frame
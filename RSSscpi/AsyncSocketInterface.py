@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+Non-blocking raw socket transport, which lets a single thread drive many instruments concurrently.
+
+The transports share a SCPIEventLoop, which multiplexes the sockets with select(). Queries sent with
+SCPIQuery.q_async() on an AsyncInstrument return immediately, and the responses are filled in when the
+event loop receives them:
+
+loop = SCPIEventLoop()
+znbs = [AsyncZNB(AsyncSocketInterface(ip, loop)) for ip in ip_list]
+responses = [znb.SENSe(1).FREQuency.STARt().q_async() for znb in znbs]
+loop.wait(responses)
+
+@author: Lukas Sandström
+"""
+
+import socket
+import select
+import errno
+import re
+import timeit
+
+
+class SCPIEventLoop(object):
+    """
+    Multiplexes a set of AsyncSocketInterface transports with select().
+    """
+    def __init__(self):
+        self._transports = set()
+
+    def register(self, transport):
+        self._transports.add(transport)
+
+    def unregister(self, transport):
+        self._transports.discard(transport)
+
+    def run_once(self, timeout=None):
+        """
+        Wait for at most timeout seconds for socket activity, and process it.
+
+        :return: False if there was no activity before the timeout
+        :rtype: bool
+        """
+        r = [t for t in self._transports if t.wants_read()]
+        w = [t for t in self._transports if t.wants_write()]
+        if not r and not w:
+            return False
+        r, w, _ = select.select(r, w, [], timeout)
+        for t in w:
+            t.handle_write()
+        for t in r:
+            t.handle_read()
+        return bool(r or w)
+
+    def run_until(self, predicate, timeout=10.0):
+        """
+        Run the event loop until predicate() returns True.
+
+        :param timeout: Timeout in seconds
+        :raises socket.timeout: if the predicate isn't fulfilled before the timeout.
+        """
+        deadline = timeit.default_timer() + timeout
+        while not predicate():
+            remaining = deadline - timeit.default_timer()
+            if remaining <= 0 or not self.run_once(remaining) and not predicate():
+                raise socket.timeout("Timeout while waiting for instrument responses")
+
+    def wait(self, responses, timeout=10.0):
+        """
+        Run the event loop until all responses have been received.
+
+        :param responses: SCPIDeferredResponses returned by SCPIQuery.q_async()
+        :param timeout: Timeout in seconds
+        :return: responses
+        """
+        responses = list(responses)
+        self.run_until(lambda: all(r.done() for r in responses), timeout)
+        return responses
+
+
+default_loop = SCPIEventLoop()
+
+
+class AsyncSocketInterface(object):
+    """
+    A non-blocking raw socket connection to the instrument, port 5025.
+    Outgoing commands are buffered and sent when the socket is writable, responses are parsed incrementally
+    and handed to the pending response objects in order.
+    """
+    chunk_size = 65536
+    has_srq = False  # Service requests are not supported on the raw socket
+    _sep_re = re.compile(r"[;\n]")
+
+    def __init__(self, ip_address, loop=None, port=5025, timeout=10.0):
+        """
+        :param ip_address: The instrument address
+        :param loop: The event loop driving the connection, default_loop if None
+        :type loop: SCPIEventLoop
+        :param timeout: Timeout in seconds for blocking operations
+        """
+        self.ip = ip_address
+        self.loop = loop if loop is not None else default_loop
+        self.timeout = timeout
+        self._socket = socket.create_connection((ip_address, port), timeout)
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._socket.setblocking(0)
+        self._tx = bytearray()
+        self._rx = bytearray()
+        self._pending = []  # Response objects waiting for data, in the order the queries were sent
+        self.loop.register(self)
+
+    def fileno(self):
+        return self._socket.fileno()
+
+    def install_handler(self, *args):
+        pass
+
+    def enable_event(self, *args):
+        pass
+
+    def close(self):
+        self.loop.unregister(self)
+        self._socket.close()
+
+    def wants_read(self):
+        return bool(self._pending)
+
+    def wants_write(self):
+        return bool(self._tx)
+
+    def handle_write(self):
+        try:
+            n = self._socket.send(self._tx)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        del self._tx[:n]
+
+    def handle_read(self):
+        try:
+            data = self._socket.recv(self.chunk_size)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        if not data:
+            raise socket.error("Connection closed by the instrument")
+        self._rx += data
+        self._dispatch()
+
+    def _message_end(self):
+        """
+        :return: The index of the newline terminating the first message in the receive buffer, or -1
+        """
+        buf = self._rx
+        pos = 0
+        while True:
+            if buf[pos:pos + 1] == "#" and len(buf) > pos + 1 and buf[pos + 1:pos + 2] != "0":
+                n = int(str(buf[pos + 1:pos + 2]))
+                if len(buf) < pos + 2 + n:
+                    return -1
+                pos += 2 + n + int(str(buf[pos + 2:pos + 2 + n]))  # Skip over the block data
+            m = self._sep_re.search(buf, pos)
+            if not m:
+                return -1
+            if buf[m.start():m.start() + 1] == "\n":
+                return m.start()
+            pos = m.start() + 1
+
+    def _dispatch(self):
+        while self._pending:
+            end = self._message_end()
+            if end < 0:
+                return
+            msg = self._rx[:end + 1]
+            del self._rx[:end + 1]
+            if msg[:1] != "#":
+                msg = str(msg)
+            self._pending.pop(0).set_result(msg)
+
+    def send(self, string, response=None):
+        """
+        Queue a message for sending, without blocking.
+
+        :param response: An object with a set_result(raw) method, which receives the response to the message.
+        """
+        self._tx += string
+        self._tx += "\n"
+        if response is not None:
+            self._pending.append(response)
+        self.handle_write()
+
+    def write(self, string):
+        self.send(string)
+
+    def read_raw(self):
+        response = _RawResponse()
+        self._pending.append(response)
+        self.loop.run_until(response.done, self.timeout)
+        return response.raw
+
+    def query(self, string):
+        self.write(string)
+        return self.read_raw()
+
+    def wait_idle(self):
+        """
+        Run the event loop until all buffered commands are sent and all responses are received.
+        """
+        self.loop.run_until(lambda: not self._tx and not self._pending, self.timeout)
+
+
+class _RawResponse(object):
+    def __init__(self):
+        self.raw = None
+        self._done = False
+
+    def set_result(self, raw):
+        self.raw = raw
+        self._done = True
+
+    def done(self):
+        return self._done
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent raw socket sessions, shared by all users in the process which talk to the same instrument:
+
+znb1 = get_instrument("10.0.0.2")
+znb2 = get_instrument("10.0.0.2")  # The same ZNB object, on the same SocketInterface, as znb1
+
+An Instrument object keeps its own view of the session state, like the data format, the state cache and the
+active traces, so a session is used by a single Instrument object. Instrument refuses a session which
+already belongs to another Instrument object.
+
+@author: Lukas Sandström
+"""
+
+import threading
+
+from SocketInterface import SocketInterface
+from ZNB import ZNB
+
+
+class ConnectionPool(object):
+    """
+    Keeps one SocketInterface session, and at most one Instrument object using it, per instrument address.
+    The sessions use TCP keepalive and reconnect automatically, see SocketInterface. A session which has been
+    closed is replaced by a new one.
+    """
+    def __init__(self, timeout=1.0, keepalive=True, interface=SocketInterface, **kwargs):
+        """
+        :param timeout: Socket timeout in seconds for new sessions
+        :param keepalive: Enable TCP keepalive for new sessions
+        :param interface: The session class
+        :param kwargs: Further arguments for new sessions, like send_buffer_size and recv_buffer_size
+        """
+        self.timeout = timeout
+        self.keepalive = keepalive
+        self.interface = interface
+        self.session_args = kwargs
+        self._sessions = {}
+        self._instruments = {}  # (ip_address, port) -> the Instrument object using the session
+        self._lock = threading.Lock()
+
+    def open_resource(self, ip_address, port=5025):
+        """
+        :return: The session for the address, connecting if there is no open session
+        :rtype: SocketInterface
+        """
+        with self._lock:
+            return self._open((ip_address, port))
+
+    def _open(self, key):
+        session = self._sessions.get(key)
+        if session is None or session.closed:
+            session = self._sessions[key] = self.interface(key[0], key[1], self.timeout, self.keepalive,
+                                                            **self.session_args)
+        return session
+
+    def get_instrument(self, ip_address, port=5025, cls=ZNB):
+        """
+        Get the Instrument object of the session for the address. It is created with cls(session) when the
+        address is first used, or when the session has been replaced.
+
+        :param cls: The Instrument class
+        :rtype: Instrument
+        """
+        key = (ip_address, port)
+        with self._lock:
+            session = self._open(key)
+            instrument = self._instruments.get(key)
+            if instrument is None or instrument._visa_res is not session:
+                instrument = self._instruments[key] = cls(session)
+            elif not isinstance(instrument, cls):
+                raise TypeError("The session is used by a %s object" % type(instrument).__name__)
+            return instrument
+
+    @property
+    def sessions(self):
+        """
+        The open sessions, keyed by (ip_address, port)
+        """
+        with self._lock:
+            return dict((k, v) for k, v in self._sessions.items() if not v.closed)
+
+    def close(self, ip_address, port=5025):
+        with self._lock:
+            session = self._sessions.pop((ip_address, port), None)
+            self._instruments.pop((ip_address, port), None)
+        if session is not None:
+            session.close()
+
+    def close_all(self):
+        with self._lock:
+            sessions, self._sessions = self._sessions.values(), {}
+            self._instruments = {}
+        for session in sessions:
+            session.close()
+
+
+default_pool = ConnectionPool()
+
+
+def get_session(ip_address, port=5025):
+    """
+    Get the shared session for the address from default_pool. Only one Instrument object can use it,
+    see get_instrument().
+
+    :rtype: SocketInterface
+    """
+    return default_pool.open_resource(ip_address, port)
+
+
+def get_instrument(ip_address, port=5025, cls=ZNB):
+    """
+    Get the Instrument object of the shared session for the address from default_pool.
+
+    :param cls: The Instrument class
+    :rtype: Instrument
+    """
+    return default_pool.get_instrument(ip_address, port, cls)
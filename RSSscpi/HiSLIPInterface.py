@@ -0,0 +1,449 @@
+# -*- coding: utf-8 -*-
+"""
+A pure Python HiSLIP client, IVI-6.1, for instruments with a HiSLIP server on port 4880, like the ZNB and ZVA.
+
+HiSLIP uses two TCP connections per session. Program messages and responses are exchanged on the synchronous
+channel, while service requests, status queries and device clear use the asynchronous channel. Service requests
+are delivered to the handler installed by Instrument.init(), so *OPC completion and errors are reported without
+polling, unlike on the raw socket:
+
+znb = ZNB(HiSLIPInterface("10.0.0.2"))
+znb.init()
+znb.start_and_wait(znb.INITiate(1).IMMediate(), timeout=10)
+
+@author: Lukas Sandström
+"""
+
+import Queue
+import socket
+import struct
+import threading
+import traceback
+
+from SocketInterface import SocketInterface
+
+# Message types, IVI-6.1 table 4
+INITIALIZE = 0
+INITIALIZE_RESPONSE = 1
+FATAL_ERROR = 2
+ERROR = 3
+ASYNC_LOCK = 4
+ASYNC_LOCK_RESPONSE = 5
+DATA = 6
+DATA_END = 7
+DEVICE_CLEAR_COMPLETE = 8
+DEVICE_CLEAR_ACKNOWLEDGE = 9
+ASYNC_REMOTE_LOCAL_CONTROL = 10
+ASYNC_REMOTE_LOCAL_RESPONSE = 11
+TRIGGER = 12
+INTERRUPTED = 13
+ASYNC_INTERRUPTED = 14
+ASYNC_MAXIMUM_MESSAGE_SIZE = 15
+ASYNC_MAXIMUM_MESSAGE_SIZE_RESPONSE = 16
+ASYNC_INITIALIZE = 17
+ASYNC_INITIALIZE_RESPONSE = 18
+ASYNC_DEVICE_CLEAR = 19
+ASYNC_SERVICE_REQUEST = 20
+ASYNC_STATUS_QUERY = 21
+ASYNC_STATUS_RESPONSE = 22
+ASYNC_DEVICE_CLEAR_ACKNOWLEDGE = 23
+
+PROTOCOL_VERSION = 0x0100  # 1.0
+FIRST_MESSAGE_ID = 0xffffff00
+OVERLAPPED = 1  # Control code bit of InitializeResponse and the device clear messages
+
+_header = struct.Struct(">2sBBIQ")  # Prologue "HS", message type, control code, message parameter, payload length
+_size = struct.Struct(">Q")
+
+
+class HiSLIPError(socket.error):
+    """
+    An Error or FatalError message from the server, or a violation of the protocol.
+    """
+    def __init__(self, msg, fatal=False):
+        super(HiSLIPError, self).__init__(msg)
+        self.fatal = fatal
+
+
+def send_message(sock, msg_type, control=0, param=0, payload=""):
+    """
+    Send a HiSLIP message. The payload is sent from its buffer if it's large, instead of being copied.
+
+    :type payload: str or bytearray or memoryview
+    """
+    header = _header.pack("HS", msg_type, control, param, len(payload))
+    if len(payload) < SocketInterface.coalesce_size:
+        sock.sendall(header + (payload.tobytes() if isinstance(payload, memoryview) else str(payload)))
+    else:
+        sock.sendall(header)
+        sock.sendall(payload)
+
+
+def recv_exact(sock, n):
+    """
+    :return: Exactly n bytes from the socket
+    :rtype: bytearray
+    """
+    buf = bytearray(n)
+    view = memoryview(buf)
+    pos = 0
+    while pos < n:
+        k = sock.recv_into(view[pos:], n - pos)
+        if not k:
+            raise socket.error("Connection closed by the peer")
+        pos += k
+    return buf
+
+
+def recv_message(sock):
+    """
+    Receive a HiSLIP message.
+
+    :return: (message type, control code, message parameter, payload)
+    :rtype: (int, int, int, bytearray)
+    """
+    prologue, msg_type, control, param, length = _header.unpack(str(recv_exact(sock, _header.size)))
+    if prologue != "HS":
+        raise HiSLIPError("Invalid message prologue: %r" % prologue, fatal=True)
+    return msg_type, control, param, recv_exact(sock, length)
+
+
+class HiSLIPInterface(SocketInterface):
+    """
+    A HiSLIP session with the subset of the pyvisa resource interface used by Instrument.
+
+    In overlapped mode, which the server selects, write() doesn't wait for the responses of earlier queries,
+    and read_raw() returns the responses in the order of the queries. Connection handling, the session lock
+    and reconnect() work as in SocketInterface.
+    """
+    has_srq = True
+    vendor_id = "PY"  # The client vendor ID sent in the Initialize message
+    max_message_size = 1 << 30  # The largest message the client accepts, longer responses are split by the server
+
+    def __init__(self, ip_address, port=4880, timeout=1.0, keepalive=True, sub_address="hislip0", **kwargs):
+        """
+        :param ip_address: The host name or IP address of the instrument
+        :param port: The HiSLIP port
+        :param timeout: Timeout in seconds for the responses on both channels
+        :param keepalive: Enable TCP keepalive, see SocketInterface
+        :param sub_address: The HiSLIP device name, from the VISA resource string TCPIP::<ip>::<sub_address>::INSTR
+        :param kwargs: The socket buffer sizes, see SocketInterface
+        """
+        self.sub_address = sub_address
+        self.overlapped = False
+        self.session_id = None
+        self.server_version = None
+        self.server_max_message_size = None
+        self._message_id = FIRST_MESSAGE_ID
+        self._rmt_delivered = False
+        self._payload_left = 0  # Unread payload of the current Data message, see _read_response_into()
+        self._response_ended = False  # The current message is DataEnd
+        self._async = None
+        self._async_lock = threading.Lock()
+        self._async_responses = None
+        self._srq_handlers = []
+        self._srq_enabled = False
+        self._srq_queue = Queue.Queue()
+        super(HiSLIPInterface, self).__init__(ip_address, port, timeout, keepalive, **kwargs)
+        dispatcher = threading.Thread(target=self._dispatch_srq, name="HiSLIP SRQ")  # Only when connected
+        dispatcher.daemon = True
+        dispatcher.start()
+
+    @staticmethod
+    def open_resource(ip_address, port=4880):
+        return HiSLIPInterface(ip_address, port)
+
+    def new_session(self):
+        return HiSLIPInterface(self.ip, self.port, self.timeout, self.keepalive, self.sub_address,
+                               send_buffer_size=self.send_buffer_size, recv_buffer_size=self.recv_buffer_size)
+
+    def _connect(self):
+        sync = self._open_socket()
+        try:
+            vendor = struct.unpack(">H", self.vendor_id)[0]
+            send_message(sync, INITIALIZE, 0, (PROTOCOL_VERSION << 16) | vendor, self.sub_address)
+            control, param, _ = self._expect(recv_message(sync), INITIALIZE_RESPONSE)
+            async_sock = self._open_socket()
+        except socket.error:
+            sync.close()
+            raise
+        try:
+            send_message(async_sock, ASYNC_INITIALIZE, 0, param & 0xffff)
+            self._expect(recv_message(async_sock), ASYNC_INITIALIZE_RESPONSE)
+            send_message(async_sock, ASYNC_MAXIMUM_MESSAGE_SIZE, payload=_size.pack(self.max_message_size))
+            _, _, payload = self._expect(recv_message(async_sock), ASYNC_MAXIMUM_MESSAGE_SIZE_RESPONSE)
+        except socket.error:
+            sync.close()
+            async_sock.close()
+            raise
+        self.overlapped = bool(control & OVERLAPPED)
+        self.server_version = param >> 16
+        self.session_id = param & 0xffff
+        self.server_max_message_size = _size.unpack(str(payload))[0]
+        self._message_id = FIRST_MESSAGE_ID
+        self._rmt_delivered = False
+        self._socket = sync
+        self._async = async_sock
+        # Each connection has its own response queue, so that a reader of a closed connection can't interfere
+        self._async_responses = Queue.Queue()
+        reader = threading.Thread(target=self._read_async, args=(async_sock, self._async_responses),
+                                  name="HiSLIP async")
+        reader.daemon = True
+        reader.start()
+
+    @staticmethod
+    def _expect(message, msg_type):
+        """
+        :param message: A message from recv_message()
+        :return: (control code, message parameter, payload)
+        :raises HiSLIPError: if the message isn't of type msg_type
+        """
+        t, control, param, payload = message
+        if t in (ERROR, FATAL_ERROR):
+            raise HiSLIPError("%s %d: %s" % ("Fatal error" if t == FATAL_ERROR else "Error", control, payload),
+                              fatal=t == FATAL_ERROR)
+        if t != msg_type:
+            raise HiSLIPError("Expected message type %d, got %d" % (msg_type, t), fatal=True)
+        return control, param, payload
+
+    def _disconnect(self):
+        for s in (self._socket, self._async):
+            if s is None:
+                continue
+            try:
+                s.shutdown(socket.SHUT_RDWR)  # Wakes up the asynchronous channel reader
+            except socket.error:
+                pass
+            s.close()
+
+    def close(self):
+        super(HiSLIPInterface, self).close()
+        self._srq_queue.put(None)
+
+    # Asynchronous channel
+
+    def _read_async(self, sock, responses):
+        """
+        Read the asynchronous channel. Service requests are passed on to the dispatcher thread, other messages
+        are responses to _async_request().
+        """
+        try:
+            sock.settimeout(None)
+            while True:
+                message = recv_message(sock)
+                if message[0] == ASYNC_SERVICE_REQUEST:
+                    self._srq_queue.put(message[1])
+                elif message[0] != ASYNC_INTERRUPTED:
+                    responses.put(message)
+        except (socket.error, struct.error, ValueError):
+            responses.put(None)  # The connection was closed
+
+    def _async_request(self, msg_type, response_type, control=0, param=0, payload=""):
+        """
+        Send a message on the asynchronous channel and wait for the response.
+
+        :return: (control code, message parameter, payload) of the response
+        """
+        with self._async_lock:
+            send_message(self._async, msg_type, control, param, payload)
+            try:
+                message = self._async_responses.get(timeout=self.timeout)
+            except Queue.Empty:
+                raise socket.timeout("Timeout while waiting for HiSLIP message type %d" % response_type)
+            if message is None:
+                raise socket.error("Connection closed by the instrument")
+            return self._expect(message, response_type)
+
+    def _dispatch_srq(self):
+        """
+        Call the service request handlers from a thread of their own, since the handlers use the
+        asynchronous channel for read_stb().
+        """
+        while True:
+            stb = self._srq_queue.get()
+            if stb is None:
+                return
+            if not self._srq_enabled:
+                continue
+            for event_type, handler, user_handle in list(self._srq_handlers):
+                try:
+                    handler(self, event_type, None, user_handle)
+                except Exception:
+                    # The handler passes the error on to the threads waiting for it, see
+                    # Instrument._service_request_handler(). Print it too, since there may be no waiting thread.
+                    traceback.print_exc()
+
+    def install_handler(self, event_type, handler, user_handle=None):
+        self._srq_handlers.append((event_type, handler, user_handle))
+        return user_handle
+
+    def uninstall_handler(self, event_type, handler, user_handle=None):
+        self._srq_handlers.remove((event_type, handler, user_handle))
+
+    def enable_event(self, *args):
+        self._srq_enabled = True
+
+    def disable_event(self, *args):
+        self._srq_enabled = False
+
+    def read_stb(self):
+        """
+        Read the status byte with AsyncStatusQuery.
+
+        :rtype: int
+        """
+        control, _, _ = self._async_request(ASYNC_STATUS_QUERY, ASYNC_STATUS_RESPONSE, int(self._rmt_delivered),
+                                            (self._message_id - 2) & 0xffffffff)
+        return control
+
+    def clear(self):
+        """
+        Device clear, discards any pending responses and resets the message ID.
+        """
+        with self.lock:
+            control, _, _ = self._async_request(ASYNC_DEVICE_CLEAR, ASYNC_DEVICE_CLEAR_ACKNOWLEDGE)
+            send_message(self._socket, DEVICE_CLEAR_COMPLETE, control & OVERLAPPED)
+            while True:
+                message = recv_message(self._socket)
+                if message[0] == DEVICE_CLEAR_ACKNOWLEDGE:
+                    break
+                if message[0] == FATAL_ERROR:
+                    self._expect(message, DEVICE_CLEAR_ACKNOWLEDGE)
+            self.overlapped = bool(message[1] & OVERLAPPED)
+            self._message_id = FIRST_MESSAGE_ID
+            self._rmt_delivered = False
+
+    # Synchronous channel
+
+    def _send_data(self, msg_type, payload):
+        control = int(self._rmt_delivered)
+        self._rmt_delivered = False
+        send_message(self._socket, msg_type, control, self._message_id, payload)
+        self._message_id = (self._message_id + 2) & 0xffffffff
+
+    def write(self, string):
+        self.write_parts([string])
+
+    def write_parts(self, parts):
+        """
+        Send the concatenation of parts as a program message, in Data messages terminated by DataEnd.
+        Large parts are sent from their buffers, see SocketInterface.write_parts().
+
+        :param parts: A list of str, bytearray or memoryview
+        """
+        with self.lock:
+            max_size = self.server_max_message_size
+            total = sum(len(x) for x in parts)
+            if total <= max_size and len(parts) == 1:
+                self._send_data(DATA_END, parts[0])
+                return
+            views = [memoryview(x) if not isinstance(x, memoryview) else x for x in parts]
+            if total <= max_size and total < self.coalesce_size:
+                self._send_data(DATA_END, "".join(v.tobytes() for v in views))
+                return
+            # Split into messages of at most max_size, each sent as the header followed by the slices of the parts
+            sent = 0
+            while True:
+                n = min(max_size, total - sent)
+                last = sent + n == total
+                control = int(self._rmt_delivered)
+                self._rmt_delivered = False
+                self._socket.sendall(_header.pack("HS", DATA_END if last else DATA, control, self._message_id, n))
+                self._message_id = (self._message_id + 2) & 0xffffffff
+                end = sent + n
+                pos = 0
+                for v in views:
+                    a, b = max(sent, pos), min(end, pos + len(v))
+                    if a < b:
+                        self._socket.sendall(v[a - pos:b - pos])
+                    pos += len(v)
+                sent = end
+                if last:
+                    return
+
+    def write_stream(self, chunks):
+        """
+        Send a program message which is produced in chunks, each chunk in a Data message of its own,
+        see SocketInterface.write_stream().
+        """
+        with self.lock:
+            max_size = self.server_max_message_size
+            for chunk in chunks:
+                view = chunk if isinstance(chunk, memoryview) else memoryview(chunk)
+                for pos in xrange(0, len(view), max_size):
+                    self._send_data(DATA, view[pos:pos + max_size])
+            self._send_data(DATA_END, "")
+
+    def _next_data_message(self):
+        """
+        Read the header of the next Data or DataEnd message of the response, the payload is left in the socket.
+        """
+        while True:
+            prologue, msg_type, control, param, length = _header.unpack(str(recv_exact(self._socket, _header.size)))
+            if prologue != "HS":
+                raise HiSLIPError("Invalid message prologue: %r" % prologue, fatal=True)
+            if msg_type in (DATA, DATA_END):
+                self._payload_left = length
+                self._response_ended = msg_type == DATA_END
+                return
+            self._expect((msg_type, control, param, recv_exact(self._socket, length)), DATA_END)
+
+    def _read_response_into(self, view):
+        pos = 0
+        while pos < len(view):
+            if not self._payload_left:
+                if self._response_ended:
+                    self._response_ended = False
+                    raise HiSLIPError("The response ended before the block")
+                self._next_data_message()
+                continue
+            n = min(self._payload_left, len(view) - pos)
+            self._recv_into(view[pos:pos + n])
+            self._payload_left -= n
+            pos += n
+
+    def _end_response(self):
+        rest = bytearray()
+        while True:
+            if self._payload_left:
+                rest += recv_exact(self._socket, self._payload_left)
+                self._payload_left = 0
+            if self._response_ended:
+                break
+            self._next_data_message()
+        self._response_ended = False
+        self._rmt_delivered = True
+        return str(rest)
+
+    def read_raw(self):
+        """
+        Read a complete response, the payload of the Data messages up to and including DataEnd.
+        A response in a single message is received directly into a preallocated buffer.
+
+        :return: A bytearray if the response contains block data, a str otherwise
+        :rtype: str or bytearray
+        """
+        with self.lock:
+            buf = None
+            while True:
+                msg_type, control, param, payload = recv_message(self._socket)
+                if msg_type in (DATA, DATA_END):
+                    if buf is None:
+                        buf = payload
+                    else:
+                        buf += payload
+                    if msg_type == DATA_END:
+                        break
+                elif msg_type == INTERRUPTED:
+                    buf = None  # The response was discarded by the server, synchronized mode only
+                else:
+                    self._expect((msg_type, control, param, payload), DATA_END)
+            self._rmt_delivered = True
+            return buf if buf.find("#") >= 0 else str(buf)
+
+    def assert_trigger(self):
+        """
+        Send the Trigger message, the HiSLIP equivalent of a GPIB group execute trigger.
+        """
+        with self.lock:
+            self._send_data(TRIGGER, "")
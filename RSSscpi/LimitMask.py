@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Limit line checks on fetched trace data, evaluated client side with numpy:
+
+mask = LimitMask(upper=[(1e9, 2e9, -3, -3)], lower=[(1e9, 2e9, -20, -10)])
+stimulus, traces = channel.fetch_all_traces("FDATa")
+result = mask.evaluate(numpy.vstack(traces.values()), stimulus)
+result.passed, result.margin
+
+The same limits can be written to the instrument with write_to_trace(), so the instrument's limit check and
+the client side check agree.
+
+@author: Lukas Sandström
+"""
+
+import numpy
+
+
+class LimitResult(object):
+    """
+    The result of LimitMask.evaluate(). For a block of traces, the attributes are arrays with one element per trace.
+    """
+    def __init__(self, margins, stimulus):
+        """
+        :param margins: The margin at each point, see LimitMask.margins()
+        :param stimulus: The stimulus values
+        """
+        self.margins = margins
+        self.stimulus = stimulus
+        if not margins.shape[-1]:
+            raise ValueError("No trace points to check")
+        #: The index of the point with the smallest margin
+        self.worst_index = numpy.argmin(margins, axis=-1)
+        #: The smallest margin, negative if the limits are violated. +inf if no point is covered by the limits.
+        self.margin = numpy.min(margins, axis=-1)
+        #: True if no point violates the limits. Points with NaN values fail.
+        self.passed = self.margin >= 0
+
+    @property
+    def worst_stimulus(self):
+        """
+        The stimulus value of the point with the smallest margin
+        """
+        return self.stimulus[self.worst_index]
+
+    @property
+    def failed_points(self):
+        """
+        A boolean array with the shape of the data, True where the limits are violated
+        """
+        return ~(self.margins >= 0)
+
+
+class LimitMask(object):
+    """
+    Piecewise linear upper and lower limit lines. Each line is a list of segments (start, stop, start_value,
+    stop_value), like the limit line segments of the instrument, CALCulate<Ch>:LIMit:DATA. The stimulus values
+    are in Hz (or the unit of the sweep type), the response values in the unit of the trace format.
+    Points which aren't covered by any segment aren't checked. Where segments overlap, the strictest limit applies.
+
+    The limits are interpolated to the stimulus grid of the channel once, and reused as long as the grid is
+    unchanged. Channel.stimulus() returns the same array until the sweep configuration changes, so the check
+    only compares array identity in the common case.
+    """
+    UPPER = 1  # LMAX in CALCulate:LIMit:DATA
+    LOWER = 2  # LMIN
+
+    def __init__(self, upper=(), lower=()):
+        """
+        :param upper: The segments of the upper limit line, [(start, stop, start_value, stop_value), ...]
+        :param lower: The segments of the lower limit line
+        """
+        self.upper = self._segments(upper)
+        self.lower = self._segments(lower)
+        self._grid = None  # (stimulus, upper limits, lower limits)
+
+    @staticmethod
+    def _segments(segments):
+        segments = numpy.array(segments, numpy.float64).reshape(-1, 4)
+        if numpy.any(segments[:, 1] < segments[:, 0]):
+            raise ValueError("The stop value of a limit segment is less than the start value")
+        return segments
+
+    @staticmethod
+    def _on_grid(segments, stimulus, reduce, fill):
+        """
+        Interpolate the segments to the stimulus values, combining overlapping segments with reduce.
+        """
+        limits = numpy.full(len(stimulus), fill)
+        for start, stop, start_value, stop_value in segments:
+            i = numpy.searchsorted(stimulus, start, side="left")
+            j = numpy.searchsorted(stimulus, stop, side="right")
+            if i >= j:
+                continue
+            if stop > start:
+                values = start_value + (stimulus[i:j] - start) * ((stop_value - start_value) / (stop - start))
+            else:  # A vertical segment, the strictest value applies
+                values = reduce(start_value, stop_value)
+            limits[i:j] = reduce(limits[i:j], values)
+        return limits
+
+    def limits(self, stimulus):
+        """
+        The limit lines on the stimulus grid, +-inf where a line has no segment. The result is cached for the grid.
+
+        :param numpy.ndarray stimulus: The stimulus values, in ascending order
+        :return: The upper and lower limits
+        :rtype: (numpy.ndarray, numpy.ndarray)
+        """
+        grid = self._grid
+        if grid is not None and (grid[0] is stimulus or numpy.array_equal(grid[0], stimulus)):
+            return grid[1], grid[2]
+        stimulus = numpy.asarray(stimulus, numpy.float64)
+        upper = self._on_grid(self.upper, stimulus, numpy.minimum, numpy.inf)
+        lower = self._on_grid(self.lower, stimulus, numpy.maximum, -numpy.inf)
+        upper.flags.writeable = lower.flags.writeable = False
+        self._grid = (stimulus, upper, lower)
+        return upper, lower
+
+    def margins(self, data, stimulus):
+        """
+        The distance from each point to the nearest limit line, negative outside the limits.
+
+        :param data: Formatted trace data, points or traces x points
+        :param stimulus: The stimulus values
+        :rtype: numpy.ndarray
+        """
+        data = numpy.asarray(data)
+        if numpy.iscomplexobj(data):
+            raise TypeError("Limit checks need formatted trace data, see Trace.fetch_data('FDATa')")
+        upper, lower = self.limits(stimulus)
+        margins = upper - data
+        numpy.minimum(margins, data - lower, out=margins)
+        return margins
+
+    def evaluate(self, data, stimulus):
+        """
+        Check a trace, or a block of traces, against the limits.
+
+        :param data: Formatted trace data, points or traces x points
+        :param stimulus: The stimulus values
+        :rtype: LimitResult
+        """
+        return LimitResult(self.margins(data, stimulus), numpy.asarray(stimulus))
+
+    def check_trace(self, trace):
+        """
+        Fetch the formatted data of a trace and check it against the limits. The stimulus values are
+        only transferred when the sweep configuration has changed, see Channel.stimulus().
+
+        :param Trace trace:
+        :rtype: LimitResult
+        """
+        return self.evaluate(trace.fetch_data("FDATa"), trace.channel.stimulus())
+
+    def write_to_trace(self, trace, check=True, display=True):
+        """
+        Replace the limit lines of a trace on the instrument with the segments of the mask, in one batch.
+        The instrument result can then be read with CALCulate<Ch>:LIMit:FAIL?, see instrument_failed().
+
+        :param Trace trace:
+        :param check: Enable the limit check, CALCulate<Ch>:LIMit:STATe
+        :param display: Show the limit lines, CALCulate<Ch>:LIMit:DISPlay:STATe
+        """
+        args = []
+        for line_type, segments in ((self.UPPER, self.upper), (self.LOWER, self.lower)):
+            for segment in segments.tolist():
+                args += [line_type] + segment
+        lim = trace.channel.CALC.LIMit
+        with trace.channel.instrument.batch():
+            trace.select_trace()
+            lim.DELete.ALL().w()
+            if args:
+                lim.DATA().w(*args)
+            lim.STATe().w(check)
+            lim.DISPlay.STATe().w(display)
+
+    @staticmethod
+    def instrument_failed(trace):
+        """
+        :param Trace trace:
+        :return: True if the trace failed the limit check of the instrument, CALCulate<Ch>:LIMit:FAIL?
+        :rtype: bool
+        """
+        with trace.channel.instrument.pipeline():
+            trace.select_trace()
+            failed = trace.channel.CALC.LIMit.FAIL().q_async()
+        return bool(int(failed))
@@ -4,16 +4,120 @@
 @author: Lukas Sandström
 """
 
+import re
 import socket
+import threading
 
 
 class SocketInterface(object):
-    def __init__(self, ip_address):
+    """
+    A raw socket session, port 5025, with the subset of the pyvisa resource interface used by Instrument.
+
+    When the instrument has closed or reset the connection, for instance after a reboot, Instrument calls
+    reconnect() and restores its setup before retrying the failed command, see Instrument._call_visa().
+    Threads using the same Instrument notice the new connection from reconnect_count.
+
+    A session belongs to one Instrument object, which can be used from several threads, see
+    ConnectionPool.get_instrument(). Writes and queries are serialized with lock.
+    """
+    chunk_size = 4096  # Size of the recv() calls used when reading ASCII responses
+    has_srq = False  # Service requests are not supported on the raw socket
+    _special_re = re.compile(r"[;\n'\"]")  # Separators and quotes in ASCII responses
+
+    keepalive_idle = 10  # Seconds of idle time before TCP keepalive probes are sent
+    keepalive_interval = 5  # Seconds between the keepalive probes
+    keepalive_count = 3  # The number of unanswered probes before the connection is considered lost
+
+    coalesce_size = 65536  # Parts smaller than this are joined by write_parts(), larger parts are sent as is
+
+    def __init__(self, ip_address, port=5025, timeout=1.0, keepalive=True, send_buffer_size=None,
+                 recv_buffer_size=None):
+        """
+        :param ip_address: The host name or IP address of the instrument
+        :param port: The SCPI raw socket port
+        :param timeout: Socket timeout in seconds
+        :param keepalive: Enable TCP keepalive, so that a lost connection is detected while the session is idle
+        :param send_buffer_size: The socket send buffer size, SO_SNDBUF, in bytes. The OS default if None.
+        :param recv_buffer_size: The socket receive buffer size, SO_RCVBUF, in bytes. The OS default if None.
+                                 A larger buffer speeds up large block transfers on links with high latency.
+        """
         self.ip = ip_address
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._socket.settimeout(1)  # 1 second timeout
-        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 0)  # Disable Nagle algorithm
-        self._socket.connect((self.ip, 5025))
+        self.port = port
+        self.timeout = timeout
+        self.keepalive = keepalive
+        self.send_buffer_size = send_buffer_size
+        self.recv_buffer_size = recv_buffer_size
+        self.auto_reconnect = True
+        self.reconnect_count = 0
+        """
+        The number of times the connection has been reopened
+        """
+        self.lock = threading.RLock()
+        self._closed = False
+        self._socket = None
+        self._connect()
+
+    def _connect(self):
+        self._socket = self._open_socket()
+
+    def _open_socket(self):
+        """
+        :return: A new connection to the instrument, with the socket options of the session
+        """
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.settimeout(self.timeout)
+        # Disable the Nagle algorithm. Commands are sent in one piece, so there is nothing to gain from
+        # delaying small segments, and Nagle combined with delayed ACKs stalls short queries by up to 40 ms.
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # The buffer sizes are set before connecting, so that the TCP window scaling is negotiated accordingly
+        if self.send_buffer_size:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer_size)
+        if self.recv_buffer_size:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.recv_buffer_size)
+        if self.keepalive:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            for opt, value in [("TCP_KEEPIDLE", self.keepalive_idle), ("TCP_KEEPINTVL", self.keepalive_interval),
+                               ("TCP_KEEPCNT", self.keepalive_count)]:
+                if hasattr(socket, opt):  # Not available on all platforms
+                    s.setsockopt(socket.IPPROTO_TCP, getattr(socket, opt), value)
+        try:
+            s.connect((self.ip, self.port))
+        except socket.error:
+            s.close()
+            raise
+        return s
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def settimeout(self, timeout):
+        """
+        Change the socket timeout of the session, also for connections opened by reconnect().
+
+        :param timeout: Timeout in seconds
+        """
+        self.timeout = timeout
+        if self._socket is not None:
+            self._socket.settimeout(timeout)
+
+    def reconnect(self, count=None):
+        """
+        Close the connection and open a new one.
+
+        :param count: The reconnect_count observed when the connection failed. If the session has been
+                      reconnected since, by another user of the session, the connection is not reopened again.
+        :return: True if a new connection is open, False if reconnecting is disabled or the session is closed
+        """
+        with self.lock:
+            if self._closed or not self.auto_reconnect:
+                return False
+            if count is not None and count != self.reconnect_count:
+                return True
+            self._disconnect()
+            self._connect()
+            self.reconnect_count += 1
+            return True
 
     def install_handler(self, *args):
         pass
@@ -22,18 +126,226 @@ class SocketInterface(object):
         pass
 
     @staticmethod
-    def open_resource(ip_address):
-        return SocketInterface(ip_address)
+    def open_resource(ip_address, port=5025):
+        return SocketInterface(ip_address, port)
+
+    def new_session(self):
+        """
+        :return: A new session to the same instrument with the same settings, independent of this one
+        :rtype: SocketInterface
+        """
+        return type(self)(self.ip, self.port, self.timeout, self.keepalive, send_buffer_size=self.send_buffer_size,
+                          recv_buffer_size=self.recv_buffer_size)
+
+    def _disconnect(self):
+        try:
+            self._socket.close()
+        except socket.error:
+            pass
 
     def close(self):
-        self._socket.close()
+        self._closed = True
+        self._disconnect()
 
     def write(self, string):
-        self._socket.send(string + "\n")
+        if len(string) >= self.coalesce_size:
+            self.write_parts([string])  # Avoid copying a large string to append the terminator
+            return
+        with self.lock:
+            self._socket.sendall(string + "\n")
 
-    def query(self, string):
-        self.write(string)
-        r = self._socket.recv(4096)
-        while r[-1] != "\n":
-            r += self._socket.recv(4096)
+    def write_parts(self, parts):
+        """
+        Write the concatenation of parts followed by the terminator, without joining large parts, like the
+        data of a block, into a new string. Consecutive small parts are joined and sent together, so that
+        the command header is not sent in a segment of its own.
+
+        :param parts: A list of str, bytearray or memoryview
+        """
+        with self.lock:
+            small = []
+            for part in parts:
+                if len(part) < self.coalesce_size:
+                    small.append(part.tobytes() if isinstance(part, memoryview) else str(part))
+                    continue
+                if small:
+                    self._socket.sendall("".join(small))
+                    small = []
+                self._socket.sendall(part)
+            small.append("\n")
+            self._socket.sendall("".join(small))
+
+    def write_stream(self, chunks):
+        """
+        Write a program message which is produced in chunks, like a file read with a fixed-size buffer,
+        followed by the terminator. Each chunk is sent before the next one is requested, so the iterator
+        may reuse its buffer.
+
+        :param chunks: An iterable of str, bytearray or memoryview
+        """
+        with self.lock:
+            for chunk in chunks:
+                self._socket.sendall(chunk)
+            self._socket.sendall("\n")
+
+    def _recv(self):
+        r = self._socket.recv(self.chunk_size)
+        if not r:
+            raise socket.error("Connection closed by the instrument")
         return r
+
+    def _recv_into(self, view):
+        """
+        Fill the memoryview completely with data from the socket.
+        """
+        pos = 0
+        while pos < len(view):
+            n = self._socket.recv_into(view[pos:], len(view) - pos)
+            if not n:
+                raise socket.error("Connection closed by the instrument")
+            pos += n
+
+    def read_raw(self):
+        """
+        Read a complete response from the instrument.
+
+        Definite length block data, #<n><length><data>, is received directly into a preallocated
+        bytearray of the exact response size, which is returned without further copying.
+        Other responses are read until the terminating newline and returned as a str. Newlines and semicolons
+        in quoted strings are skipped, a quote without a closing quote is read as a literal character.
+        Responses to combined queries, "A?;B?", are read until the final newline, and returned as one
+        bytearray if they contain any definite length blocks.
+
+        :rtype: str or bytearray
+        """
+        parts = []
+        r = self._recv()
+        while True:
+            if r[0] == "#":
+                while len(r) < 2 or len(r) < int(r[1]) + 2:  # Make sure the whole block header has been received
+                    r += self._recv()
+                n = int(r[1])
+                if n == 0:  # Indefinite length block, terminated by newline
+                    parts.append(self._read_line(r))
+                    break
+                header_len = n + 2
+                size = header_len + int(r[2:header_len]) + 1  # Header, data and the separator or terminator
+                buf = bytearray(size)
+                view = memoryview(buf)
+                received = min(len(r), size)
+                view[:received] = r[:received]
+                self._recv_into(view[received:])
+                r = r[size:]
+                if not parts and buf[-1:] == "\n":
+                    return buf
+                parts.append(buf)
+                if buf[-1:] == "\n":
+                    break
+            else:
+                chunks = []
+                pos = 0
+                while True:
+                    m = self._special_re.search(r, pos)
+                    if not m:
+                        chunks.append(r)
+                        r = self._recv()
+                        pos = 0
+                        continue
+                    c = m.group()
+                    if c == ";" or c == "\n":
+                        break
+                    end = r.find(c, m.end())  # Skip over quoted strings
+                    if end >= 0:
+                        pos = end + 1
+                    elif r[-1:] == "\n":
+                        # No closing quote before the end of the received data, which ends with a newline.
+                        # Treat the quote as a literal character, like the apostrophe in an unquoted file name.
+                        pos = m.end()
+                    else:
+                        r += self._recv()
+                chunks.append(r[:m.end()])
+                r = r[m.end():]
+                parts.append("".join(chunks))
+                if c == "\n":
+                    break
+            if not r:
+                r = self._recv()
+        if len(parts) == 1:
+            return parts[0]
+        if not any(isinstance(x, bytearray) for x in parts):
+            return "".join(parts)
+        ret = bytearray()
+        for x in parts:
+            ret += x
+        return ret
+
+    def _read_line(self, r):
+        """
+        :param r: The start of the response, already received
+        :return: The rest of the response, up to and including the terminating newline
+        """
+        chunks = [r]
+        while "\n" not in chunks[-1]:
+            chunks.append(self._recv())
+        return "".join(chunks)
+
+    def _read_response_into(self, view):
+        """
+        Fill the memoryview with the next part of the response, see read_block().
+        """
+        self._recv_into(view)
+
+    def _end_response(self):
+        """
+        Discard the rest of the response after read_block(), normally only the terminator.
+        """
+        return self._read_line("")
+
+    def read_block(self, write, chunk_size=1 << 20):
+        """
+        Read a response consisting of a single definite length block, and pass the data to write() in chunks.
+        The chunks are received into a reused buffer of chunk_size bytes, so the memory use doesn't depend on
+        the size of the block.
+
+        :param write: Function called with a memoryview of each chunk, which is only valid during the call
+        :param chunk_size: The buffer size in bytes
+        :return: The length of the block
+        :rtype: int
+        """
+        with self.lock:
+            header = bytearray(11)
+            view = memoryview(header)
+            self._read_response_into(view[:2])
+            if header[0:1] != "#" or not chr(header[1]).isdigit() or header[1:2] == "0":
+                rest = self._end_response()
+                raise ValueError("Expected a definite length block, got: %r" % (str(header[:2]) + rest[:40]))
+            n = int(chr(header[1]))
+            self._read_response_into(view[2:2 + n])
+            length = remaining = int(str(header[2:2 + n]))
+            buf = memoryview(bytearray(min(chunk_size, length)))
+            while remaining:
+                k = min(len(buf), remaining)
+                self._read_response_into(buf[:k])
+                write(buf[:k])
+                remaining -= k
+            self._end_response()
+            return length
+
+    def query_block(self, string, write, chunk_size=1 << 20):
+        """
+        Write string and read the block response with read_block().
+        """
+        with self.lock:
+            self.write(string)
+            return self.read_block(write, chunk_size)
+
+    def query_raw(self, string):
+        """
+        Write string and read the response, see read_raw().
+        """
+        with self.lock:
+            self.write(string)
+            return self.read_raw()
+
+    def query(self, string):
+        return self.query_raw(string)
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: Lukas Sandström
+"""
+
+import numpy
+
+
+class SweepHistory(object):
+    """
+    A ring buffer holding the most recent sweeps of a trace, in a preallocated 2-D array (sweeps x points).
+    When the buffer is full, appended sweeps overwrite the oldest ones.
+    """
+    def __init__(self, capacity, points, dtype=numpy.complex128):
+        """
+        :param capacity: The maximum number of sweeps kept
+        :param points: The number of points in each sweep
+        :param dtype: The dtype of the sweep data
+        """
+        self.buffer = numpy.empty((capacity, points), dtype)
+        self.count = 0  # The total number of appended sweeps
+
+    @property
+    def capacity(self):
+        return self.buffer.shape[0]
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, sweep):
+        self.buffer[self.count % self.capacity] = sweep
+        self.count += 1
+
+    def extend(self, sweeps):
+        """
+        Append the rows of a 2-D array, with at most two copies into the buffer.
+        """
+        sweeps = sweeps[-self.capacity:]
+        pos = self.count % self.capacity
+        n = min(len(sweeps), self.capacity - pos)
+        self.buffer[pos:pos + n] = sweeps[:n]
+        self.buffer[:len(sweeps) - n] = sweeps[n:]
+        self.count += len(sweeps)
+
+    def array(self):
+        """
+        :return: The sweeps in the buffer, oldest first. A view of the buffer until it has wrapped around, a copy after.
+        :rtype: numpy.ndarray
+        """
+        if self.count <= self.capacity:
+            return self.buffer[:self.count]
+        pos = self.count % self.capacity
+        return numpy.concatenate((self.buffer[pos:], self.buffer[:pos]))
+
+    def __getitem__(self, item):
+        """
+        :param int item: Index of the sweep, 0 is the oldest in the buffer and -1 the latest
+        """
+        n = len(self)
+        if not -n <= item < n:
+            raise IndexError("Sweep index out of range")
+        return self.buffer[(self.count - n + item % n) % self.capacity]
+
+
+class ChannelTraceData(object):
+    """
+    Bulk trace data transfers for a VNA channel, shared by the ZNB and ZVA Channel classes.
+    The channel must have the attributes n, instrument, CALC and SENSe.
+    """
+
+    def _query_sweep_config(self):
+        """
+        Queue queries for the settings which determine the stimulus values, in the current pipeline.
+
+        :return: A list of SCPIDeferredResponses
+        """
+        return [self.SENSe.SWEep.TYPE().q_async(),
+                self.SENSe.SWEep.POINts().q_async(),
+                self.SENSe.FREQuency.STARt().q_async(),
+                self.SENSe.FREQuency.STOP().q_async()]
+
+    def _stimulus(self, sweep_config):
+        """
+        :param sweep_config: The responses from _query_sweep_config()
+        :return: The cached stimulus values if the sweep configuration is unchanged, otherwise CALCulate:DATA:STIMulus?
+        """
+        key = tuple(str(x) for x in sweep_config)
+        cache = self.instrument._stimulus_cache
+        cached = cache.get(self.n)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        stimulus = self.CALC.DATA.STIMulus().q().numpy_array()
+        stimulus.flags.writeable = False  # The array is shared by all callers
+        if key[0].upper().startswith(("LIN", "LOG")):  # Other sweep types depend on more settings than the key
+            cache[self.n] = (key, stimulus)
+        return stimulus
+
+    def stimulus(self):
+        """
+        The stimulus values of the sweep, CALCulate<Ch>:DATA:STIMulus?
+        For linear and logarithmic frequency sweeps the values are cached, and only transferred again
+        when the number of points or the frequency range changes.
+
+        :rtype: numpy.ndarray
+        """
+        with self.instrument.pipeline():
+            sweep_config = self._query_sweep_config()
+        return self._stimulus(sweep_config)
+
+    def iter_sweeps(self, count=None, fmt="SDATa", chunk_size=64):
+        """
+        Read the sweeps recorded for the active trace in the last single sweep group, oldest first,
+        with CALCulate<Ch>:DATA:NSWeep:FIRSt? The sweeps are transferred as binary data, the data format
+        is switched to REAL,64 during the transfer, and the previous format is restored afterwards.
+
+        The sweeps are read chunk_size at a time with pipelined queries, and decoded into a preallocated array
+        which is yielded after each chunk. The array is reused for the next chunk, so copy the data which is kept.
+
+        :param count: The number of sweeps to read, counted back from the latest. All available sweeps if None.
+        :param fmt: "SDATa" (default) for complex data, or "FDATa" for formatted data
+        :param chunk_size: The number of sweeps in each chunk
+        :return: A generator of 2-D arrays, chunk x points
+        """
+        inst = self.instrument
+        prev_format, block_dtype = inst.data_format, inst._block_dtype
+        with inst.pipeline():
+            available = self.CALC.DATA.NSWeep.COUNt().q_async()
+            points = self.SENSe.SWEep.POINts().q_async()
+            if block_dtype is None:
+                byte_order = inst.FORMat.BORDer().q_async()
+        available, points = int(available), int(points)
+        if block_dtype is not None:
+            byte_order = "SWAPped" if block_dtype.str[0] == "<" else "NORMal"
+        else:
+            byte_order = str(byte_order).strip()
+        count = available if count is None else min(count, available)
+        is_complex = not fmt.upper().startswith("FDAT")
+        chunk = numpy.empty((min(chunk_size, count), points), numpy.complex128 if is_complex else numpy.float64)
+
+        # Keep the byte order, so only FORMat:DATA changes. It's unchanged if REAL,64 is already selected.
+        switch_format = block_dtype is None or block_dtype.itemsize != 8
+        if switch_format:
+            inst.set_data_format(inst.DATA_FORMAT_REAL64, byte_order)
+        try:
+            first = self.CALC.DATA.NSWeep.FIRSt()
+            for start in xrange(available - count + 1, available + 1, chunk_size):
+                n = min(chunk_size, available + 1 - start)
+                with inst.pipeline():
+                    responses = [first.q_async(fmt, start + i) for i in xrange(n)]
+                for i, r in enumerate(responses):
+                    if is_complex:
+                        r.numpy_complex(out=chunk[i])
+                    else:
+                        r.numpy_array(out=chunk[i])
+                yield chunk[:n]
+        finally:
+            if switch_format:
+                inst.set_data_format(prev_format, byte_order)
+
+    def sweep_history(self, capacity=None, count=None, fmt="SDATa", chunk_size=64):
+        """
+        Read the sweeps recorded for the active trace into a SweepHistory ring buffer, see iter_sweeps().
+        Only the latest capacity sweeps are kept, so the memory use is bounded for any number of sweeps.
+
+        :param capacity: The size of the ring buffer, the number of sweeps read if None
+        :param count: The number of sweeps to read, all available sweeps if None
+        :return: The ring buffer, or None if no sweeps have been recorded
+        :rtype: SweepHistory
+        """
+        if count is None:
+            count = int(self.CALC.DATA.NSWeep.COUNt().q())
+        history = None
+        for chunk in self.iter_sweeps(count, fmt, chunk_size):
+            if history is None:
+                history = SweepHistory(capacity or count, chunk.shape[1], chunk.dtype)
+            history.extend(chunk)
+        return history
+
+    def fetch_all_traces(self, fmt="SDATa"):
+        """
+        Read the data of all S-parameter traces in the channel in one transfer, CALCulate<Ch>:DATA:CALL?
+        The trace catalogs and the sweep configuration are queried in the same message, so only one round trip
+        is needed unless the stimulus values have to be updated, see stimulus().
+        Traces measuring other quantities than S-parameters are not included in CALCulate<Ch>:DATA:CALL?.
+
+        :param fmt: "SDATa" (default) or "MDATa" for complex data, or "FDATa" for formatted data
+        :return: The stimulus values and a dict with the trace data, keyed by trace name. The rows of
+                 two-valued formatted data, like Smith charts, are returned as a 2-D array.
+        :rtype: (numpy.ndarray, dict of numpy.ndarray)
+        """
+        with self.instrument.pipeline():
+            params = self.CALC.DATA.CALL.CATalog().q_async()
+            traces = self.CALC.PARameter.CATalog().q_async()
+            sweep_config = self._query_sweep_config()
+            data = self.CALC.DATA.CALL().q_async(fmt)
+        stimulus = self._stimulus(sweep_config)
+
+        params = [x.strip() for x in str(params).split(",") if x.strip()]
+        if not params:
+            return stimulus, {}
+        if fmt.upper().startswith("FDAT"):
+            x = data.numpy_array().reshape(len(params), len(stimulus), -1)
+            x = x[:, :, 0] if x.shape[2] == 1 else x
+        else:
+            x = data.numpy_complex().reshape(len(params), len(stimulus))
+        rows = dict(zip([p.upper() for p in params], x))
+        traces = [t.strip() for t in str(traces).split(",")]  # 'Trc1,S21,Trc2,S11'
+        ret = {}
+        for name, param in zip(traces[::2], traces[1::2]):
+            row = rows.get(param.upper())
+            if row is not None:
+                ret[name] = row
+        return stimulus, ret
@@ -5,23 +5,75 @@ Created on 16 feb. 2016
 @author: Lukas Sandström
 """
 
-from gen import ZNB_gen, SCPIProperty, SCPIPropertyMinMax, SCPIPropertyMapping
-from RSSscpi.gen import SCPIBlockData
+from gen import ZNB_gen, AsyncInstrument, SCPIProperty, SCPIPropertyMinMax, SCPIPropertyMapping, quote_string
+from TraceData import ChannelTraceData
 
+from collections import namedtuple
 import ntpath
+import numpy
 import os.path
+import Queue
+import re
+import threading
 
 
 class ZNB(ZNB_gen):
+    STATE_CACHE_INVALIDATE = ZNB_gen.STATE_CACHE_INVALIDATE + (
+        "MMEMory:LOAD",  # Recall sets, calibrations, limit lines...
+        "MEMory:SELect", "MEMory:DEFine", "MEMory:CLOSe",  # Switching the active recall set
+        "CONFigure:TRACe:REName", "CALCulate:PARameter:DELete",  # The trace properties are keyed by the trace name
+        "CALCulate:FORMat", "CALCulate:PARameter:MEASure",  # Change the scale of the trace
+        "DISPlay:WINDow:STATe",  # Deleting a diagram renumbers the remaining ones
+        "SENSe:SEGMent",  # Renumbers the sweep segments, or changes the number of points of segmented sweeps
+        "SENSe:SWEep:STEP", "SENSe:SWEep:TYPE",  # Changes the number of points
+    )
+    STATE_CACHE_COUPLED = dict(ZNB_gen.STATE_CACHE_COUPLED, **{
+        "SENSe:SWEep:TIME": ("SENSe:SWEep:TIME:AUTO",),  # Setting the sweep time turns AUTO off
+        "DISPlay:WINDow:TRACe:Y:SCALe": ("DISPlay:WINDow:TRACe:Y:SCALe",),  # The scale settings depend on each other
+    })
+
+    TRACE_SELECTION_RESET = ("*RST", "*RCL", "SYSTem:PRESet", "MMEMory:LOAD:STATe", "MEMory",
+                             "CALCulate:PARameter", "CONFigure:TRACe:REName")
+    """
+    Commands after which the active trace of each channel is unknown, see select_trace()
+    """
+
     def __init__(self, visa_res):
         super(ZNB, self).__init__(visa_res)
         self.filesystem = Filesystem(self)
+        self._selected_traces = {}  # Channel number -> name of the active trace, as selected by the library
+        self._selection_reset = self._command_pattern(self.TRACE_SELECTION_RESET)
 
     def init(self):
         super(ZNB_gen, self).init()
         self.SYSTem.COMMunicate.GPIB.SELF.RTERminator().w("EOI")
         self.SYSTem.COMMunicate.CODec().w("UTF8")  # Set the character encoding
 
+    def write(self, cmd, *args, **kwargs):
+        super(ZNB, self).write(cmd, *args, **kwargs)
+        if self._selected_traces and self._selection_reset.match(cmd.build_cmd()):
+            self._selected_traces.clear()
+
+    def invalidate_state_cache(self):
+        super(ZNB, self).invalidate_state_cache()
+        self._selected_traces.clear()
+
+    def select_trace(self, channel, name, force=False):
+        """
+        Make a trace the active trace in its channel, CALCulate<Ch>:PARameter:SELect. The active trace of each
+        channel is tracked, and the command is only sent if the selection changes. Commands which may change
+        the selection, see TRACE_SELECTION_RESET, discard the tracked state, as do errors and reconnects.
+        Selections made from the front panel or by other sessions are not detected, use force=True.
+
+        :param int channel: The channel number
+        :param str name: The trace name
+        :param force: Send the command even if the trace is already active
+        """
+        if force or self._selected_traces.get(channel) != name:
+            # Bypass write() above, which would discard the tracked selection of all channels
+            super(ZNB, self).write(self.CALCulate(channel).PARameter.SELect(), name)
+            self._selected_traces[channel] = name
+
     def set_source_power_offset(self, channel=None, src=0, power=-300, relative=True):
         if relative:
             x = 'CPAD'
@@ -87,10 +139,19 @@ class ZNB(ZNB_gen):
         else:
             self.HCOPy.PAGE.WINDow().w("HARDcopy")
         self.HCOPy.IMMediate().w()  # Perform the screen capture
-        return self.filesystem.file(filename)
+        f = self.filesystem.file(filename)
+        self.filesystem.invalidate(f.path)
+        return f
 
 
-class Channel(object):
+class AsyncZNB(AsyncInstrument, ZNB):
+    """
+    A ZNB on a non-blocking transport, see AsyncInstrument and RSSscpi.AsyncSocketInterface.
+    """
+    pass
+
+
+class Channel(ChannelTraceData):
     def __init__(self, n, instrument):
         """
         :param n: Channel number
@@ -104,6 +165,7 @@ class Channel(object):
         self.SENSe = instrument.SENSe(n)
         self.SWEep = instrument.SENSe(n).SWEep
         self.CORRection = instrument.SENSe(n).CORRection
+        self.DISPlay = instrument.DISPlay
 
     name = SCPIProperty(ZNB.CONFigure.CHANnel.NAME, str, get_root_node=lambda self: self.CONFch)
     """
@@ -130,6 +192,7 @@ class Channel(object):
         :rtype: Trace
         """
         self.CALC.PARameter.SDEFine().w(name, parameter)
+        self.instrument._selected_traces[self.n] = name  # The new trace becomes the active trace
         trace = self.get_trace(name)
         if diagram is not None:
             trace.assign_diagram(diagram)
@@ -144,12 +207,13 @@ class Channel(object):
         """
         name = str(self.CALC.PARameter.SELect().q())
         # n = self.instrument.CONFigure.TRACe.CHANnel.NAME.ID.q(name)
+        self.instrument._selected_traces[self.n] = name
         return Trace(name, self)
 
     @active_trace.setter
     def active_trace(self, trace):
         name = trace.name if isinstance(trace, Trace) else str(trace)
-        self.CALC.PARameter.SELect().w(name)
+        self.instrument.select_trace(self.n, name, force=True)
 
     sweep_points = SCPIPropertyMinMax(ZNB.SENSe.SWEep.POINts, int, get_root_node=lambda self: self.SWEep)
     """
@@ -181,7 +245,9 @@ class Channel(object):
         """
         cmd_fmt = "{:d}, {:q}, {:s}, {:s}, {:d*}"
         self.instrument.MMEMory.STORe.TRACe.PORTs().w(self.n, filename, fmt, mode_impedance, ports, fmt=cmd_fmt)
-        return File(self.instrument, filename)
+        f = File(self.instrument, filename)
+        self.instrument.filesystem.invalidate(f.path)
+        return f
 
 
 class SweepSegment(ZNB.SENSe.SEGMent):
@@ -207,11 +273,18 @@ class SweepSegment(ZNB.SENSe.SEGMent):
     if_selectivity = SCPIProperty(_SEG.BWIDth.RESolution.SELect, str)
     number_of_points = SCPIProperty(_SEG.SWEep.POINts, int)
     power_level = SCPIProperty(_SEG.POWer, float)
-    sweep_time = SCPIProperty(_SEG.SWEep.TIME, float)
+    sweep_time = SCPIProperty(_SEG.SWEep.TIME, float, cached=False)  # Depends on the other segment settings
     sweep_mode = SCPIProperty(_SEG.SWEep.GENeration, str)  # FIXME: see Sweep
 
 
 class SweepSegments(object):
+    TABLE_DTYPE = numpy.dtype([("start", "f8"), ("stop", "f8"), ("points", "i4"), ("power", "f8"), ("ifbw", "f8"),
+                               ("time", "f8"), ("selectivity", "S8"), ("sweep_mode", "S8"), ("enabled", "?")])
+    """
+    The fields of a segment table, see load_table() and to_table(). Frequencies in Hz, power in dBm, times in seconds.
+    A time of NaN means that the segment sweep time is set automatically.
+    """
+
     def __init__(self, channel):
         """
         :param Channel channel: The channel which the sweep segments belong to
@@ -257,7 +330,74 @@ class SweepSegments(object):
         :return:
         """
         self._SEG(position+1).INSert().w(start_freq, stop_freq, points, power, time, "0", ifbw, lo_sideband, if_selectivity, sweep_mode)
-        return SweepSegment(position, self.channel)
+        return SweepSegment(position + 1, self.channel)
+
+    def load_table(self, table, append=False):
+        """
+        Replace the segment list with the rows of a structured array, see TABLE_DTYPE. All segments are inserted
+        in one batch, so the transfer takes a single round trip regardless of the number of segments.
+
+        The fields start, stop, points, power and ifbw are required. Missing time, selectivity and sweep_mode
+        fields select AUTO, NORMal and STEPped, and a missing enabled field enables all segments.
+        Per-segment sweep times are enabled if any segment has a time which isn't NaN. A NaN time inserts the
+        segment with AUTO, and the instrument selects the shortest sweep time for it.
+
+        :param numpy.ndarray table: The segment table, one row per segment
+        :param append: Add the segments after the existing ones, instead of replacing them
+        """
+        table = numpy.atleast_1d(table)
+        n = len(table)
+
+        def column(name, default):
+            if name in table.dtype.names:
+                return table[name].tolist()
+            return [default] * n
+
+        times = ["AUTO" if t != t else t for t in column("time", float("nan"))]
+        first = len(self) + 1 if append else 1
+        with self.channel.instrument.batch():
+            if not append:
+                self.remove_all_segments()
+            if any(t != "AUTO" for t in times):
+                self._SEG.SWEep.TIME.CONTrol().w(True)
+            for i, start, stop, points, power, time, ifbw, selectivity, sweep_mode, enabled in zip(
+                    xrange(first, first + n), table["start"].tolist(), table["stop"].tolist(),
+                    table["points"].tolist(), table["power"].tolist(), times, table["ifbw"].tolist(),
+                    column("selectivity", "NORM"), column("sweep_mode", "STEP"), column("enabled", True)):
+                seg = self._SEG(i)
+                seg.INSert().w(start, stop, points, power, time, "0", ifbw, "AUTO", selectivity, sweep_mode)
+                if not enabled:
+                    seg.STATe().w(False)
+
+    def to_table(self):
+        """
+        Read the segment list into a structured array, see TABLE_DTYPE. The settings of all segments are
+        queried in one pipeline. The times are NaN unless per-segment sweep times are enabled.
+
+        The instrument doesn't report which segments were inserted with an AUTO sweep time, so the round trip
+        through load_table() isn't exact for the times. With per-segment sweep times enabled, an AUTO segment
+        reads back with the time the instrument computed for it, which is fixed when the table is loaded again.
+        With them disabled every time reads back as NaN, also the times which were set explicitly.
+
+        :rtype: numpy.ndarray
+        """
+        n = len(self)
+        with self.channel.instrument.pipeline():
+            time_control = self._SEG.SWEep.TIME.CONTrol().q_async()
+            rows = []
+            for i in xrange(1, n + 1):
+                seg = self._SEG(i)
+                rows.append([seg.FREQuency.STARt().q_async(), seg.FREQuency.STOP().q_async(),
+                             seg.SWEep.POINts().q_async(), seg.POWer().q_async(), seg.BWIDth.RESolution().q_async(),
+                             seg.SWEep.TIME().q_async(), seg.BWIDth.RESolution.SELect().q_async(),
+                             seg.SWEep.GENeration().q_async(), seg.STATe().q_async()])
+        table = numpy.empty(n, self.TABLE_DTYPE)
+        for name, conv, values in zip(self.TABLE_DTYPE.names, (float, float, int, float, float, float, str, str, int),
+                                      zip(*rows) if rows else [()] * 9):
+            table[name] = [conv(str(x).strip()) for x in values]
+        if not int(time_control):
+            table["time"] = numpy.nan
+        return table
 
     def remove_segment(self, n):
         """
@@ -306,9 +446,9 @@ class Sweep(ZNB_gen.SENSe.SWEep):
     dwell_on_each_partial_measurement = SCPIPropertyMapping(_SWE.DWELl.IPOint, str, {"ALL": True, "FIRSt": False})
     number_of_points = SCPIPropertyMinMax(_SWE.POINts, int)
     sweep_count = SCPIProperty(_SWE.COUNt, int)  # FIXME: move to Channel?
-    sweep_time = SCPIPropertyMinMax(_SWE.TIME, float)
+    sweep_time = SCPIPropertyMinMax(_SWE.TIME, float, cached=False)  # Depends on the number of points etc.
     sweep_time_auto = SCPIPropertyMinMax(_SWE.TIME.AUTO, bool)
-    step_size = SCPIPropertyMinMax(_SWE.STEP, float)
+    step_size = SCPIPropertyMinMax(_SWE.STEP, float, cached=False)  # Depends on the frequency span and points
 
 
 class Trace(object):
@@ -324,7 +464,6 @@ class Trace(object):
         self._n = None
         self._name = str(name)
         self.channel = channel
-        self._cmd_cnt = None
 
     def _calc_node(self):
         return self.channel.CALC
@@ -336,13 +475,11 @@ class Trace(object):
         return self.channel.SWEep
 
     def _disp_node(self):
-        return self.channel.instrument.DISPlay
+        return self.channel.DISPlay
 
     # noinspection PyUnusedLocal
     def _make_active_cb(self, *args, **kwargs):
-        if self._cmd_cnt != self.channel.instrument.command_cnt:
-            self.select_trace()
-        self._cmd_cnt = self.channel.instrument.command_cnt + 1
+        self.select_trace()
 
     def copy_data_to_mem(self, trace_name):
         self.channel.instrument.TRACe.COPY().w(trace_name, self.name)
@@ -388,15 +525,15 @@ class Trace(object):
     # noinspection PyUnusedLocal
     def _add_trace_name_arg_cb(self, value=None, **kwargs):
         if value is not None:
-            return str(value) + ", '" + self.name + "'"
-        return "'" + self.name + "'"
+            return str(value) + ", " + quote_string(self.name)
+        return quote_string(self.name)
 
     _SCALE = ZNB.DISPlay.WINDow.TRACe.Y.SCALe
-    scale_per_div = SCPIProperty(_SCALE.PDIVision, float, callback=_add_trace_name_arg_cb, get_root_node=_disp_node)
-    scale_top = SCPIProperty(_SCALE.TOP, float, callback=_add_trace_name_arg_cb, get_root_node=_disp_node)
-    scale_bottom = SCPIProperty(_SCALE.BOTTom, float, callback=_add_trace_name_arg_cb, get_root_node=_disp_node)
-    ref_level = SCPIProperty(_SCALE.RLEVel, float, callback=_add_trace_name_arg_cb, get_root_node=_disp_node)
-    ref_pos = SCPIProperty(_SCALE.RPOSition, float, callback=_add_trace_name_arg_cb, get_root_node=_disp_node)
+    scale_per_div = SCPIProperty(_SCALE.PDIVision, float, callback=_add_trace_name_arg_cb, get_root_node=_disp_node, cached=True)
+    scale_top = SCPIProperty(_SCALE.TOP, float, callback=_add_trace_name_arg_cb, get_root_node=_disp_node, cached=True)
+    scale_bottom = SCPIProperty(_SCALE.BOTTom, float, callback=_add_trace_name_arg_cb, get_root_node=_disp_node, cached=True)
+    ref_level = SCPIProperty(_SCALE.RLEVel, float, callback=_add_trace_name_arg_cb, get_root_node=_disp_node, cached=True)
+    ref_pos = SCPIProperty(_SCALE.RPOSition, float, callback=_add_trace_name_arg_cb, get_root_node=_disp_node, cached=True)
 
     cal_state_label = SCPIProperty(ZNB.SENSe.CORRection.SSTate, str, callback=_make_active_cb, get_root_node=_corr_node)  # FIXME: read-only -> method
     source_port = SCPIProperty(ZNB.SENSe.SWEep.SRCPort, int, callback=_make_active_cb, get_root_node=_sweep_node)  # Logical port number of the simulus port
@@ -408,11 +545,41 @@ class Trace(object):
     def is_active(self):
         return self.channel.active_trace.name == self.name
 
-    def select_trace(self):
+    def select_trace(self, force=False):
+        """
+        Makes the trace the active trace in the channel, if it isn't already. See ZNB.select_trace().
+
+        :param force: Send the command even if the trace is already active
         """
-        Makes the trace the active trace in the channel.
+        self.channel.instrument.select_trace(self.channel.n, self.name, force)
+
+    def fetch_data(self, fmt="SDATa"):
+        """
+        Read the trace data, CALCulate<Ch>:DATA:TRACe?. The trace is addressed by name, so it isn't made active.
+
+        :param fmt: "SDATa" (default) for complex data, or "FDATa" for formatted data
+        :rtype: numpy.ndarray
+        """
+        data = self.channel.CALC.DATA.TRACe().q(self.name, fmt, fmt="{:q}, {:s}")
+        return data.numpy_array() if fmt.upper().startswith("FDAT") else data.numpy_complex()
+
+    def iter_sweeps(self, count=None, fmt="SDATa", chunk_size=64):
+        """
+        Make the trace active, and read its sweeps from the last single sweep group. See Channel.iter_sweeps().
+
+        :return: A generator of 2-D arrays, chunk x points
+        """
+        self.select_trace()
+        return self.channel.iter_sweeps(count, fmt, chunk_size)
+
+    def sweep_history(self, capacity=None, count=None, fmt="SDATa", chunk_size=64):
         """
-        self.channel.CALC.PARameter.SELect().w(self.name)
+        Make the trace active, and read its sweeps into a ring buffer. See Channel.sweep_history().
+
+        :rtype: RSSscpi.TraceData.SweepHistory
+        """
+        self.select_trace()
+        return self.channel.sweep_history(capacity, count, fmt, chunk_size)
 
     def get_marker(self, n):
         """
@@ -422,6 +589,15 @@ class Trace(object):
         """
         return Marker(n, self)
 
+    @property
+    def markers(self):
+        """
+        The markers of the trace, for reading and positioning several markers at once.
+
+        :rtype: TraceMarkers
+        """
+        return TraceMarkers(self)
+
     def assign_diagram(self, diagram):
         """
         Assigns the trace to a diagram.
@@ -447,13 +623,10 @@ class Marker(ZNB.CALCulate.MARKer):
         super(Marker, self).__init__(parent=trace.channel.CALC)
         self.n = n
         self.trace = trace
-        self._cmd_cnt = None
 
     # noinspection PyUnusedLocal
     def _prop_callback(self, *args, **kwargs):
-        if not self._cmd_cnt or self._cmd_cnt != self.trace.channel.instrument.command_cnt:
-            self.trace.select_trace()
-        self._cmd_cnt = self.trace.channel.instrument.command_cnt + 1
+        self.trace.select_trace()
 
     _MKR = ZNB.CALCulate.MARKer
     tracking = SCPIProperty(_MKR.SEARch.TRACking, bool, callback=_prop_callback)  #: Marker tracking enabled
@@ -465,6 +638,161 @@ class Marker(ZNB.CALCulate.MARKer):
     y = SCPIProperty(_MKR.Y, float, callback=_prop_callback)  # FIXME: query only -> query_y() method
 
 
+class MarkerValues(object):
+    """
+    The pending marker readout returned by TraceMarkers.query_async()
+    """
+    def __init__(self, x, y):
+        """
+        :param x: The SCPIDeferredResponses of the marker positions
+        :param y: The SCPIDeferredResponses of the marker values
+        """
+        self._x = x
+        self._y = y
+
+    def result(self):
+        """
+        :return: The marker positions and values. The values are a 2-D array, markers x 2, for two-valued
+                 trace formats like Smith charts.
+        :rtype: (numpy.ndarray, numpy.ndarray)
+        """
+        if not self._x:
+            return numpy.empty(0), numpy.empty(0)
+        x = numpy.array([float(r) for r in self._x])
+        y = numpy.array([[float(v) for v in str(r).split(",")] for r in self._y]).reshape(len(self._y), -1)
+        return x, y[:, 0] if y.shape[1] == 1 else y
+
+
+class TraceMarkers(object):
+    """
+    The markers of a trace, as a group. The commands for all markers are sent in one batch after selecting the
+    trace, instead of the round trip per marker and property of Marker. To read the markers of several traces
+    in one round trip, queue the queries in an outer pipeline:
+
+    with znb.pipeline():
+        pending = [t.markers.query_async([1, 2, 3]) for t in traces]
+    values = [p.result() for p in pending]
+
+    The traces are selected in the order they are queued, so group the queries by trace.
+    """
+    MAX_MARKERS = 10
+
+    def __init__(self, trace):
+        """
+        :param Trace trace: The trace which the markers belong to
+        """
+        self.trace = trace
+        self.instrument = trace.channel.instrument
+        self._MKR = trace.channel.CALC.MARKer
+
+    def __getitem__(self, n):
+        """
+        :param int n: Marker number
+        :rtype: Marker
+        """
+        return Marker(n, self.trace)
+
+    def place(self, x, numbers=None):
+        """
+        Enable markers and move them to the stimulus values x, in one batch.
+
+        :param x: The marker positions, a sequence or array
+        :param numbers: The marker numbers, 1 to len(x) if None
+        """
+        x = numpy.atleast_1d(x).tolist()
+        numbers = range(1, len(x) + 1) if numbers is None else list(numbers)
+        if len(numbers) != len(x):
+            raise ValueError("The number of marker numbers and positions differ")
+        with self.instrument.batch():
+            self.trace.select_trace()
+            for n, pos in zip(numbers, x):
+                mkr = self._MKR(n)
+                mkr.STATe().w(True)
+                mkr.X().w(pos)
+
+    def enabled(self):
+        """
+        :return: The numbers of the enabled markers, among 1 to MAX_MARKERS
+        :rtype: list of int
+        """
+        with self.instrument.pipeline():
+            self.trace.select_trace()
+            states = [self._MKR(n).STATe().q_async() for n in xrange(1, self.MAX_MARKERS + 1)]
+        return [n for n, state in enumerate(states, 1) if int(state)]
+
+    def query_async(self, numbers):
+        """
+        Queue the queries for the positions and values of the markers in the current pipeline, after
+        selecting the trace.
+
+        :param numbers: The marker numbers, the markers must be enabled
+        :rtype: MarkerValues
+        """
+        self.trace.select_trace()
+        mkrs = [self._MKR(n) for n in numbers]
+        return MarkerValues([m.X().q_async() for m in mkrs], [m.Y().q_async() for m in mkrs])
+
+    def read(self, numbers=None):
+        """
+        Read the positions and values of the markers in one round trip, see MarkerValues.result().
+
+        :param numbers: The marker numbers, all enabled markers if None. Finding the enabled markers takes
+                        an additional round trip.
+        :rtype: (numpy.ndarray, numpy.ndarray)
+        """
+        if numbers is None:
+            numbers = self.enabled()
+        if not numbers:
+            return numpy.empty(0), numpy.empty(0)
+        with self.instrument.pipeline():
+            values = self.query_async(numbers)
+        return values.result()
+
+    def disable_all(self):
+        """
+        Remove all markers of the trace, CALCulate<Ch>:MARKer:AOFF
+        """
+        with self.instrument.batch():
+            self.trace.select_trace()
+            self._MKR.AOFF().w()
+
+    def interpolate(self, x, data=None, stimulus=None):
+        """
+        Compute marker values client side, by linear interpolation in the formatted trace data. This gives the
+        same values as markers in the default continuous marker mode, without any marker commands, so the
+        values at many positions or for many sweeps can be computed from data which has already been fetched.
+
+        :param x: The marker positions
+        :param data: The formatted trace data, read with Trace.fetch_data("FDATa") if None. A 2-D array,
+                     sweeps x points, gives the values for each sweep.
+        :param stimulus: The stimulus values, read with Channel.stimulus() if None
+        :return: The values, with the shape of x for each sweep. Two-valued formats add a last axis of length 2.
+        :rtype: numpy.ndarray
+        """
+        if stimulus is None:
+            stimulus = self.trace.channel.stimulus()
+        if data is None:
+            data = self.trace.fetch_data("FDATa")
+        data = numpy.asarray(data)
+        x = numpy.asarray(x, numpy.float64)
+        if data.shape[-1] == 2 * len(stimulus):  # Two-valued format, interleaved
+            data = data.reshape(data.shape[:-1] + (len(stimulus), 2))
+            return numpy.stack([self._interp(x, stimulus, data[..., i]) for i in (0, 1)], -1)
+        return self._interp(x, stimulus, data)
+
+    @staticmethod
+    def _interp(x, stimulus, data):
+        """
+        numpy.interp() on the last axis of data
+        """
+        if data.ndim == 1:
+            return numpy.interp(x, stimulus, data)
+        # Locate x once, and interpolate all rows with the same weights
+        i = numpy.clip(numpy.searchsorted(stimulus, x) - 1, 0, len(stimulus) - 2)
+        w = numpy.clip((x - stimulus[i]) / (stimulus[i + 1] - stimulus[i]), 0.0, 1.0)
+        return data[..., i] * (1 - w) + data[..., i + 1] * w
+
+
 class Diagram(ZNB_gen.DISPlay.WINDow):
     def __init__(self, n, instrument):
         """
@@ -531,21 +859,66 @@ class Diagram(ZNB_gen.DISPlay.WINDow):
 
 
 class Filesystem(ZNB_gen.MMEMory):
+    """
+    The file system of the instrument. The working directory and the directory listings are cached until
+    they are changed through this class, File, or the methods which store files, like ZNB.save_screenshot().
+    Changes made with MMEMory commands written directly, by other sessions, or from the front panel, are not
+    detected, use invalidate() or refresh=True.
+    """
     def __init__(self, instrument):
         super(Filesystem, self).__init__(parent=instrument)
+        self._cwd = None
+        self._catalog_cache = {}  # Directory listings keyed by the normalized path, see Directory.scandir()
 
     def getcwd(self):
         """
         :return: a string representing the current working directory on the instrument.
         :rtype: str
         """
-        return str(self.CDIRectory().q())
+        cwd = self._cwd
+        if cwd is None:
+            cwd = self._cwd = str(self.CDIRectory().q())
+        return cwd
+
+    def invalidate(self, path=None):
+        """
+        Discard cached directory listings.
+
+        :param path: The directory to discard, or None for all directories and the working directory
+        """
+        if path is None:
+            self._cwd = None
+            self._catalog_cache.clear()
+        else:
+            self._catalog_cache.pop(self._cache_key(path), None)
+
+    def _invalidate_target(self, target):
+        """
+        Discard the listings which a file operation with the destination target may have changed.
+        """
+        target = ntpath.join(self.getcwd(), str(target))
+        self.invalidate(target)  # The target may be a directory which the file is copied into
+        self.invalidate(ntpath.dirname(target))
+
+    @staticmethod
+    def _cache_key(path):
+        return ntpath.normcase(ntpath.normpath(path))
 
     def chdir(self, path):
         """
         Change the current working directory on the instrument to path.
         """
         self.CDIRectory.w(path)
+        self._cwd = None
+
+    def mkdir(self, path):
+        """
+        Create a directory on the instrument, MMEMory:MDIRectory
+
+        :param path: The new directory, absolute or relative to the working directory
+        """
+        self.MDIRectory().w(path)
+        self._invalidate_target(path)
 
     def file(self, filename, path=None):
         """
@@ -565,6 +938,25 @@ class Filesystem(ZNB_gen.MMEMory):
             path = self.getcwd()
         return Directory(path=path, instrument=self._parent).listdir()
 
+    def walk(self, path=None):
+        """
+        Traverse the directory tree from path, the working directory if None, see Directory.walk().
+        """
+        if path is None:
+            path = self.getcwd()
+        return Directory(path=path, instrument=self._parent).walk()
+
+
+CatalogEntry = namedtuple("CatalogEntry", "name size is_dir")
+"""
+An entry in a directory listing, see Directory.scandir(). The size of directories is None.
+"""
+
+_catalog_header = re.compile(r"\s*(\d+)\s*,\s*(\d+)\s*(?:,|$)")
+# <name>, <DIR> or empty, <size>. We can't split on comma alone, since a comma might be contained in a
+# filename, so the name is matched up to the first pair of fields which are valid as a type and a size.
+_catalog_entry = re.compile(r"\s*(.*?)\s*,\s*(<DIR>)?\s*,\s*(\d*)\s*(?:,|$)")
+
 
 class Path(object):
     def __init__(self, path, filename):
@@ -589,19 +981,133 @@ class Directory(Path):
     def file(self, filename):
         return File(filename=filename, instrument=self.instrument, path=self.path)
 
-    def listdir(self):
-        def mk_list(match):
-            if match.group(2) == "<DIR>":
-                return Directory(path=match.group(1), instrument=self.instrument)
+    @staticmethod
+    def parse_catalog(catalog):
+        """
+        Parse a MMEMory:CATalog? response in a single pass.
+
+        :param str catalog: '<used>, <free>, <name>, <DIR> or empty, <size>, ...'
+        :return: The entries, without "." and ".."
+        :rtype: list of CatalogEntry
+        """
+        header = _catalog_header.match(catalog)
+        if header is None:
+            raise ValueError("Invalid catalog: %r" % catalog[:40])
+        ret = []
+        for m in _catalog_entry.finditer(catalog, header.end()):
+            name, is_dir, size = m.groups()
+            if is_dir:
+                if name not in (".", ".."):
+                    ret.append(CatalogEntry(name, None, True))
             else:
-                return File(filename=match.group(1), path=self.path, instrument=self.instrument)
+                ret.append(CatalogEntry(name, int(size) if size else 0, False))
+        return ret
+
+    def scandir(self, refresh=False):
+        """
+        The directory contents from MMEMory:CATalog?, cached until the file system is changed,
+        see Filesystem.invalidate().
 
-        import re
-        x = self.instrument.MMEMory.CATalog.q(self.path)
-        used_size, free_disk, files = str(x).split(", ", 2)
-        # We can't split files on comma alone, since a comma might be contained in a filename
-        r = re.finditer('(.*?), (?:(<DIR>), |, (\d+)),', files)
-        return map(mk_list, r)
+        :param refresh: Query the instrument even if the listing is cached
+        :rtype: list of CatalogEntry
+        """
+        filesystem = self.instrument.filesystem
+        key = filesystem._cache_key(self.path)
+        entries = None if refresh else filesystem._catalog_cache.get(key)
+        if entries is None:
+            entries = self.parse_catalog(str(self.instrument.MMEMory.CATalog.q(self.path)))
+            filesystem._catalog_cache[key] = entries
+        return entries
+
+    def listdir(self, refresh=False):
+        """
+        :param refresh: Query the instrument even if the listing is cached, see scandir()
+        :return: The files and subdirectories
+        :rtype: list of File and Directory
+        """
+        ret = []
+        for name, size, is_dir in self.scandir(refresh):
+            if is_dir:
+                ret.append(Directory(path=ntpath.join(self.path, name), instrument=self.instrument))
+            else:
+                ret.append(File(filename=name, path=self.path, instrument=self.instrument))
+        return ret
+
+    def walk(self, refresh=False):
+        """
+        Traverse the directory tree top-down, like os.walk().
+
+        :param refresh: Query the instrument even if the listings are cached, see scandir()
+        :return: A generator of (path, directory names, file entries) for each directory.
+                 Directories removed from the list of names are not visited.
+        :rtype: generator of (str, list of str, list of CatalogEntry)
+        """
+        entries = self.scandir(refresh)
+        dirs = [e.name for e in entries if e.is_dir]
+        yield self.path, dirs, [e for e in entries if not e.is_dir]
+        for name in dirs:
+            for x in Directory(path=ntpath.join(self.path, name), instrument=self.instrument).walk(refresh):
+                yield x
+
+    def download_all(self, local_dir, sessions=4, callback=None):
+        """
+        Retrieve all files in the directory, not including subdirectories, with File.get().
+        The files are transferred in parallel over several sessions to the instrument, opened with
+        new_session() on the transport. With transports which can't open new sessions the files are
+        transferred one at a time.
+
+        :param local_dir: The target directory on the controller
+        :param sessions: The number of parallel sessions
+        :param callback: Progress callback, called as callback(filename, transferred, total) from the worker threads
+        :return: The paths of the retrieved files
+        :rtype: list of str
+        """
+        files = [e for e in self.scandir() if not e.is_dir]
+        targets = [os.path.join(local_dir, e.name) for e in files]
+        new_session = getattr(self.instrument._visa_res, "new_session", None)
+        if new_session is None or sessions < 2 or len(files) < 2:
+            for entry, target in zip(files, targets):
+                self._download(self.instrument, entry, target, callback)
+            return targets
+
+        todo = Queue.Queue()
+        for x in zip(files, targets):
+            todo.put(x)
+        errors = []
+
+        def worker():
+            try:
+                visa_res = new_session()
+            except BaseException, e:
+                errors.append(e)
+                return
+            try:
+                instrument = type(self.instrument)(visa_res)
+                while not errors:
+                    try:
+                        entry, target = todo.get(block=False)
+                    except Queue.Empty:
+                        return
+                    self._download(instrument, entry, target, callback)
+            except BaseException, e:
+                errors.append(e)
+            finally:
+                visa_res.close()
+
+        threads = [threading.Thread(target=worker, name="download_all") for _ in xrange(min(sessions, len(files)))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0]
+        return targets
+
+    def _download(self, instrument, entry, target, callback):
+        f = File(filename=entry.name, path=self.path, instrument=instrument)
+        f.get(target, callback=None if callback is None else lambda transferred, total: callback(entry.name, transferred, total),
+              expected_size=entry.size)  # The size from the catalog, instead of reading it again for each file
 
     @staticmethod
     def isdir():
@@ -642,31 +1148,114 @@ class File(Path):
         return ntpath.join(self.path, self.filename)
 
     def read(self):
+        """
+        Read the file contents, MMEMory:DATA?
+
+        :return: The file contents
+        :rtype: str
+        """
+        data = self.read_buffer()
+        return data.tobytes() if isinstance(data, memoryview) else str(data)
+
+    def read_buffer(self):
+        """
+        Read the file contents, MMEMory:DATA?, without copying them. Transports which read block data into
+        a preallocated buffer, like SocketInterface, return a memoryview of the buffer, other transports a str.
+
+        :rtype: memoryview or str
+        """
         return self.instrument.MMEMory.DATA().q(self.full_path).block_data()
 
     def write(self, data):
-        self.instrument.MMEMory.DATA().w(self.full_path, SCPIBlockData(data))
+        """
+        Write the file contents, MMEMory:DATA. The data is sent without copying it into the command string,
+        see Instrument.write_block().
 
-    def get(self, local_target):
+        :type data: str or bytearray or memoryview
         """
-        Retrieve a file from the VNA.
+        self.instrument.write_block(self.instrument.MMEMory.DATA(), data, self.full_path)
+        self.instrument.filesystem.invalidate(self.path)
+
+    def size(self):
+        """
+        :return: The file size in bytes according to MMEMory:CATalog?, or None if the file doesn't exist
+        :rtype: int
+        """
+        name = ntpath.normcase(self.filename)
+        for entry in Directory(path=self.path, instrument=self.instrument).scandir(refresh=True):
+            if not entry.is_dir and ntpath.normcase(entry.name) == name:
+                return entry.size
+        return None
+
+    def get(self, local_target, callback=None, chunk_size=1 << 20, verify=True, expected_size=None):
+        """
+        Retrieve a file from the VNA. The file is streamed to disk through a buffer of chunk_size bytes,
+        see Instrument.query_block().
 
         :param local_target: The target file on the controller. If local_target is a directory the file will be stored with the same name as on the instrument.
+        :param callback: Progress callback, called as callback(transferred, total) after each chunk
+        :param chunk_size: The buffer size in bytes
+        :param verify: Check the number of bytes received against the size in MMEMory:CATalog?
+        :param expected_size: The file size, if it is already known from Directory.scandir(). The catalog
+                              isn't queried then.
+        :raises IOError: if the file doesn't exist or the size doesn't match
         """
         if os.path.isdir(local_target):
             local_target = os.path.join(local_target, self.filename)
+        total = expected_size
+        if total is None and (verify or callback):
+            total = self.size()
+        if verify and total is None:
+            raise IOError("File not found on the instrument: %s" % self)
+        transferred = [0]
+
         with open(local_target, "wb") as fd:
-            fd.write(self.read())
+            def write(chunk):
+                fd.write(chunk)
+                transferred[0] += len(chunk)
+                if callback:
+                    callback(transferred[0], total)
 
-    def put(self, local_file):
+            length = self.instrument.query_block(self.instrument.MMEMory.DATA(), write, self.full_path,
+                                                 chunk_size=chunk_size)
+        if verify and length != total:
+            raise IOError("Size mismatch for %s: received %d bytes, the catalog says %s" % (self, length, total))
+
+    def put(self, local_file, callback=None, chunk_size=1 << 20, verify=True):
         """
-        Copy a file from the controller to the instrument.
+        Copy a file from the controller to the instrument. The file is streamed from disk through a buffer of
+        chunk_size bytes, see Instrument.write_block_stream().
 
-        :param local_file:
-        :return:
+        :param local_file: The file on the controller
+        :param callback: Progress callback, called as callback(transferred, total) after each chunk
+        :param chunk_size: The buffer size in bytes
+        :param verify: Check the size in MMEMory:CATalog? against the size of local_file afterwards
+        :raises IOError: if the size doesn't match
         """
         with open(local_file, "rb") as fd:
-            self.write(fd.read())
+            total = os.fstat(fd.fileno()).st_size
+
+            def chunks():
+                buf = bytearray(min(chunk_size, total) or 1)
+                view = memoryview(buf)
+                transferred = 0
+                while transferred < total:
+                    n = fd.readinto(buf) if total - transferred >= len(buf) else fd.readinto(view[:total - transferred])
+                    if not n:
+                        raise IOError("%s was truncated during the transfer" % local_file)
+                    yield view[:n]
+                    transferred += n
+                    if callback:
+                        callback(transferred, total)
+
+            try:
+                self.instrument.write_block_stream(self.instrument.MMEMory.DATA(), chunks(), total, self.full_path)
+            finally:
+                self.instrument.filesystem.invalidate(self.path)
+        if verify:
+            size = self.size()
+            if size != total:
+                raise IOError("Size mismatch for %s: sent %d bytes, the catalog says %s" % (self, total, size))
 
     def copy(self, target):
         """
@@ -675,3 +1264,21 @@ class File(Path):
         :param target: The location of the copy
         """
         self.instrument.MMEMory.COPY().w(self.full_path, str(target))
+        self.instrument.filesystem._invalidate_target(target)
+
+    def move(self, target):
+        """
+        Move or rename the file on the instrument, MMEMory:MOVE
+
+        :param target: The new location
+        """
+        self.instrument.MMEMory.MOVE().w(self.full_path, str(target))
+        self.instrument.filesystem.invalidate(self.path)
+        self.instrument.filesystem._invalidate_target(target)
+
+    def delete(self):
+        """
+        Delete the file on the instrument, MMEMory:DELete
+        """
+        self.instrument.MMEMory.DELete().w(self.full_path)
+        self.instrument.filesystem.invalidate(self.path)
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: Lukas Sandström
+"""
+
+from gen import ZVA_gen
+from TraceData import ChannelTraceData
+
+
+class ZVA(ZVA_gen):
+    def get_channel(self, n):
+        """
+
+        :param n: Channel number
+        :rtype: Channel
+        """
+        return Channel(n, self)
+
+
+class Channel(ChannelTraceData):
+    def __init__(self, n, instrument):
+        """
+        :param n: Channel number
+        :param instrument: A SCPINode instance, linked to the instrument
+        :type instrument: ZVA
+        """
+        self.n = n
+        self.instrument = instrument
+        self.CALC = instrument.CALCulate(n)
+        self.SENSe = instrument.SENSe(n)
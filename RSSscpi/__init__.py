@@ -1,4 +1,10 @@
 # -*- coding: utf-8 -*-
 
-from ZNB import ZNB
+from ZNB import ZNB, AsyncZNB
+from ZVA import ZVA
 from SocketInterface import SocketInterface
+from HiSLIPInterface import HiSLIPInterface
+from ConnectionPool import ConnectionPool, get_session, get_instrument
+from AsyncSocketInterface import AsyncSocketInterface, SCPIEventLoop
+from Acquisition import Acquisition
+from LimitMask import LimitMask, LimitResult
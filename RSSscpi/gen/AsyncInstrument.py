@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: Lukas Sandström
+"""
+
+from Instrument import Instrument
+from SCPI_response import SCPIResponse, SCPIDeferredResponse
+
+
+class _CombinedResponse(object):
+    """
+    Receives the response to a combined message, and distributes the parts to the individual queries.
+    """
+    def __init__(self, instrument, responses):
+        self._instrument = instrument
+        self._responses = responses
+
+    def set_result(self, raw):
+        parts = SCPIResponse.split_combined(raw)
+        if len(parts) != len(self._responses):
+            self._instrument.error_queue.put_nowait(self._instrument.Error(
+                -1, "Expected %d responses to pipelined queries, got %d" % (len(self._responses), len(parts))))
+            return
+        for r, x in zip(self._responses, parts):
+            r.set_result(x)
+
+
+class AsyncInstrument(Instrument):
+    """
+    An Instrument for non-blocking transports, like AsyncSocketInterface. Queries queued with SCPIQuery.q_async()
+    are sent immediately and return a SCPIDeferredResponse, which is filled in by the event loop of the transport.
+    Many instruments can thereby be kept busy from a single thread. Blocking queries, q(), run the event loop
+    until their response arrives, so the rest of the Instrument API works unchanged.
+
+    Combine with an instrument class to use the generated command tree, see RSSscpi.ZNB.AsyncZNB.
+    """
+
+    def query_async(self, cmd, *args, **kwargs):
+        """
+        Send a SCPI query without waiting for the response.
+
+        :param cmd: The SCPI command
+        :type cmd: SCPINodeBase
+        :param args: A list of arguments for the command, see query()
+        :rtype: SCPIDeferredResponse
+        """
+        x = cmd.build_cmd() + "? " + self._build_arg_str(cmd, args, kwargs)
+        response = SCPIDeferredResponse(self, self._block_dtype)
+        with self._visa_lock:
+            if self._batch_depth:
+                self._batch_cmd(x, response)
+            else:
+                self._flush_batch()
+                self._call_visa(lambda msg: self._visa_res.send(msg, response), x)
+        return response
+
+    def _flush_batch(self):
+        if not self._batch:
+            return
+        responses = [r for _, r in self._batch if r is not None]
+        if not responses:
+            return super(AsyncInstrument, self)._flush_batch()
+        cmds, self._batch, self._batch_len = self._batch, [], 0
+        msg = cmds[0][0] + "".join((";" if c[0] == "*" else ";:") + c for c, _ in cmds[1:])
+        combined = _CombinedResponse(self, responses)
+        self._call_visa(lambda m: self._visa_res.send(m, combined), msg, record=False)
+
+    def flush(self):
+        """
+        Send any buffered commands, and run the event loop until all outstanding responses have been received.
+        """
+        super(AsyncInstrument, self).flush()
+        self._visa_res.wait_idle()
@@ -5,20 +5,28 @@
 """
 
 from SCPI_gen_support import SCPINodeBase
-from SCPI_response import SCPIResponse
+from SCPI_response import SCPIResponse, SCPIDeferredResponse, SCPIBlockData, quote_string
 
 import visa
+import numpy
 
 from time import ctime
 import timeit, time
 import threading, traceback
+import weakref
+import socket
+import sys, linecache
 
+from contextlib import contextmanager
 import Queue  # Use Queue.Queue, not multiprocessing.Queue, to avoid unnecessary pickling
 from collections import OrderedDict
 import itertools
 import re, string
 
 
+_package_prefix = __name__.split(".")[0] + "."  # Used to identify stack frames inside the package
+
+
 class LimitedCapacityDict(OrderedDict):
     def __init__(self, max_len=None):
         self._max_len = max_len
@@ -75,12 +83,107 @@ class SCPICmdFormatter(string.Formatter):
             return ", ".join(map(lambda x: self.format_field(x, format_spec[:-1]), value))
         elif format_spec[-1] == "q":  # code for single quoted string
             format_spec = format_spec[:-1] + "s"
-            return "'" + self.format_field(value, format_spec) + "'"
+            return quote_string(self.format_field(value, format_spec))
         elif format_spec[-1] == "s":  # coerce everything with str() for convenience
             value = str(value)
 
         return super(SCPICmdFormatter, self).format_field(value, format_spec)
 
+    _compiled = {}  # Compiled format strings, see compile()
+    _compiled_specs = {}
+    _field_name = re.compile(r"(?:\d+|[A-Za-z_]\w*)$")
+
+    @classmethod
+    def compile(cls, format_string):
+        """
+        Compile a format string into a function f(args, kwargs), which returns the same string as
+        SCPICmdFormatter().vformat(format_string, args, kwargs). The format string is only parsed once,
+        the compiled functions are cached.
+
+        :rtype: function
+        """
+        func = cls._compiled.get(format_string)
+        if func is None:
+            func = cls._compiled[format_string] = cls._compile(format_string)
+        return func
+
+    @classmethod
+    def _compile(cls, format_string):
+        parts = []  # (literal text, argument index or keyword, conversion, field formatter)
+        last_number = 0
+        for literal, name, spec, conversion in string.Formatter().parse(format_string):
+            if name is None:
+                parts.append((literal, None, None, None))
+                continue
+            if name and not cls._field_name.match(name) or "{" in spec:
+                # Attribute and index lookups, and nested fields, are left to the formatter
+                return lambda args, kwargs: cls().vformat(format_string, args, kwargs)
+            if name == "":
+                key = last_number
+                last_number += 1
+            else:
+                key = int(name) if name.isdigit() else name
+            parts.append((literal, key, conversion, cls._compile_spec(spec)))
+
+        if len(parts) == 1 and not parts[0][0] and type(parts[0][1]) is int and not parts[0][2]:
+            key, field = parts[0][1], parts[0][3]
+            return lambda args, kwargs: field(args[key])  # A single field, like "{:s*}"
+
+        def vformat(args, kwargs):
+            ret = []
+            for literal, key, conversion, field in parts:
+                ret.append(literal)
+                if field is not None:
+                    value = args[key] if type(key) is int else kwargs[key]
+                    if conversion == "r":
+                        value = repr(value)
+                    elif conversion == "s":
+                        value = str(value)
+                    ret.append(field(value))
+            return "".join(ret)
+        return vformat
+
+    @classmethod
+    def _compile_spec(cls, format_spec):
+        """
+        :return: A function formatting a single value like format_field()
+        """
+        func = cls._compiled_specs.get(format_spec)
+        if func is None:
+            func = cls._compiled_specs[format_spec] = cls._compile_spec_r(format_spec)
+        return func
+
+    @classmethod
+    def _compile_spec_r(cls, format_spec):
+        if not format_spec:
+            return lambda value: format(value, "")
+        elif format_spec[-1] == "*":  # list unpack
+            item_spec = format_spec[:-1]
+            item = cls._compile_spec(item_spec)
+            if item_spec not in ("", "s", "d"):
+                return lambda value: ", ".join(map(item, value))
+
+            def unpack(value):
+                if isinstance(value, numpy.ndarray) and value.ndim == 1:
+                    # Convert numeric arrays to Python numbers in one call, instead of formatting numpy scalars.
+                    # repr() of a Python float is the same as str() of a numpy float64, which is what "s" gives.
+                    # format(numpy.float64, "") rounds to 12 digits like str() of a float, so "" keeps the slow path.
+                    kind = value.dtype.kind
+                    if kind in "iu" or kind == "b" and item_spec != "d":
+                        return ", ".join(map(str, value.tolist()))
+                    elif value.dtype == numpy.float64 and item_spec == "s":
+                        return ", ".join(map(repr, value.tolist()))
+                return ", ".join(map(item, value))
+            return unpack
+        elif format_spec[-1] == "q":  # single quoted string
+            item = cls._compile_spec(format_spec[:-1] + "s")
+            return lambda value: quote_string(item(value))
+        elif format_spec == "s":
+            return str
+        elif format_spec[-1] == "s":  # coerce everything with str() for convenience
+            return lambda value: format(str(value), format_spec)
+        return lambda value: format(value, format_spec)
+
 
 # http://stackoverflow.com/questions/16244923/how-to-make-a-custom-exception-class-with-multiple-init-args-pickleable
 # http://bugs.python.org/issue1692335
@@ -101,6 +204,28 @@ class InstrumentError(BaseException):
 class Instrument(SCPINodeBase):
     _cmd = ""
 
+    DATA_FORMAT_ASCII = "ASCii"
+    DATA_FORMAT_REAL32 = "REAL,32"
+    DATA_FORMAT_REAL64 = "REAL,64"
+
+    ERROR_ATTRIBUTION_OFF = "off"  # Don't record where commands are issued from
+    ERROR_ATTRIBUTION_CHEAP = "cheap"  # Record the first calling frame outside of RSSscpi
+    ERROR_ATTRIBUTION_FULL = "full"  # Record the whole call stack
+
+    STATE_CACHE_INVALIDATE = ("*RST", "*RCL", "SYSTem:PRESet", "MMEMory:LOAD:STATe")
+    """
+    Commands which change the instrument state in ways the state cache can't follow, see enable_state_cache().
+    Writing one of them clears the whole cache. The entries are matched against the start of the written command,
+    with any node indices, so "SENSe:SWEep:STEP" also matches SENSe2:SWEep:STEP.
+    """
+
+    STATE_CACHE_COUPLED = {}
+    """
+    Commands which change other settings, {command: (coupled commands, ...)}, see enable_state_cache().
+    Writing the command discards the cached values of the coupled commands. Both are matched like
+    STATE_CACHE_INVALIDATE, with any node indices.
+    """
+
     def __get__(self, instance, owner):
         return self
 
@@ -113,6 +238,7 @@ class Instrument(SCPINodeBase):
         """
 
         super(Instrument, self).__init__(None)
+        self._claim_session(visa_res)
         self._visa_res = visa_res
         self.command_cnt = 0
         """
@@ -125,10 +251,14 @@ class Instrument(SCPINodeBase):
         self._service_request_callback_handle = None
         self.last_cmd_time = 0
 
-        self._visa_lock = threading.Lock()
+        self._visa_lock = threading.RLock()  # Reentrant, for _restore_session()
         self._in_callback = threading.Lock()
         """Locks used to synchronize VISA operations."""
 
+        self._initialized = False  # init() has been called
+        self._session_count = getattr(visa_res, "reconnect_count", 0)  # See _restore_session()
+        self._restoring = False
+
         self.event_queue = Queue.Queue()
         """
         Events generated by the VISA library are queued here.
@@ -139,11 +269,96 @@ class Instrument(SCPINodeBase):
         Errors fetched from the instrument are queued here.
         """
 
+        self._opc_lock = threading.Lock()
+        self._opc_sent = 0  # Sequence number of the last *OPC sent by send_opc(), updated under _visa_lock
+        self._opc_done = 0  # Sequence number of the last completed *OPC
+        self._opc_waiters = {}  # Sequence number -> threading.Event, see wait_opc()
+        self._esr_stale = False  # The event status register wasn't read after a service request, see _opc_failed()
+
         self.exception_on_error = True
         self._cmd_debug = LimitedCapacityDict(max_len=500)
         """
-        _call_visa(...) stores the stack trace here for each command.
+        _call_visa(...) stores the call stack here for each command, see _capture_stack().
+        """
+        self.error_attribution = self.ERROR_ATTRIBUTION_FULL
+        """
+        Determines how much of the call stack is recorded for each command, used to attribute
+        instrument errors to source lines. One of ERROR_ATTRIBUTION_OFF, _CHEAP or _FULL.
+        """
+
+        self.data_format = self.DATA_FORMAT_ASCII
+        """
+        The data format used for trace data transfers, set with set_data_format()
+        """
+        self._block_dtype = None  # numpy dtype of binary block data, None in ASCII mode
+        self._stimulus_cache = {}  # Channel number -> (sweep configuration, stimulus values), see ChannelTraceData
+
+        self.input_buffer_size = 4096
+        """
+        The maximum length of the combined messages sent by batch()
+        """
+        self._batch_state = threading.local()  # The batch of each thread, see batch()
+
+        self.state_cache = None
+        """
+        Cached SCPIProperty values, {command: {arguments: value}}, or None if disabled. See enable_state_cache().
+        """
+        self._state_cache_invalidate = None  # Compiled STATE_CACHE_INVALIDATE
+        self._state_cache_coupled = None  # Compiled STATE_CACHE_COUPLED, [(command, coupled commands), ...]
+
+    def _claim_session(self, visa_res):
+        """
+        Each Instrument object keeps its own view of the session state, like the data format, the state cache
+        and the active traces, which would get out of sync if several objects used the same session.
+        Refuse a session which is used by another Instrument object, see ConnectionPool.get_instrument().
+        """
+        ref = getattr(visa_res, "_instrument_ref", None)
+        owner = ref() if ref is not None else None
+        if owner is not None and owner is not self:
+            raise ValueError("The session is already used by another Instrument object: %r" % owner)
+        try:
+            visa_res._instrument_ref = weakref.ref(self)
+        except AttributeError:
+            pass  # The transport doesn't take new attributes, nothing to check against
+
+    @property
+    def _batch_depth(self):
+        return getattr(self._batch_state, "depth", 0)
+
+    @_batch_depth.setter
+    def _batch_depth(self, value):
+        self._batch_state.depth = value
+
+    @property
+    def _batch(self):
+        """
+        The commands buffered by batch() in the current thread, [(command, response or None), ...]
+        """
+        try:
+            return self._batch_state.cmds
+        except AttributeError:
+            cmds = self._batch_state.cmds = []
+            return cmds
+
+    @_batch.setter
+    def _batch(self, value):
+        self._batch_state.cmds = value
+
+    @property
+    def _batch_len(self):
+        return getattr(self._batch_state, "length", 0)
+
+    @_batch_len.setter
+    def _batch_len(self, value):
+        self._batch_state.length = value
+
+    @property
+    def supports_srq(self):
+        """
+        True if the transport delivers service requests, so that events are put in event_queue.
+        Transports without service requests, like SocketInterface, set has_srq = False.
         """
+        return getattr(self._visa_res, "has_srq", True)
 
     def init(self):
         """
@@ -153,11 +368,47 @@ class Instrument(SCPINodeBase):
         # Enable Operation Complete reporting with *OPC
         # Generate a Service Request when the event status register changes, or the error queue is non-empty
         self._write("*CLS;*ESE 127;*SRE 36")
+        self._initialized = True
 
         self._service_request_callback_handle = self._visa_res.install_handler(
             visa.constants.EventType.service_request, self._service_request_handler, 0)
         self._visa_res.enable_event(visa.constants.EventType.service_request, visa.constants.VI_HNDLR)
 
+    def _restore_session(self):
+        """
+        Restore the setup on a new connection to the instrument, for instance after a reboot.
+        Runs init() again if it has been called before, and restores the binary data format if one is selected.
+        """
+        self.invalidate_state_cache()  # The instrument may have been reset
+        self._restoring = True
+        batch_depth, self._batch_depth = self._batch_depth, 0  # Send the setup commands immediately
+        try:
+            self.log("Restoring the instrument setup on a new connection")
+            if self._initialized:
+                self.init()
+            if self._block_dtype is not None:
+                byte_order = "SWAPped" if self._block_dtype.str[0] == "<" else "NORMal"
+                bits = self._block_dtype.itemsize * 8
+                self._write("FORMat:BORDer {};:FORMat:DATA REAL,{:d}".format(byte_order, bits))
+        finally:
+            self._batch_depth = batch_depth
+            self._restoring = False
+
+    def _reconnect(self, count):
+        """
+        Reopen the connection after it was lost and restore the setup, if the transport supports it,
+        see SocketInterface.reconnect().
+
+        :param count: The reconnect_count of the transport before the failed command
+        :return: True if the failed command can be retried on the new connection
+        """
+        reconnect = getattr(self._visa_res, "reconnect", None)
+        if reconnect is None or self._restoring or not reconnect(count):
+            return False
+        self._restore_session()
+        self._session_count = self._visa_res.reconnect_count
+        return True
+
     # noinspection PyUnusedLocal
     def _service_request_handler(self, session, event_type, context, user_handle):
         """
@@ -171,29 +422,38 @@ class Instrument(SCPINodeBase):
         """
         duration = timeit.default_timer() - self.last_cmd_time
         #print "Handling service request"
-        with self._visa_lock:
-            with self._in_callback:
-                stb = self._visa_res.read_stb()  # Read out the SRQ status byte
-                if stb & 32:
-                    esr = self._call_visa(self._visa_res.query, "*ESR?")  # read and reset the event status register
-                else:
-                    esr = 0
-                self.log("VISA event: STB: {:08b}, ESR: {:08b}, duration {:.2f} ms".format(stb, int(esr), duration*1e3))
-                self.event_queue.put_nowait(VISAEvent(duration, stb, esr))
-
-                if stb & (1 << 2):  # Error queue not empty bit
-                    self._get_error_queue()
+        try:
+            with self._visa_lock:
+                with self._in_callback:
+                    stb = self._visa_res.read_stb()  # Read out the SRQ status byte
+                    opc_sent = self._opc_sent  # The *OPC sent before the *ESR? query below
+                    if stb & 32:
+                        esr = self._call_visa(self._visa_res.query, "*ESR?")  # read and reset the event status register
+                    else:
+                        esr = 0
+                    self.log("VISA event: STB: {:08b}, ESR: {:08b}, duration {:.2f} ms".format(stb, int(esr), duration*1e3))
+                    self.event_queue.put_nowait(VISAEvent(duration, stb, esr))
+                    if int(esr) & 1:  # Operation complete
+                        self._opc_complete(opc_sent)
+
+                    if stb & (1 << 2):  # Error queue not empty bit
+                        self._get_error_queue()
+        except BaseException, e:
+            self.log("Service request handling failed: %r" % e)
+            self._opc_failed(e)  # The event may have been lost, don't leave the waiting threads hanging
+            raise
         return visa.constants.VI_SUCCESS
 
     def _get_error_queue(self):
+        self.invalidate_state_cache()  # A cached setting may not have been accepted
         err = self._query("SYSTem:ERRor:ALL?")
         cnt = 0
         for r in re.finditer(r'(-?\d+),"(.*?([A-Z]{3}.*?)?(?:\n.*?)?)"', str(err)):
             cnt += 1
             x = (int(r.group(1)), r.group(2).replace("\n", " "))
             bad_cmd = r.group(3)
-            tb = self._cmd_debug.get(bad_cmd)
-            if not tb:
+            tb = self._format_stack(self._cmd_debug.get(bad_cmd))
+            if not tb and self.error_attribution != self.ERROR_ATTRIBUTION_OFF:
                 print "No stack for", str(err), r.groups()
             self.error_queue.put_nowait(InstrumentError(x[0], x[1], tb))
             self.log("%d %s" % x)
@@ -215,11 +475,29 @@ class Instrument(SCPINodeBase):
             # TODO: raise with original stack trace instead?
             raise self.error_queue.get(block=False)
 
-    def _call_visa(self, func, arg):
+    def _call_visa(self, func, arg, record=True, retry=True):
+        """
+        :param func: The VISA function to invoke with arg
+        :param arg: The command string
+        :param record: If False the command is not counted and no stack is stored, used when the commands
+                       in arg have already been recorded individually.
+        :param retry: If False the command is not retried after reconnecting, used for streamed transfers
+                      which can't be repeated.
+
+        If the transport reports that the connection was lost, the command is retried once after reconnecting
+        and restoring the instrument setup, see _reconnect().
+        """
         self.check_error_queue()
 
-        self.command_cnt += 1
-        self._cmd_debug[arg] = traceback.extract_stack()[:-2]  # Store the current stack for later debugging
+        count = getattr(self._visa_res, "reconnect_count", 0)
+        if count != self._session_count and not self._restoring:  # Reconnected by another user of the session
+            self._restore_session()
+            self._session_count = count
+
+        if record:
+            self.command_cnt += 1
+            if self.error_attribution != self.ERROR_ATTRIBUTION_OFF:
+                self._cmd_debug[arg] = self._capture_stack()  # Store the current stack for later debugging
         start = timeit.default_timer()
         err = None
         try:
@@ -228,6 +506,10 @@ class Instrument(SCPINodeBase):
             err = "Resource error: " + str(e) + ", " + arg
             print err
             raise
+        except socket.error, e:
+            if isinstance(e, socket.timeout) or not self._reconnect(count) or not retry:
+                raise
+            ret = func(arg)  # Retry once on the new connection
         finally:
             self.last_cmd_time = timeit.default_timer()
             elapsed = (self.last_cmd_time - start) * 1e3
@@ -236,19 +518,96 @@ class Instrument(SCPINodeBase):
                 self.log(err)
         return ret
 
+    def _capture_stack(self, depth=3):
+        """
+        Record the call stack, excluding the _call_visa() frame and its caller.
+        Only (code, line number) pairs are stored, the source lines are looked up by _format_stack()
+        when an error is actually reported.
+
+        :return: A list of (code, lineno), outermost frame first.
+        """
+        f = sys._getframe(depth)
+        if self.error_attribution == self.ERROR_ATTRIBUTION_CHEAP:
+            while f.f_back and f.f_globals.get("__name__", "").startswith(_package_prefix):
+                f = f.f_back  # Skip the frames inside RSSscpi
+            return [(f.f_code, f.f_lineno)]
+        stack = []
+        while f:
+            stack.append((f.f_code, f.f_lineno))
+            f = f.f_back
+        stack.reverse()
+        return stack
+
+    @staticmethod
+    def _format_stack(stack):
+        """
+        Convert a stack recorded by _capture_stack() to the format returned by traceback.extract_stack().
+
+        :rtype: list of (str, int, str, str) or None
+        """
+        if not stack:
+            return None
+        ret = []
+        for code, lineno in stack:
+            filename = code.co_filename
+            linecache.checkcache(filename)
+            line = linecache.getline(filename, lineno)
+            ret.append((filename, lineno, code.co_name, line.strip() if line else None))
+        return ret
+
     @staticmethod
     def _build_arg_str(cmd, args, kwargs):
+        """
+        Format the arguments with kwargs["fmt"], see SCPICmdFormatter.compile(). Without a format string the
+        arguments are joined as with "{:s*}", or "{:q*}" if kwargs["quote"] is set or the command takes a string.
+        """
         fmt = kwargs.get("fmt")
-        if not fmt:
-            args = (args, )
-            if kwargs.get("quote") or "'string'" in cmd.args:
-                fmt = "{:q*}"
-            else:
-                fmt = "{:s*}"
-        return SCPICmdFormatter().vformat(fmt, args, kwargs)
+        if fmt:
+            return SCPICmdFormatter.compile(fmt)(args, kwargs)
+        if not args:
+            return ""
+        if kwargs.get("quote") or "'string'" in cmd.args:
+            return ", ".join(map(quote_string, args))
+        return ", ".join(map(str, args))
+
+    def set_data_format(self, fmt, byte_order="SWAPped"):
+        """
+        Select the format used for trace data transfers, FORMat:DATA and FORMat:BORDer.
+        In the REAL formats query responses are read as raw bytes, and block data is decoded without
+        intermediate string conversions by SCPIResponse.numpy_array() and numpy_complex().
+
+        :param str fmt: DATA_FORMAT_ASCII, DATA_FORMAT_REAL32 or DATA_FORMAT_REAL64
+        :param str byte_order: "SWAPped" (little endian, default) or "NORMal" (big endian)
+        """
+        fmt = fmt.replace(" ", "")
+        if fmt.upper() == self.DATA_FORMAT_ASCII.upper():
+            self.FORMat.DATA().w("ASCii")
+            self._block_dtype = None
+        elif fmt.upper() in (self.DATA_FORMAT_REAL32, self.DATA_FORMAT_REAL64):
+            bits = int(fmt.split(",")[1])
+            endian = "<" if byte_order.upper().startswith("SWAP") else ">"
+            self.FORMat.BORDer().w(byte_order)
+            self.FORMat.DATA().w("REAL", bits)
+            self._block_dtype = numpy.dtype(endian + "f%d" % (bits // 8))
+        else:
+            raise ValueError("Invalid data format: " + fmt)
+        self.data_format = fmt
+
+    def _visa_query_raw(self, cmd_str):
+        """
+        Write cmd_str and read the response as raw bytes. Used in the binary data formats, where
+        the response can't be decoded as text.
+        """
+        query_raw = getattr(self._visa_res, "query_raw", None)
+        if query_raw is not None:  # The transport writes and reads atomically, see SocketInterface
+            return query_raw(cmd_str)
+        self._visa_res.write(cmd_str)
+        return self._visa_res.read_raw()
 
     def _write(self, cmd_str):
-        self._call_visa(self._visa_res.write, cmd_str)
+        with self._visa_lock:
+            self._flush_batch()  # Keep the order of the commands of this thread
+            self._call_visa(self._visa_res.write, cmd_str)
 
     def write(self, cmd, *args, **kwargs):
         """
@@ -261,10 +620,229 @@ class Instrument(SCPINodeBase):
         """
         x = cmd.build_cmd() + " " + self._build_arg_str(cmd, args, kwargs)
         with self._visa_lock:
-            self._call_visa(self._visa_res.write, x)
+            if self._batch_depth:
+                self._batch_cmd(x)
+            else:
+                self._flush_batch()  # Send any queued queries first, to preserve the command order
+                self._call_visa(self._visa_res.write, x)
+        if self.state_cache is not None:
+            self._update_state_cache(cmd.build_cmd())
+
+    def enable_state_cache(self, enable=True):
+        """
+        Enable or disable the write-through cache of SCPIProperty values. With the cache enabled, values written
+        through a property are recorded, and read back from the cache without a query. Values which can't be
+        predicted from the written value, like strings the instrument normalizes, are cached on the first read.
+        On transports without service requests, like SocketInterface, a rejected value isn't reported, so
+        values are only cached when they are read.
+
+        Writing a command discards the cached values of the same command and of the commands coupled to it in
+        STATE_CACHE_COUPLED. The commands in STATE_CACHE_INVALIDATE, like *RST, clear the whole cache, as do
+        reconnects and instrument errors reported by service requests.
+        Changes made from the front panel or by other sessions are not detected, use invalidate_state_cache().
+
+        :param enable: False to disable the cache and discard the cached values
+        """
+        if not enable:
+            self.state_cache = None
+            return
+        if self._state_cache_invalidate is None:
+            self._state_cache_invalidate = self._command_pattern(self.STATE_CACHE_INVALIDATE)
+            self._state_cache_coupled = [(self._command_pattern([cmd]), self._command_pattern(coupled))
+                                         for cmd, coupled in self.STATE_CACHE_COUPLED.items()]
+        if self.state_cache is None:
+            self.state_cache = {}
+
+    @staticmethod
+    def _command_pattern(commands):
+        """
+        :param commands: Command paths, like "SENSe:SWEep:STEP"
+        :return: A regex matching the start of built commands with any of the paths, with any node indices
+        """
+        return re.compile("|".join(":".join(re.escape(node) + r"\d*" for node in cmd.split(":")) for cmd in commands))
+
+    def invalidate_state_cache(self):
+        """
+        Discard all cached property values, see enable_state_cache().
+        """
+        if self.state_cache is not None:
+            self.state_cache.clear()
+
+    def _update_state_cache(self, cmd_str):
+        if self._state_cache_invalidate.match(cmd_str):
+            self.state_cache.clear()
+            return
+        self.state_cache.pop(cmd_str, None)
+        for pattern, coupled in self._state_cache_coupled:
+            if pattern.match(cmd_str):
+                for key in [k for k in self.state_cache if coupled.match(k)]:
+                    del self.state_cache[key]
+
+    def write_block(self, cmd, data, *args, **kwargs):
+        """
+        Send a command with a definite length block as the last argument, like MMEMory:DATA.
+        Transports which support it, like SocketInterface.write_parts(), send the data directly from the
+        buffer, instead of copying it into the command string. Any buffered commands are sent first.
+
+        :param cmd: The SCPI command
+        :type cmd: SCPINodeBase
+        :param data: The block contents
+        :type data: str or bytearray or memoryview
+        :param args: The arguments preceding the block, see write()
+        """
+        msg = cmd.build_cmd() + " "
+        if args:
+            msg += self._build_arg_str(cmd, args, kwargs) + ", "
+        msg += SCPIBlockData.header(len(data))
+        write_parts = getattr(self._visa_res, "write_parts", None)
+        with self._visa_lock:
+            self._flush_batch()
+            if write_parts is not None:
+                self._call_visa(lambda x: write_parts([x, data]), msg)
+            else:
+                data = data.tobytes() if isinstance(data, memoryview) else str(data)
+                self._call_visa(self._visa_res.write, msg + data)
+
+    def write_block_stream(self, cmd, chunks, length, *args, **kwargs):
+        """
+        Send a command with a definite length block as the last argument, with the block contents produced in
+        chunks, like a file read with a fixed-size buffer. Transports with write_stream(), like SocketInterface,
+        send each chunk as it is produced, others get the joined chunks. The command is not retried if the
+        connection is lost.
+
+        :param cmd: The SCPI command
+        :type cmd: SCPINodeBase
+        :param chunks: An iterable of str, bytearray or memoryview, with length bytes in total
+        :param int length: The length of the block
+        :param args: The arguments preceding the block, see write()
+        """
+        msg = cmd.build_cmd() + " "
+        if args:
+            msg += self._build_arg_str(cmd, args, kwargs) + ", "
+        msg += SCPIBlockData.header(length)
+        write_stream = getattr(self._visa_res, "write_stream", None)
+        with self._visa_lock:
+            self._flush_batch()
+            if write_stream is not None:
+                self._call_visa(lambda x: write_stream(itertools.chain([x], chunks)), msg, retry=False)
+            else:
+                data = "".join(x.tobytes() if isinstance(x, memoryview) else str(x) for x in chunks)
+                self._call_visa(self._visa_res.write, msg + data, retry=False)
+
+    def query_block(self, cmd, write, *args, **kwargs):
+        """
+        Execute a query with a definite length block response, like MMEMory:DATA?, and pass the block contents
+        to write() in chunks. Transports with query_block(), like SocketInterface, receive the block into a
+        buffer of chunk_size bytes, so the memory use doesn't depend on the size of the block. With other
+        transports the whole response is read first. The query is not retried if the connection is lost.
+
+        :param cmd: The SCPI command
+        :type cmd: SCPINodeBase
+        :param write: Function called with each chunk of the block, a str or memoryview which is only valid
+                      during the call
+        :param args: The arguments for the command, see query()
+        :param chunk_size: Keyword only, the buffer size in bytes
+        :return: The length of the block
+        :rtype: int
+        """
+        chunk_size = kwargs.pop("chunk_size", 1 << 20)
+        x = cmd.build_cmd() + "? " + self._build_arg_str(cmd, args, kwargs)
+        query_block = getattr(self._visa_res, "query_block", None)
+        with self._visa_lock:
+            self._flush_batch()
+            if query_block is not None:
+                return self._call_visa(lambda s: query_block(s, write, chunk_size), x, retry=False)
+            data = SCPIBlockData.parse(self._call_visa(self._visa_query_raw, x, retry=False))
+            write(data)
+            return len(data)
+
+    @contextmanager
+    def batch(self):
+        """
+        Context manager which buffers all writes and sends them joined with ";:" in as few messages
+        as possible, bounded by input_buffer_size. The buffer is flushed when the context exits and
+        before any query. Batches can be nested, the outermost batch determines when the buffer is flushed.
+
+        The call stack of each command is still recorded individually, so errors reported by
+        the instrument are attributed to the right source line.
+
+        with znb.batch():
+            sense.FREQuency.STARt().w(100e6)
+            sense.FREQuency.STOP().w(3e9)
+
+        Queries queued with SCPIQuery.q_async() are sent in the same messages, see pipeline().
+
+        The batch belongs to the calling thread. Commands from other threads are sent as usual, and may
+        be sent before the buffered commands.
+        """
+        with self._visa_lock:
+            self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            with self._visa_lock:
+                self._batch_depth -= 1
+                if not self._batch_depth:
+                    self._flush_batch()
+
+    def pipeline(self):
+        """
+        Context manager for pipelined queries. Queries queued with SCPIQuery.q_async() or SCPIProperty.q_async()
+        inside the context are sent together with the buffered writes, and their SCPIDeferredResponses
+        are filled in from the combined response when the context exits.
+
+        with znb.pipeline():
+            ys = [Marker.y.q_async(m) for m in markers]
+        values = [y.result() for y in ys]
+        """
+        return self.batch()
+
+    def _batch_cmd(self, cmd_str, response=None):
+        """
+        Add a command to the batch buffer. The caller must hold _visa_lock.
+
+        :param response: The SCPIDeferredResponse for a query, None for writes
+        """
+        self.check_error_queue()
+        self.command_cnt += 1
+        if self.error_attribution != self.ERROR_ATTRIBUTION_OFF:
+            self._cmd_debug[cmd_str] = self._capture_stack()
+        if self._batch and self._batch_len + len(cmd_str) + 2 > self.input_buffer_size:
+            self._flush_batch()
+        self._batch.append((cmd_str, response))
+        self._batch_len += len(cmd_str) + 2
+
+    def _flush_batch(self):
+        """
+        Send the buffered commands. The caller must hold _visa_lock.
+        """
+        if not self._batch:
+            return
+        cmds, self._batch, self._batch_len = self._batch, [], 0
+        # Common commands, *XXX, can't be preceded by a colon
+        msg = cmds[0][0] + "".join((";" if c[0] == "*" else ";:") + c for c, _ in cmds[1:])
+        responses = [r for _, r in cmds if r is not None]
+        if not responses:
+            self._call_visa(self._visa_res.write, msg, record=False)
+            return
+        raw = self._call_visa(self._visa_query_raw, msg, record=False)
+        parts = SCPIResponse.split_combined(raw)
+        if len(parts) != len(responses):
+            raise self.Error(-1, "Expected %d responses to pipelined queries, got %d" % (len(responses), len(parts)))
+        for r, x in zip(responses, parts):
+            r.set_result(x)
+
+    def flush(self):
+        """
+        Send any commands buffered by batch() immediately.
+        """
+        with self._visa_lock:
+            self._flush_batch()
 
     def _query(self, cmd_str):
-        return SCPIResponse(self._call_visa(self._visa_res.query, cmd_str))
+        with self._visa_lock:
+            self._flush_batch()
+            return SCPIResponse(self._call_visa(self._visa_res.query, cmd_str))
 
     def query(self, cmd, *args, **kwargs):
         """
@@ -278,9 +856,11 @@ class Instrument(SCPINodeBase):
         """
         # TODO: add function to read back result later
         x = cmd.build_cmd() + "? " + self._build_arg_str(cmd, args, kwargs)
+        func = self._visa_res.query if self._block_dtype is None else self._visa_query_raw
         try:
             with self._visa_lock:
-                return SCPIResponse(self._call_visa(self._visa_res.query, x))
+                self._flush_batch()
+                return SCPIResponse(self._call_visa(func, x), self._block_dtype)
         except visa.VisaIOError, e:
             if e.error_code == visa.constants.VI_ERROR_TMO:  # timeout
                 if self.exception_on_error:
@@ -290,6 +870,147 @@ class Instrument(SCPINodeBase):
                         pass
             raise e
 
+    def query_async(self, cmd, *args, **kwargs):
+        """
+        Queue a SCPI query in the batch buffer, see pipeline().
+        The query is sent when the buffer is flushed, at the latest when the response is accessed.
+
+        :param cmd: The SCPI command
+        :type cmd: SCPINodeBase
+        :param args: A list of arguments for the command, see query()
+        :rtype: SCPIDeferredResponse
+        """
+        x = cmd.build_cmd() + "? " + self._build_arg_str(cmd, args, kwargs)
+        response = SCPIDeferredResponse(self, self._block_dtype)
+        with self._visa_lock:
+            self._batch_cmd(x, response)
+        return response
+
+    def send_opc(self):
+        """
+        Send *OPC, which sets the operation complete bit in the event status register when all pending
+        operations have finished. Inside batch() the buffered commands are sent together with the *OPC.
+
+        The events of several *OPC can be merged before the service request handler reads the event status
+        register, so an operation complete event completes every *OPC sent by send_opc() before the *ESR? query
+        which reported it. *OPC written directly, OPC.w(), isn't numbered and can't be waited for.
+
+        :return: The sequence number of the *OPC, for wait_opc()
+        :rtype: int
+        """
+        with self._visa_lock:  # The service request handler reads _opc_sent under the same lock
+            if self._esr_stale:
+                # Clear the event status register, an event left in it would prevent the next service request
+                self._query("*ESR?")
+                self._esr_stale = False
+            self.OPC.w()
+            self._flush_batch()
+            with self._opc_lock:
+                self._opc_sent += 1
+                return self._opc_sent
+
+    def _opc_complete(self, seq):
+        """
+        Mark all *OPC up to seq as complete and wake their waiters.
+        """
+        with self._opc_lock:
+            self._opc_done = max(self._opc_done, min(seq, self._opc_sent))
+            for n in [n for n in self._opc_waiters if n <= self._opc_done]:
+                self._opc_waiters.pop(n).set()
+
+    def _opc_failed(self, error):
+        """
+        Wake all threads in wait_opc() with an error, when an operation complete event may have been lost.
+        """
+        with self._opc_lock:
+            waiters, self._opc_waiters = self._opc_waiters, {}
+            self._esr_stale = True
+        for event in waiters.values():
+            event.error = error
+            event.set()
+
+    @contextmanager
+    def _transport_timeout(self, timeout):
+        """
+        Change the timeout of the transport while the context is active, and hold _visa_lock so that the
+        timeout only applies to the calling thread. Only used with the transports of this package, see
+        SocketInterface.settimeout(), pyvisa resources have service requests and a timeout in milliseconds.
+
+        :param timeout: Timeout in seconds, the timeout is unchanged if None
+        """
+        with self._visa_lock:
+            res = self._visa_res
+            if timeout is None or not hasattr(res, "timeout"):
+                yield
+                return
+            old = res.timeout
+            settimeout = getattr(res, "settimeout", None) or (lambda t: setattr(res, "timeout", t))
+            settimeout(timeout)
+            try:
+                yield
+            finally:
+                settimeout(old)
+
+    def wait_opc(self, seq=None, timeout=None):
+        """
+        Wait for the operation tagged by send_opc() to complete. The waiting thread is woken by the service
+        request handler when the operation complete event arrives, without polling.
+        On transports without service requests, see supports_srq, *OPC? is used instead, with the timeout
+        applied to the transport.
+
+        :param seq: The sequence number returned by send_opc(), the last *OPC sent if None
+        :param timeout: Timeout in seconds, wait indefinitely if None
+        :raises InstrumentError: on timeout, socket.timeout on transports without service requests
+        """
+        with self._opc_lock:
+            if seq is None:
+                seq = self._opc_sent
+            if seq <= self._opc_done:
+                return
+            sent = self._opc_sent
+            event = self._opc_waiters.get(seq)
+            if event is None:
+                event = self._opc_waiters[seq] = threading.Event()
+        if not self.supports_srq:
+            with self._transport_timeout(timeout):
+                self.OPC.q()  # Returns when all pending operations are complete
+            self._opc_complete(sent)
+            return
+        event.wait(timeout)
+        with self._opc_lock:
+            error = getattr(event, "error", None)
+            if error is not None and seq > self._opc_done:
+                raise self.Error(-1, "Service request handling failed while waiting for *OPC %d: %r" % (seq, error))
+            if seq > self._opc_done:
+                if self._opc_waiters.get(seq) is event:
+                    del self._opc_waiters[seq]
+                raise self.Error(-1, "Timeout while waiting for operation complete, *OPC %d" % seq)
+
+    def start_and_wait(self, cmd, *args, **kwargs):
+        """
+        Send a command which starts an overlapped operation, like INITiate:IMMediate, together with *OPC,
+        and wait for the operation to complete. See wait_opc().
+        On transports without service requests the command is sent together with *OPC?, and the timeout
+        is applied to the transport while waiting for the response.
+
+        znb.start_and_wait(znb.INITiate(1).IMMediate(), timeout=10)
+
+        :param cmd: The SCPI command
+        :type cmd: SCPINodeBase
+        :param args: Arguments for the command, see write()
+        :param timeout: Keyword argument, timeout in seconds
+        """
+        timeout = kwargs.pop("timeout", None)
+        if not self.supports_srq:
+            with self._transport_timeout(timeout), self.pipeline():  # A single round trip
+                self.write(cmd, *args, **kwargs)
+                self.OPC.q_async()
+            return
+        with self.batch():
+            self.write(cmd, *args, **kwargs)
+            seq = self.send_opc()
+        self.wait_opc(seq, timeout)
+
     def update_display(self, state=True, once=False):
         if state:
             if once:
@@ -302,3 +1023,5 @@ class Instrument(SCPINodeBase):
 
     def preset(self):
         self.RST.w()
+        self.data_format = self.DATA_FORMAT_ASCII  # *RST restores FORMat:DATA ASCii
+        self._block_dtype = None
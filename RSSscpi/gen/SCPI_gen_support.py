@@ -6,6 +6,7 @@ Created on Thu Feb 11 11:30:33 2016
 """
 
 import inspect
+import threading
 from SCPI_response import SCPIResponse
 
 # TODO
@@ -18,6 +19,7 @@ from SCPI_response import SCPIResponse
 
 
 class DummyVisa(object):
+    has_srq = False
 
     def __init__(self, name):
         self.name = name
@@ -29,6 +31,10 @@ class DummyVisa(object):
     def write(self, w):
         print "Visa write,", self.name, w
 
+    def read_raw(self):
+        print "Visa read,", self.name
+        return "1 A\n"
+
     def install_handler(*args):
         print "Install handler not implemented"
 
@@ -40,6 +46,7 @@ class SCPINodeBase(object):
     _cmd = "SCPINodeBase"
     _parent_class = None  # The class of the parent of the command node
     _SCPI_class = None  # Identifies the original class type in cases of subclassing
+    _root = None  # Memoized root node, see _get_root()
 
     def __init__(self, parent=None):
         """
@@ -84,7 +91,9 @@ class SCPINodeBase(object):
         """
         if not self._parent:
             return self
-        return self._parent._get_root()
+        if self._root is None:
+            self._root = self._parent._get_root()  # The parent never changes, so the root can be memoized
+        return self._root
 
 
 class SCPINode(SCPINodeBase):
@@ -144,6 +153,15 @@ class SCPIQuery(SCPICmd):
         """
         return self._get_root().query(self, *args, **kwargs)
 
+    def q_async(self, *args, **kwargs):
+        """
+        Queue a SCPI query, to be sent in the same message as other queued commands. See Instrument.pipeline().
+
+        :returns: a SCPIDeferredResponse instance, which is filled in when the queue is flushed
+        :rtype: RSSscpi.gen.SCPI_response.SCPIDeferredResponse
+        """
+        return self._get_root().query_async(self, *args, **kwargs)
+
 
 class SCPISet(SCPICmd):
     def w(self, *args, **kwargs):
@@ -163,3 +181,116 @@ class SCPIBool(SCPIQuery, SCPISet):
     def w(self, x):
         super(SCPIBool, self).w(self._mk_arg(x))
 
+
+
+_materialize_lock = threading.Lock()
+
+
+class SCPILazyNodeType(type):
+    """
+    Metaclass for command trees stored as tables, see lazy_instrument_class().
+    The node classes are created from the table on first access, instead of when the module is imported.
+    """
+    def __getattr__(cls, name):
+        if name[0] == "_":
+            raise AttributeError(name)  # Private and special attributes never come from the table
+        for klass in cls.__mro__:
+            table = klass.__dict__.get("_lazy_table")
+            if table is None:
+                continue
+            if callable(table):  # The table of the instrument class is loaded on first access
+                table = table()
+                type.__setattr__(klass, "_lazy_table", table)
+            if name in table:
+                klass._materialize(name, table[name])
+                return getattr(cls, name)
+        raise AttributeError("type object '%s' has no attribute '%s'" % (cls.__name__, name))
+
+    def __dir__(cls):
+        names = set()
+        for klass in cls.__mro__:
+            names.update(klass.__dict__)
+            table = klass.__dict__.get("_lazy_table")
+            if table is not None:
+                names.update(table() if callable(table) else table)
+        return sorted(names)
+
+    def _materialize(cls, name, entry):
+        """
+        Create the node class for a table entry, and add an instance of it as a class attribute, in the same way
+        as the generated class definitions do.
+
+        :param entry: (SCPI command, node flags, arguments, help URL, {children}). The flags are a string of
+                      "N": indexed node, "Q": query, "S": set, "B": boolean.
+        """
+        with _materialize_lock:
+            if name in cls.__dict__:
+                return  # Created by another thread
+            cmd, flags, args, url, children = entry
+            bases = (SCPINodeN if "N" in flags else SCPINode, )
+            if "B" in flags:
+                bases += (SCPIBool, )
+            else:
+                if "Q" in flags:
+                    bases += (SCPIQuery, )
+                if "S" in flags:
+                    bases += (SCPISet, )
+            path = cls.__dict__.get("_lazy_path")
+            path = path + ":" + cmd if path else cmd
+            url_base = cls._lazy_url_base
+            if url is not None:
+                doc = "`" + path + "\n<" + url_base + url + ">`_"
+            else:
+                doc = path
+            doc += "\n\nArguments: " + ", ".join(args)
+            node_class = SCPILazyNodeType(name, bases + (SCPILazyNode, ), {
+                "__doc__": doc,
+                "__module__": cls.__module__,
+                "_cmd": cmd,
+                "args": list(args),
+                "_lazy_table": children,
+                "_lazy_path": path,
+                "_lazy_url_base": url_base,
+            })
+            node_class._SCPI_class = node_class
+            node_class._parent_class = cls._SCPI_class
+            type.__setattr__(cls, name, node_class())
+
+
+class SCPILazyNode(object):
+    """
+    Mixin for the nodes of a table based command tree, see SCPILazyNodeType.
+    """
+    __metaclass__ = SCPILazyNodeType
+    _lazy_table = None
+    _lazy_url_base = ""
+
+    def __getattr__(self, name):
+        if name[0] == "_":
+            raise AttributeError(name)
+        try:
+            getattr(self.__class__, name)  # Create the node class
+        except AttributeError:
+            raise AttributeError("'%s' object has no attribute '%s'" % (self.__class__.__name__, name))
+        return getattr(self, name)
+
+    def __dir__(self):
+        return sorted(set(dir(self.__class__)) | set(self.__dict__))
+
+
+def lazy_instrument_class(name, base, table_loader, url_base="", module=None):
+    """
+    Create an instrument class from a command table generated by tools.generate_class_defs.TableCodeGen.
+    The table is loaded, and the node classes created, when the nodes are first accessed.
+
+    :param name: The class name
+    :param base: The instrument base class, normally Instrument
+    :param table_loader: A function returning the command table, {name: (cmd, flags, args, url, {children})}
+    :param url_base: Prefix for the help URLs in the table
+    :param module: The __module__ of the created classes
+    """
+    return SCPILazyNodeType(name, (base, SCPILazyNode), {
+        "__module__": module,
+        "_lazy_table": table_loader,
+        "_lazy_url_base": url_base,
+    })
@@ -6,12 +6,15 @@
 
 from SCPI_gen_support import SCPINodeBase, SCPIQuery, SCPISet
 
+_missing = object()
+
 
 class SCPIProperty(object):
     """
     Getter/setter class for turning SCPINodes to class properties
     """
-    def __init__(self, node, conv, callback=None, get_root_node=lambda x: x, docstr=None):
+    def __init__(self, node, conv, callback=None, get_root_node=lambda x: x, docstr=None, cached=None,
+                 exact=False):
         """
 
         :param SCPINodeBase node: A __class__ derived from SCPINodeBase, which q() and w() will be invoked on an instance of.
@@ -20,27 +23,45 @@ class SCPIProperty(object):
         :param get_root_node: A function returning a SCPINodeBase instance, nodes between root and <node> will be instantiated an linked to root
         :type get_root_node: (T, ) -> SCPINodeBase
         :param str docstr: The property doctring
+        :param cached: Whether the value can be kept in the state cache of the instrument, see Instrument.enable_state_cache().
+                       The cached values are keyed by the command and the query arguments, so by default only properties
+                       without a callback are cached. Set to False for values which change by themselves, or when other
+                       settings change.
+        :param exact: The instrument stores written values exactly, so they are cached on write. Otherwise only
+                      integer and bool values are cached on write, and other values on the first query, since
+                      the instrument may round them to its resolution without reporting an error.
         """
         self._leaf_node = node
         self._conv = conv
         self._callback = callback  # type: (*args, **kwargs) -> T
         self._get_root_node = get_root_node  # type: (T, ) -> SCPINodeBase
+        self._cached = callback is None if cached is None else cached
+        self._exact = exact
         if docstr:  # FIXME: remove the argument and assign self.__doc__ =  node.__doc__ unconditionally
             self.__doc__ = docstr
 
     def _get_leaf(self, instance):
         # type: (T) -> SCPINodeBase
         root = self._get_root_node(instance)  # type: SCPINodeBase
+        # The leaf nodes are cached on the root node. A cached leaf is linked to the same root node,
+        # so its command string is rebuilt if the root node index changes.
+        cache = root.__dict__.get("_leaf_cache")
+        if cache is None:
+            cache = root.__dict__["_leaf_cache"] = {}
+        leaf = cache.get(self)
+        if leaf is not None:
+            return leaf
         x = [self._leaf_node]
         while not issubclass(root.__class__, x[-1]._parent_class):
             x.append(x[-1]._parent_class)
+        leaf = root
         for c in reversed(x):
-            root = c(parent=root)
-        return root  # Return the instantiated leaf node, properly linked to the root node
+            leaf = c(parent=leaf)
+        cache[self] = leaf
+        return leaf  # Return the instantiated leaf node, properly linked to the root node
 
-    def __get__(self, instance, owner=None):
-        if instance is None:
-            return self
+    def _query_leaf(self, instance):
+        # type: (T) -> (SCPIQuery, str)
         leaf = self._get_leaf(instance)  # type: SCPIQuery
         if not hasattr(leaf, "q"):
             raise AttributeError("SCPI node doesn't support query")
@@ -49,17 +70,79 @@ class SCPIProperty(object):
             cb = self._callback(self=instance, get=True)
             if cb is not None:
                 args = cb
-        return self._conv(leaf.q(args))
+        return leaf, args
+
+    def _convert(self, response):
+        return self._conv(response)
+
+    def _state_cache(self, leaf):
+        """
+        :return: The cached values of the command, keyed by the query arguments, or None if not cached
+        :rtype: dict
+        """
+        if not self._cached:
+            return None
+        cache = getattr(leaf._get_root(), "state_cache", None)
+        if cache is None:
+            return None
+        return cache.setdefault(leaf.build_cmd(), {})
+
+    def _cached_value(self, value):
+        """
+        :param value: The value written to the instrument
+        :return: The value a query would return after the write, or _missing if it can't be predicted
+        """
+        if isinstance(value, bool):
+            return value if self._conv is bool else _missing
+        if self._conv is int and isinstance(value, (int, long)):
+            return value
+        if self._exact and self._conv is float and isinstance(value, (int, long, float)):
+            return float(value)
+        return _missing  # For instance strings, which the instrument may abbreviate or change the case of
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        leaf, args = self._query_leaf(instance)
+        values = self._state_cache(leaf)
+        if values is None:
+            return self._convert(leaf.q(args))
+        value = values.get(args, _missing)
+        if value is _missing:
+            value = values[args] = self._convert(leaf.q(args))
+        return value
+
+    def q_async(self, instance):
+        """
+        Queue a query of the property value on instance, see Instrument.pipeline().
+
+        marker_y = [Marker.y.q_async(m) for m in markers]
+
+        :return: A SCPIDeferredResponse, whose result() is the property value
+        :rtype: RSSscpi.gen.SCPI_response.SCPIDeferredResponse
+        """
+        leaf, args = self._query_leaf(instance)
+        response = leaf.q_async(args)
+        response.conv = self._convert
+        return response
 
     def __set__(self, instance, value):
         leaf = self._get_leaf(instance)  # type: SCPISet
         if not hasattr(leaf, "w"):
             raise AttributeError("SCPI node doesn't support write")
+        arg = value
         if self._callback:
             cb = self._callback(self=instance, get=False, value=value)
             if cb is not None:
-                value = cb
-        leaf.w(value)
+                arg = cb
+        leaf.w(arg)  # Discards the cached values of the command
+        values = self._state_cache(leaf)
+        # Without service requests a rejected value isn't reported, so the value is cached on the next read instead
+        if values is not None and getattr(leaf._get_root(), "supports_srq", False):
+            cached = self._cached_value(value)
+            if cached is not _missing:
+                args = self._callback(self=instance, get=True) if self._callback else None
+                values["" if args is None else args] = cached
 
 
 class SCPIPropertyMapping(SCPIProperty):
@@ -84,27 +167,32 @@ class SCPIPropertyMapping(SCPIProperty):
         if rev_mapping is None:
             self._rev_map = {v: k for k, v in self._map.items()}
 
-    def __get__(self, instance, owner=None):
-        if instance is None:
-            return self
-        x = super(SCPIPropertyMapping, self).__get__(instance, owner)
+    def _convert(self, response):
+        x = super(SCPIPropertyMapping, self)._convert(response)
         return self._map[self._conv(x)]
 
+    def _cached_value(self, value):
+        return self._map.get(value, _missing)  # The mapped value is written
+
     def __set__(self, instance, value):
         v = self._rev_map[value]
         super(SCPIPropertyMapping, self).__set__(instance, v)
 
 
 class MinMax(object):
-    def __init__(self, instance, leaf, callback):
+    def __init__(self, instance, prop):
+        """
+        :type prop: SCPIPropertyMinMax
+        """
         self._instance = instance
-        self._leaf = leaf
-        self._cb = callback
+        self._prop = prop
+        self._leaf = prop._get_leaf(instance)
+        self._cb = prop._callback
 
     def _q(self, *args):
         if self._cb:
             self._cb(self=self._instance, get=True)
-        self._leaf.q(*args)
+        return self._prop._convert(self._leaf.q(*args))
 
     def _w(self, *args):
         if self._cb:
@@ -113,11 +201,11 @@ class MinMax(object):
 
     @property
     def value(self):
-        return self._q()
+        return SCPIProperty.__get__(self._prop, self._instance)
 
     @value.setter
     def value(self, value):
-        self._w(value)
+        self._prop.__set__(self._instance, value)
 
     def query_min(self):
         return self._q("MIN")
@@ -148,4 +236,4 @@ class SCPIPropertyMinMax(SCPIProperty):
     def __get__(self, instance, owner=None):
         if instance is None:
             return self
-        return MinMax(instance, self._get_leaf(instance), self._callback)
+        return MinMax(instance, self)
@@ -5,14 +5,28 @@
 """
 
 import numpy
+import re
+
+
+def quote_string(value):
+    """
+    Quote a string argument. Quotes inside the string are doubled, as in IEEE 488.2 string data: Bob's -> 'Bob''s'
+    """
+    return "'" + str(value).replace("'", "''") + "'"
 
 
 class SCPIResponse(object):
     """
     Class used for containing and parsing responses from SCPI queries.
     """
-    def __init__(self, res):
+    def __init__(self, res, block_dtype=None):
+        """
+        :param res: The raw response from the instrument
+        :param block_dtype: The numpy dtype of binary block data responses, see Instrument.set_data_format()
+        :type block_dtype: numpy.dtype or None
+        """
         self.raw = res
+        self.block_dtype = block_dtype
 
     def __nonzero__(self):
         """
@@ -23,8 +37,10 @@ class SCPIResponse(object):
         return str(self) in ["1", "ON"]
 
     def __str__(self):
-        x = self.raw.replace("\r", "\n")
-        return x.strip().strip("'")
+        x = str(self.raw).replace("\r", "\n").strip()
+        if len(x) > 1 and x[0] == x[-1] == "'":
+            return x[1:-1].replace("''", "'")  # A quoted string, with doubled quotes inside, see quote_string()
+        return x.strip("'")
 
     def __int__(self):
         x = str(self).split()[0]  # Remove the unit string
@@ -54,10 +70,46 @@ class SCPIResponse(object):
         """
         return [x.strip() for x in self.raw.split(",")]
 
-    def numpy_array(self, dtype=numpy.float64):
-        return numpy.fromstring(self.raw, sep=",", dtype=dtype)
+    def is_block_data(self):
+        """
+        :return: True if the response is a SCPI block data transfer
+        :rtype: bool
+        """
+        return self.raw[:1] == "#"
+
+    def numpy_array(self, dtype=numpy.float64, out=None):
+        """
+        Convert the response to a numpy array. REAL,32 and REAL,64 block data is decoded directly from
+        the response buffer with numpy.frombuffer, ASCII data is parsed as a comma separated list.
+
+        :param dtype: The dtype of the returned array
+        :param numpy.ndarray out: Decode the data into this array instead, it must have the size of the data
+        :rtype: numpy.ndarray
+        """
+        if self.block_dtype is not None and self.is_block_data():
+            offset, length = SCPIBlockData.parse_header(self.raw)
+            x = numpy.frombuffer(self.raw, dtype=self.block_dtype,
+                                 count=length // self.block_dtype.itemsize, offset=offset)
+            if out is not None:
+                out[...] = x
+                return out
+            return x.astype(dtype, copy=False)  # No copy if the block byte order is native
+        x = numpy.fromstring(self.raw, sep=",", dtype=dtype)
+        if out is not None:
+            out[...] = x
+            return out
+        return x
 
-    def numpy_complex(self):
+    def numpy_complex(self, out=None):
+        """
+        Convert the response to a complex numpy array, from pairs of real and imaginary parts.
+
+        :param numpy.ndarray out: A complex128 array to decode the data into, see numpy_array()
+        :rtype: numpy.ndarray
+        """
+        if out is not None:
+            self.numpy_array(out=out.view(numpy.float64))
+            return out
         x = self.numpy_array(dtype=numpy.float64)
         # http://stackoverflow.com/questions/15244327/python-unpacking-string-of-floats-to-complex-numbers
         x.dtype = numpy.complex128
@@ -71,23 +123,138 @@ class SCPIResponse(object):
         """
         return SCPIBlockData.parse(self.raw)
 
+    _split_re = re.compile(r"[;'\"#]")
+
+    @staticmethod
+    def split_combined(raw):
+        """
+        Split the response to a combined message, "A?;B?", into the responses of the individual queries.
+        Semicolons inside quoted strings and block data are not treated as separators.
+
+        :param raw: The raw response
+        :type raw: str or bytearray
+        :return: A list with one raw response per query
+        """
+        parts = []
+        start = pos = 0
+        find = SCPIResponse._split_re.search
+        while True:
+            m = find(raw, pos)
+            if not m:
+                break
+            i = m.start()
+            c = raw[i:i + 1]
+            if c == ";":
+                parts.append(raw[start:i])
+                start = pos = i + 1
+            elif c == "#":
+                pos = i + 1
+                if i == start:  # Skip over the block data
+                    try:
+                        offset, l = SCPIBlockData.parse_header(raw[i:i + 11])
+                        pos = i + offset + l
+                    except ValueError:
+                        pass  # Not a definite length block
+            else:  # Skip to the closing quote
+                end = raw.find(c, i + 1)
+                pos = end + 1 if end >= 0 else len(raw)
+        parts.append(raw[start:])
+        return parts
+
+
+class SCPIDeferredResponse(SCPIResponse):
+    """
+    A placeholder for the response to a query queued with SCPIQuery.q_async(). It is filled in when the queued
+    commands are sent to the instrument, accessing the response before that flushes the queue.
+    """
+    def __init__(self, instrument, block_dtype=None, conv=None):
+        """
+        :param instrument: The Instrument which the query is queued on
+        :param block_dtype: See SCPIResponse
+        :param conv: An optional function applied to the response by result()
+        """
+        self._done = False
+        self._instrument = instrument
+        self.conv = conv
+        super(SCPIDeferredResponse, self).__init__(None, block_dtype)
+
+    @property
+    def raw(self):
+        if not self._done:
+            self._instrument.flush()
+            if not self._done:
+                raise RuntimeError("The deferred query was never sent to the instrument")
+        return self._raw
+
+    @raw.setter
+    def raw(self, value):
+        self._raw = value
+
+    def set_result(self, raw):
+        self._raw = raw
+        self._done = True
+
+    def done(self):
+        """
+        :return: True if the response has been received
+        :rtype: bool
+        """
+        return self._done
+
+    def result(self):
+        """
+        :return: The response, converted with conv if one was given
+        """
+        if self.conv is None:
+            return self
+        return self.conv(self)
+
 
 class SCPIBlockData(object):
     def __init__(self, data=None):
         self.data = data
 
     @staticmethod
-    def parse(blk):
-        if blk[0] != "#":
+    def parse_header(blk):
+        """
+        Parse the header of a definite length block, #<n><length><data>
+
+        :return: (offset, length), the position and size of the data in blk
+        :rtype: (int, int)
+        """
+        if blk[0:1] != "#":
             print "WARN: invalid block data header"
-        n = int(blk[1])  # The number of digits in the data length specifier
-        l = int(blk[2:n + 2])  # data length
-        return blk[n + 2:l + n + 2]
+        n = int(str(blk[1:2]))  # The number of digits in the data length specifier
+        l = int(str(blk[2:n + 2]))  # data length
+        return n + 2, l
+
+    @staticmethod
+    def parse(blk):
+        """
+        :param blk: The block data, including the header
+        :type blk: str or bytearray
+        :return: The block contents. A memoryview into blk is returned if blk is a bytearray, to avoid copying.
+        :rtype: str or memoryview
+        """
+        offset, l = SCPIBlockData.parse_header(blk)
+        if isinstance(blk, bytearray):
+            return memoryview(blk)[offset:offset + l]
+        return blk[offset:offset + l]
+
+    @staticmethod
+    def header(length):
+        """
+        :param int length: The data length in bytes
+        :return: The definite length block header, #<n><length>
+        """
+        l = str(length)
+        return "#" + str(len(l)) + l
 
     @staticmethod
     def format(data):
-        l = str(len(data))
-        return "#" + str(len(l)) + l + data
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        return SCPIBlockData.header(len(data)) + data
 
     def __str__(self):
         return self.format(self.data)
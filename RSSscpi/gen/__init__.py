@@ -2,7 +2,8 @@
 
 from SCPI_gen_support import DummyVisa, SCPINodeBase
 from Instrument import Instrument
+from AsyncInstrument import AsyncInstrument
 from SCPI_property import SCPIProperty, SCPIPropertyMinMax, SCPIPropertyMapping
-from SCPI_response import SCPIResponse, SCPIBlockData
+from SCPI_response import SCPIResponse, SCPIBlockData, SCPIDeferredResponse, quote_string
 from ZNB_gen import ZNB_gen
 from ZVA_gen import ZVA_gen
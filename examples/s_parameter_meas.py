@@ -6,7 +6,6 @@
 
 from RSSscpi import ZNB
 
-import Queue
 import time, timeit
 
 from RSSscpi.gen.SCPI_gen_support import DummyVisa
@@ -65,32 +64,19 @@ tr_s22 = ch.create_trace("S22", "S22", dia1)
 # Calibrate
 
 #ch.cal_auto((1, 2))
-znb.INITiate.IMMediate.ALL.w()
-znb.OPC.w()
-
-
-def wait_for_event():
-    for x in range(100):  # wait for at most 10 seconds for completion
-        try:
-            return znb.event_queue.get(timeout=0.1)
-        except Queue.Empty:
-            print ".",
-            continue
-    return None
-
 print "Calibrating",
-opc = wait_for_event()
+znb.start_and_wait(znb.INITiate.IMMediate.ALL, timeout=10)
 print "done"
-#print opc
 
 # Make the measurement
-znb.INITiate.IMMediate.ALL.w()
-znb.OPC.w()
-
 print "Measuring",
-wait_for_event()
+znb.start_and_wait(znb.INITiate.IMMediate.ALL, timeout=10)
 print "done"
 
+# Read all four traces in one transfer
+freq, traces = ch.fetch_all_traces()
+print "S21 at %g Hz: %s" % (freq[0], traces["S21"][0])
+
 # Save the S-parameter data
 print ch.save_touchstone("test.s2p", ports=(1,2))
 # Final OPC before the program terminates
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""
+Throughput benchmarks for the command, query and trace transfer paths, run against the local
+instrument simulator in tools.simulator. The results are written as JSON, and can be compared with
+the results of an earlier run to spot regressions:
+
+python -m tools.benchmark --output before.json
+python -m tools.benchmark --compare before.json
+
+@author: Lukas Sandström
+"""
+
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+import timeit
+
+import numpy
+
+from RSSscpi import ZNB, SocketInterface
+from RSSscpi.gen import SCPIResponse
+from RSSscpi.gen.Instrument import SCPICmdFormatter
+from tools.simulator import InstrumentSimulator, block
+
+
+def measure(func, min_time=0.5, min_runs=3):
+    """
+    Call func repeatedly for at least min_time seconds.
+
+    :return: The fastest and the mean duration of a call in seconds
+    :rtype: (float, float)
+    """
+    times = []
+    start = timeit.default_timer()
+    while len(times) < min_runs or timeit.default_timer() - start < min_time:
+        t0 = timeit.default_timer()
+        func()
+        times.append(timeit.default_timer() - t0)
+    return min(times), sum(times) / len(times)
+
+
+def rate_result(n, func, min_time):
+    """
+    Benchmark func, which performs n operations per call.
+    """
+    best, mean = measure(func, min_time)
+    return {"ops": n, "best_s": best, "mean_s": mean, "ops_per_s": n / best}
+
+
+class BenchmarkSuite(object):
+    """
+    Each bench_ method returns a dict with the results of one benchmark, keyed by the benchmark name.
+    """
+    cmd_count = 200  # Commands per measurement in the command and query benchmarks
+    trace_points = [201, 10001, 100001]
+    block_sizes_mb = [1, 10, 100]
+
+    def __init__(self, latency=0.0, bandwidth=None, min_time=0.5, quick=False):
+        """
+        :param latency: Response latency of the simulator in seconds
+        :param bandwidth: Response bandwidth of the simulator in bytes/s, unlimited if None
+        :param min_time: Minimum duration of each measurement in seconds
+        :param quick: Use smaller block transfers, for a fast smoke test
+        """
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.min_time = min_time
+        if quick:
+            self.block_sizes_mb = [1, 10]
+        self.sim = None
+        self.znb = None
+
+    def setup(self):
+        self.sim = InstrumentSimulator(port=0, latency=self.latency, bandwidth=self.bandwidth).start()
+        self.znb = ZNB(SocketInterface("127.0.0.1", port=self.sim.port))
+        self.znb.error_attribution = ZNB.ERROR_ATTRIBUTION_CHEAP
+        self.znb.init()
+
+    def teardown(self):
+        self.znb._visa_res.close()
+        self.sim.stop()
+
+    def run(self):
+        results = {}
+        self.setup()
+        try:
+            for name in sorted(x for x in dir(self) if x.startswith("bench_")):
+                print >> sys.stderr, "Running", name[6:]
+                results.update(getattr(self, name)())
+        finally:
+            self.teardown()
+        return results
+
+    def bench_import(self):
+        """
+        Time to import RSSscpi in a fresh interpreter, including numpy and pyvisa.
+        """
+        code = "import timeit; t = timeit.default_timer(); import RSSscpi; print timeit.default_timer() - t"
+        times = [float(subprocess.check_output([sys.executable, "-c", code])) for _ in range(5)]
+        return {"import_RSSscpi": {"best_s": min(times), "mean_s": sum(times) / len(times)}}
+
+    def bench_write(self):
+        points = self.znb.SENSe(1).SWEep.POINts()
+
+        def run():
+            for _ in xrange(self.cmd_count):
+                points.w(201)
+            self.znb.OPC.q()  # Make sure the simulator has processed all commands
+        return {"SCPISet.w": rate_result(self.cmd_count, run, self.min_time)}
+
+    def bench_query(self):
+        points = self.znb.SENSe(1).SWEep.POINts()
+
+        def run():
+            for _ in xrange(self.cmd_count):
+                points.q()
+        return {"SCPIQuery.q": rate_result(self.cmd_count, run, self.min_time)}
+
+    def bench_property(self):
+        channel = self.znb.get_channel(1)
+
+        def get():
+            for _ in xrange(self.cmd_count):
+                channel.sweep_points
+
+        def set_():
+            for _ in xrange(self.cmd_count):
+                channel.sweep_points = 201
+            self.znb.OPC.q()
+        return {"SCPIProperty.get": rate_result(self.cmd_count, get, self.min_time),
+                "SCPIProperty.set": rate_result(self.cmd_count, set_, self.min_time)}
+
+    def bench_formatter(self):
+        cases = {
+            "number": ("{:s*}", ((201,),)),
+            "quoted": ("{:q*}", (("Trc1", "S21"),)),
+            "list": ("{:d}, {:q}, {:s}, {:s}, {:d*}", (1, "file.s4p", "COMPlex", "CIMPedance", [1, 2, 3, 4])),
+        }
+        n = 1000
+        results = {}
+        for name, (fmt, args) in cases.items():
+            def run():
+                for _ in xrange(n):
+                    SCPICmdFormatter().vformat(fmt, args, {})
+
+            def run_compiled():
+                for _ in xrange(n):
+                    SCPICmdFormatter.compile(fmt)(args, {})
+            results["SCPICmdFormatter." + name] = rate_result(n, run, self.min_time)
+            results["SCPICmdFormatter.compile." + name] = rate_result(n, run_compiled, self.min_time)
+        return results
+
+    def bench_numpy_complex(self):
+        """
+        Parse trace data responses of different sizes, without the transport.
+        """
+        results = {}
+        rng = numpy.random.RandomState(0)
+        for points in self.trace_points:
+            x = rng.normal(size=2 * points)
+            ascii_raw = ",".join(["%.10g" % v for v in x.tolist()]) + "\n"
+            real64_raw = bytearray(block(x.astype("<f8").tostring()) + "\n")
+            for fmt, raw, dtype in [("ASCii", ascii_raw, None), ("REAL64", real64_raw, numpy.dtype("<f8"))]:
+                results["SCPIResponse.numpy_complex.%s.%d" % (fmt, points)] = rate_result(
+                    1, lambda: SCPIResponse(raw, dtype).numpy_complex(), self.min_time)
+        return results
+
+    def bench_trace_query(self):
+        """
+        Query trace data of different sizes through the transport, CALCulate:DATA? SDATa
+        """
+        results = {}
+        data = self.znb.CALCulate(1).DATA()
+        for fmt in [ZNB.DATA_FORMAT_ASCII, ZNB.DATA_FORMAT_REAL64]:
+            self.znb.set_data_format(fmt)
+            for points in self.trace_points:
+                self.znb.get_channel(1).sweep_points = points
+                result = rate_result(1, lambda: data.q("SDATa").numpy_complex(), self.min_time)
+                result["points_per_s"] = points / result["best_s"]
+                results["CALCulate.DATA.%s.%d" % (fmt.replace(",", ""), points)] = result
+        self.znb.set_data_format(ZNB.DATA_FORMAT_ASCII)
+        self.znb.get_channel(1).sweep_points = 201
+        return results
+
+    def bench_block_transfer(self):
+        """
+        Read files of 1 - 100 MB with MMEMory:DATA?
+        """
+        results = {}
+        for mb in self.block_sizes_mb:
+            name = "bench_%dMB.bin" % mb
+            self.sim.instrument.add_file(name, "\xa5" * (mb * 2**20))
+            f = self.znb.filesystem.file(name)
+            result = rate_result(1, f.read, self.min_time)
+            result["MB_per_s"] = mb / result["best_s"]
+            results["MMEMory.DATA.read.%dMB" % mb] = result
+            self.sim.instrument.remove_file(name)
+        return results
+
+
+def compare(results, baseline):
+    """
+    Print the change of the best times relative to an earlier run.
+    """
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        new, old = results[name]["best_s"], baseline[name]["best_s"]
+        print >> sys.stderr, "%-45s %10.3g s %+7.1f %%" % (name, new, (new / old - 1) * 100)
+
+
+def main():
+    p = argparse.ArgumentParser(description="Benchmark RSSscpi against the local instrument simulator.")
+    p.add_argument("--output", help="Write the JSON results to this file instead of stdout")
+    p.add_argument("--compare", help="JSON results of an earlier run to compare with")
+    p.add_argument("--latency", type=float, default=0.0, help="Simulated response latency in seconds")
+    p.add_argument("--bandwidth", type=float, default=None, help="Simulated response bandwidth in bytes/s")
+    p.add_argument("--min-time", type=float, default=0.5, help="Minimum duration of each measurement")
+    p.add_argument("--quick", action="store_true", help="Skip the largest block transfers")
+    a = p.parse_args()
+
+    suite = BenchmarkSuite(a.latency, a.bandwidth, a.min_time, a.quick)
+    results = suite.run()
+    report = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "numpy": numpy.__version__,
+        "simulator": {"latency": a.latency, "bandwidth": a.bandwidth},
+        "results": results,
+    }
+    if a.compare:
+        with open(a.compare) as fd:
+            compare(results, json.load(fd)["results"])
+    if a.output:
+        with open(a.output, "w") as fd:
+            json.dump(report, fd, indent=2, sort_keys=True)
+    else:
+        print json.dumps(report, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
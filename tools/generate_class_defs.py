@@ -13,7 +13,10 @@ except ImportError:
     from urllib2 import urlopen, HTTPError
     from urllib import urlretrieve
 
-from bs4 import BeautifulSoup
+try:
+    from bs4 import BeautifulSoup  # Only needed for the webhelp URLs, CmdListParser works without it
+except ImportError:
+    BeautifulSoup = None
 import re
 
 
@@ -141,7 +144,7 @@ class RohdeZVAWebhelp(Webhelp):
 
         for u in soup("key"):
             # TODO: The second item in the list can contain "(deprecated)". Use this info?
-            cmd = u['name'].split()[0].translate(None, '"\\')
+            cmd = str(u['name']).split()[0].translate(None, '"\\')
             if not cmd[0:3].isupper():
                 continue  # All SCPI commands start with at least three capital letters
             cmd_key = str(cmd).translate(None, '[]?')
@@ -345,6 +348,125 @@ class ClassCodeGen(object):
             self._out("")
 
 
+class TableCodeGen(object):
+    """
+    Generates a Python module with the SCPI command tree stored as a data table. The node classes are created
+    on first access by RSSscpi.gen.SCPI_gen_support.lazy_instrument_class(), which makes the module much faster
+    to import and smaller in memory than the class definitions generated by ClassCodeGen.
+    """
+    def __init__(self, class_name, cmd_tree, io_obj, source, webhelp=Webhelp()):
+        """
+        See ClassCodeGen
+        """
+        self.cmd_tree = cmd_tree
+        self._output = io_obj
+        self._indent = 0
+        self.class_name = class_name
+        self.source = source
+        self.hlp = webhelp
+
+        self._urls = dict()  # SCPI command -> help URL
+        self._url_base = ""
+
+        self._cmd_cnt = 0
+        self._cmd_help_cnt = 0
+
+    def _preamble(self):
+        import time
+        self._out("# -*- coding: utf-8 -*-")
+        self._out("# Generated from " + self.source + " on " + time.strftime("%Y-%m-%d %H:%M"))
+        self._out("from SCPI_gen_support import lazy_instrument_class")
+        self._out("from . import Instrument")
+        self._out("")
+        self._out("_url_base = " + repr(self._url_base))
+        self._out("")
+        self._out("")
+        self._out("def _load_table():")
+        self._indent += 1
+        self._out('"""')
+        self._out("The command tree, {name: (SCPI command, node flags, arguments, help URL, {children})}")
+        self._out("See SCPILazyNodeType._materialize() for the node flags.")
+        self._out('"""')
+        self._out("return {")
+        self._indent += 1
+
+    def _postamble(self):
+        self._indent -= 1
+        self._out("}")
+        self._indent -= 1
+        self._out("")
+        self._out("")
+        self._out(self.class_name + " = lazy_instrument_class(" + repr(self.class_name) +
+                  ", Instrument, _load_table, _url_base, __name__)")
+
+    def _collect_urls(self, cmd_tree, parents):
+        for cmd_str in cmd_tree:
+            cmd_str_list = parents + [cmd_str]
+            url = self.hlp.get_help_url(cmd_str_list)
+            if url is not None:
+                self._urls[":".join(cmd_str_list)] = url
+            self._collect_urls(cmd_tree[cmd_str], cmd_str_list)
+
+    def gen(self):
+        import os.path
+        self._collect_urls(self.cmd_tree, [])
+        self._url_base = os.path.commonprefix(self._urls.values())
+        self._preamble()
+        self._gen(self.cmd_tree, [])
+        self._postamble()
+        self._out("# END OF " + self.class_name)
+        c1 = self._cmd_cnt
+        c2 = self._cmd_help_cnt
+        c3 = str(int(float(c2)/c1 * 100))
+        print self.class_name + ":", c1, "commands,", c2, "have a help URL (" + c3 + "%)."
+
+    def _out(self, str_):
+        if not str_:
+            self._output.write("\n")  # don't print lines with only indentation
+        else:
+            self._output.write(" "*(self._indent*4) + str_ + "\n")
+
+    def _gen(self, cmd_tree, parents):
+        """
+        Generates the table entries for the command tree.
+
+        :param cmd_tree:
+        :type cmd_tree: CmdNode
+        :param parents:
+        :type parents: list of str
+        """
+        for cmd_str in sorted(cmd_tree):
+            cmd = cmd_tree[cmd_str]
+            self._cmd_cnt += 1
+
+            flags = "N" if cmd.is_countable else ""  # See SCPILazyNodeType._materialize()
+            if "ON" in cmd.args:
+                flags += "B"
+            else:
+                if cmd.has_query:
+                    flags += "Q"
+                if cmd.has_set:
+                    flags += "S"
+
+            url = self._urls.get(":".join(parents + [cmd_str]))
+            if url is not None:
+                url = url[len(self._url_base):]
+                self._cmd_help_cnt += 1
+
+            name = cmd_str
+            if name[0] == '*' or name[0] == '@':
+                name = name[1:]
+            entry = "%r: (%r, %r, %r, %r, {" % (name, cmd_str, flags, tuple(cmd.args) or ("", ), url)
+            if not len(cmd):
+                self._out(entry + "}),")
+                continue
+            self._out(entry)
+            self._indent += 1
+            self._gen(cmd, parents + [cmd_str])
+            self._indent -= 1
+            self._out("}),")
+
+
 class ZNBTreePatcher(object):
     def __init__(self):
         self.fixit = dict()
@@ -368,13 +490,15 @@ class ZNBTreePatcher(object):
 
         return cmd_tree
 
-def generate_SCPI_class(input_file, module_name, webhelp=Webhelp(), tree_patcher=None):
+def generate_SCPI_class(input_file, module_name, webhelp=Webhelp(), tree_patcher=None, code_gen=TableCodeGen):
     """
 
     :param input_file: filename of the command list from GPIB Explorer
     :param module_name: Name of the module to be generated
     :param webhelp: Webhelp subclass instance, generating help URLs
     :param tree_patcher: Function used to fix errors in the command tree before the code generation
+    :param code_gen: TableCodeGen (default) for a lazily materialized command table, or ClassCodeGen for
+                     nested class definitions
     :return: None
     """
     parser = CmdListParser('SCPI_cmd_lists/' + input_file)
@@ -385,7 +509,7 @@ def generate_SCPI_class(input_file, module_name, webhelp=Webhelp(), tree_patcher
         cmd_tree = parser.cmd_tree
     path = "RSSscpi/gen/" + module_name + ".py"
     with open(path, 'wb') as fd:
-        g = ClassCodeGen(module_name, cmd_tree, fd, source=input_file, webhelp=webhelp)
+        g = code_gen(module_name, cmd_tree, fd, source=input_file, webhelp=webhelp)
         g.gen()
 
     import importlib
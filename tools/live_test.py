@@ -7,7 +7,7 @@ Created on Wed Feb 10 21:57:01 2016
 
 import visa
 rm = visa.ResourceManager()
-from RSSscpi import SocketInterface
+from RSSscpi import get_instrument
 
 znb_ip = "10.188.178.47"
 
@@ -15,12 +15,8 @@ znb_ip = "10.188.178.47"
 #zva_res = rm.open_resource('TCPIP::10.188.179.15::INSTR')
 #x = ZVA_gen(zva_res)
 
-from RSSscpi import ZNB
-
 #znb_res = rm.open_resource('TCPIP::10.188.178.47::INSTR')
-znb_res = SocketInterface(znb_ip)
-
-znb = ZNB(znb_res)
+znb = get_instrument(znb_ip)  # Reuses the connection and the ZNB object when run again in the same interpreter
 znb.init()
 
 print znb.IDN.q()
@@ -40,4 +36,5 @@ scr = znb.save_screenshot("scr.png")
 scr.get(".")
 
 
-znb_res.close()
+# The session stays open: the pool hands the same session to the next run in this interpreter.
+# Closing it would make get_instrument() reconnect every time.
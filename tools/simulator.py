@@ -0,0 +1,1236 @@
+# -*- coding: utf-8 -*-
+"""
+A local stand-in for a R&S ZNB, speaking SCPI over a raw socket like the real instrument on port 5025.
+
+The simulator is driven by the command tree parsed from the GPIB Explorer command list with CmdListParser,
+so it accepts the same long and short form headers as the instrument, and reports
+-113,"Undefined header;..." for anything else. Settings are stored per channel (per numeric suffix),
+trace data is synthesized for the configured SENSe<Ch>:SWEep:POINts and frequency range, and files written with
+MMEMory:DATA are kept in memory. Latency and bandwidth of the responses can be configured, to make benchmarks
+of the transports and the response parsing repeatable without an instrument.
+
+sim = InstrumentSimulator(port=0).start()
+znb = ZNB(SocketInterface("127.0.0.1", port=sim.port))
+...
+sim.stop()
+
+HiSLIPSimulator serves the same instrument over HiSLIP, including service requests.
+
+Run from the command line with: python -m tools.simulator --port 5025 --latency 0.0005
+
+@author: Lukas Sandström
+"""
+
+import SocketServer
+import argparse
+import itertools
+import ntpath
+import os
+import re
+import socket
+import struct
+import threading
+import timeit
+import time
+import zlib
+
+import numpy
+
+from RSSscpi.HiSLIPInterface import (ASYNC_DEVICE_CLEAR, ASYNC_DEVICE_CLEAR_ACKNOWLEDGE, ASYNC_INITIALIZE,
+                                     ASYNC_INITIALIZE_RESPONSE, ASYNC_LOCK, ASYNC_LOCK_RESPONSE,
+                                     ASYNC_MAXIMUM_MESSAGE_SIZE, ASYNC_MAXIMUM_MESSAGE_SIZE_RESPONSE,
+                                     ASYNC_REMOTE_LOCAL_CONTROL, ASYNC_REMOTE_LOCAL_RESPONSE, ASYNC_SERVICE_REQUEST,
+                                     ASYNC_STATUS_QUERY, ASYNC_STATUS_RESPONSE, DATA, DATA_END,
+                                     DEVICE_CLEAR_ACKNOWLEDGE, DEVICE_CLEAR_COMPLETE, ERROR, FATAL_ERROR, INITIALIZE,
+                                     INITIALIZE_RESPONSE, PROTOCOL_VERSION, TRIGGER, recv_message, send_message)
+from tools.generate_class_defs import CmdListParser, ZNBTreePatcher
+
+default_cmd_list = os.path.join(os.path.dirname(__file__), "..", "SCPI_cmd_lists", "ZNB_commands_2_70.inp")
+
+
+class SCPIError(Exception):
+    """
+    An error which is put in the error queue of the simulated instrument.
+    """
+    def __init__(self, code, msg):
+        super(SCPIError, self).__init__(code, msg)
+        self.code = code
+        self.msg = msg
+
+
+def _block_end(s, i):
+    """
+    :return: The index after the definite length block starting at s[i] == "#", or len(s) if the block is
+             incomplete or of indefinite length
+    """
+    n = s[i + 1:i + 2]
+    if not n.isdigit() or n == "0":
+        return len(s)
+    n = int(n)
+    length = s[i + 2:i + 2 + n]
+    if len(length) < n:
+        return len(s)
+    return i + 2 + n + int(length)
+
+
+_split_res = dict((sep, re.compile("[" + sep + "'\"#]")) for sep in ";,")
+
+
+def split_outside(s, sep):
+    """
+    Split s on sep, except inside quoted strings and block data.
+    """
+    parts = []
+    start = pos = 0
+    find = _split_res[sep].search
+    while True:
+        m = find(s, pos)
+        if not m:
+            break
+        i = m.start()
+        c = s[i]
+        if c == sep:
+            parts.append(s[start:i])
+            start = pos = i + 1
+        elif c == "#":
+            pos = _block_end(s, i)
+        else:
+            end = s.find(c, i + 1)
+            pos = end + 1 if end >= 0 else i + 1  # A quote without a closing quote is a literal character
+    parts.append(s[start:])
+    return parts
+
+
+def unquote(arg):
+    arg = arg.strip()
+    if len(arg) > 1 and arg[0] in "'\"" and arg[-1] == arg[0]:
+        return arg[1:-1].replace(arg[0] * 2, arg[0])  # Quotes inside the string are doubled
+    return arg
+
+
+def quote(string):
+    return "'" + string.replace("'", "''") + "'"
+
+
+def block(data):
+    """
+    Wrap data in a definite length block, #<n><length><data>
+    """
+    length = str(len(data))
+    return "#" + str(len(length)) + length + data
+
+
+def parse_block(arg):
+    arg = arg.lstrip()
+    if arg[:1] != "#":
+        raise SCPIError(-104, "Data type error;block data expected")
+    n = int(arg[1])
+    if n == 0:
+        return arg[2:]
+    return arg[2 + n:_block_end(arg, 0)]
+
+
+_units = {"": 1.0, "HZ": 1.0, "KHZ": 1e3, "MHZ": 1e6, "GHZ": 1e9, "S": 1.0, "MS": 1e-3, "US": 1e-6, "NS": 1e-9,
+          "DBM": 1.0, "DB": 1.0}
+
+
+def to_float(value):
+    """
+    Convert a numeric SCPI argument, with an optional unit, to float
+    """
+    m = re.match(r"\s*([-+0-9.eE]+)\s*([A-Za-z]*)", str(value))
+    if not m:
+        raise SCPIError(-104, "Data type error;" + str(value))
+    return float(m.group(1)) * _units.get(m.group(2).upper(), 1.0)
+
+
+class SimulatedInstrument(object):
+    """
+    The SCPI parser and the state of the simulated instrument. Not thread safe, the server serializes the access.
+    """
+    identity = "Rohde-Schwarz,ZNB8-4Port,1311601062100000,2.70"
+    default_dir = r"C:\Users\Public\Documents\Rohde-Schwarz\Vna"
+    disk_size = 64 * 2**30
+
+    defaults = {
+        "SENSe:SWEep:POINts": "201",
+        "SENSe:SWEep:TYPE": "LIN",
+        "SENSe:SWEep:COUNt": "1",
+        "SENSe:SWEep:TIME": "0.01",
+        "SENSe:FREQuency:STARt": "100000",
+        "SENSe:FREQuency:STOP": "8000000000",
+        "SENSe:BANDwidth:RESolution": "10000",
+        "SOURce:POWer:LEVel:IMMediate:AMPLitude": "0",
+        "INITiate:CONTinuous": "1",
+        "INSTrument:NSELect": "1",
+        "MMEMory:NAME": "'Hardcopy.png'",
+    }
+    """
+    Query responses for settings which haven't been set, "0" is used for anything else.
+    """
+
+    min_max = {
+        "SENSe:SWEep:POINts": ("1", "100001"),
+        "SENSe:FREQuency:STARt": ("100000", "8000000000"),
+        "SENSe:FREQuency:STOP": ("100000", "8000000000"),
+    }
+
+    extra_cmds = ["SYSTem:ERRor:ALL?", "SYSTem:ERRor:NEXT?", "SYSTem:ERRor?"]
+    """
+    Commands supported by the instrument, but missing from the command list
+    """
+
+    def __init__(self, cmd_list=default_cmd_list, tree_patcher=ZNBTreePatcher(), sweep_time=0.0, seed=0):
+        """
+        :param cmd_list: The GPIB Explorer command list defining the accepted commands
+        :param tree_patcher: Function used to fix errors in the command tree, see generate_class_defs
+        :param sweep_time: The time in seconds a sweep started with INITiate takes, *OPC? and *WAI wait for it
+        :param seed: Seed for the trace noise
+        """
+        parser = CmdListParser(cmd_list)
+        for cmd in self.extra_cmds:
+            parser._add_cmd(cmd)
+        self.cmd_tree = tree_patcher(parser.cmd_tree) if tree_patcher else parser.cmd_tree
+        self._lookup = {}  # id(CmdNode) -> {upper case long and short mnemonics: key}
+        self.sweep_time = sweep_time
+        self.seed = seed
+
+        self._queries = {
+            "*IDN": lambda idx, args: self.identity,
+            "*OPC": self._q_opc,
+            "*ESR": self._q_esr,
+            "*STB": self._q_stb,
+            "*ESE": lambda idx, args: str(self.ese),
+            "*SRE": lambda idx, args: str(self.sre),
+            "*OPT": lambda idx, args: "ZNB-K2,ZNB-K4",
+            "*TST": lambda idx, args: "0",
+            "SYSTem:ERRor:ALL": self._q_error_all,
+            "SYSTem:ERRor:NEXT": self._q_error_next,
+            "SYSTem:ERRor": self._q_error_next,
+            "FORMat:DATA": lambda idx, args: "REAL,%d" % (self.data_dtype.itemsize * 8) if self.data_dtype else "ASC,0",
+            "FORMat:BORDer": lambda idx, args: "SWAP" if self.byte_order == "<" else "NORM",
+            "CALCulate:DATA": self._q_calc_data,
+            "CALCulate:DATA:STIMulus": lambda idx, args: self.format_data(self.stimulus(idx[0])),
+            "CALCulate:DATA:ALL": self._q_calc_data_all,
+            "CALCulate:DATA:DALL": self._q_calc_data_all,
+            "CALCulate:DATA:CHANnel:ALL": self._q_calc_data_channel,
+            "CALCulate:DATA:CHANnel:DALL": self._q_calc_data_channel,
+            "CALCulate:DATA:CALL": self._q_calc_data_call,
+            "CALCulate:DATA:CALL:CATalog": lambda idx, args: quote(",".join(self.channel_s_params(idx[0]))),
+            "CALCulate:DATA:NSWeep": self._q_nsweep_last,
+            "CALCulate:DATA:NSWeep:LAST": self._q_nsweep_last,
+            "CALCulate:DATA:NSWeep:FIRSt": self._q_nsweep_first,
+            "CALCulate:DATA:NSWeep:COUNt": lambda idx, args: str(self.nsweep_count(idx[0])),
+            "CALCulate:DATA:TRACe": self._q_calc_data_trace,
+            "CALCulate:FORMat": lambda idx, args: self._selected_trace(idx[0])["format"],
+            "CALCulate:MARKer:STATe": lambda idx, args: "1" if self._marker(idx)["state"] else "0",
+            "CALCulate:MARKer:X": lambda idx, args: repr(self._marker(idx)["x"]),
+            "CALCulate:MARKer:Y": self._q_marker_y,
+            "CALCulate:LIMit:FAIL": self._q_limit_fail,
+            "CALCulate:LIMit:STATe": lambda idx, args: "1" if self._selected_trace(idx[0])["limit_check"] else "0",
+            "CALCulate:PARameter:CATalog": self._q_par_catalog,
+            "CALCulate:PARameter:SELect": lambda idx, args: quote(self._selected_name(idx[0])),
+            "CALCulate:PARameter:MEASure": lambda idx, args: quote(self._trace(unquote(args[0]))["param"]),
+            "SENSe:SEGMent:COUNt": lambda idx, args: str(self.segments.get(idx[0], 0)),
+            "CONFigure:TRACe:CATalog": lambda idx, args: quote(",".join(
+                "%d,%s" % (i + 1, name) for i, name in enumerate(self.trace_order))),
+            "CONFigure:TRACe:NAME:ID": lambda idx, args: str(self.trace_order.index(self._trace_name(args)) + 1),
+            "CONFigure:TRACe:CHANnel:NAME:ID": lambda idx, args: str(self._trace(unquote(args[0]))["channel"]),
+            "CONFigure:CHANnel:CATalog": self._q_channel_catalog,
+            "MMEMory:CDIRectory": lambda idx, args: quote(self.cwd),
+            "MMEMory:CATalog": self._q_mmem_catalog,
+            "MMEMory:DATA": lambda idx, args: block(self._file(args)[1]),
+        }
+        self._setters = {
+            "*RST": lambda idx, args: self.reset(),
+            "*CLS": self._clear_status,
+            "*OPC": self._opc,
+            "*WAI": lambda idx, args: self._wait_sweep(),
+            "*ESE": self._ese,
+            "*SRE": self._sre,
+            "FORMat:DATA": self._format_data,
+            "FORMat:BORDer": self._format_border,
+            "INITiate:IMMediate": self._init_immediate,
+            "CALCulate:FORMat": self._calc_format,
+            "CALCulate:MARKer:STATe": self._marker_state,
+            "CALCulate:MARKer:X": self._marker_x,
+            "CALCulate:MARKer:AOFF": lambda idx, args: self._selected_trace(idx[0])["markers"].clear(),
+            "CALCulate:LIMit:DATA": self._limit_data,
+            "CALCulate:LIMit:DELete:ALL": self._limit_delete_all,
+            "CALCulate:LIMit:STATe": self._limit_state,
+            "CALCulate:PARameter:SDEFine": self._par_sdefine,
+            "CALCulate:PARameter:MEASure": self._par_measure,
+            "CALCulate:PARameter:SELect": self._par_select,
+            "CALCulate:PARameter:DELete": self._par_delete,
+            "CALCulate:PARameter:DELete:ALL": self._par_delete_all,
+            "CONFigure:TRACe:REName": self._trace_rename,
+            "SENSe:SEGMent:INSert": self._segment_insert,
+            "SENSe:SEGMent:DELete": self._segment_delete,
+            "SENSe:SEGMent:DELete:ALL": lambda idx, args: self._segment_delete_all(idx[0]),
+            "MMEMory:CDIRectory": self._mmem_cdir,
+            "MMEMory:DATA": self._mmem_data,
+            "MMEMory:DELete": self._mmem_delete,
+            "MMEMory:COPY": self._mmem_copy,
+            "MMEMory:MOVE": self._mmem_move,
+            "MMEMory:MDIRectory": self._mmem_mdir,
+            "MMEMory:RDIRectory": self._mmem_rdir,
+            "MMEMory:STORe:TRACe:PORTs": self._mmem_store_ports,
+            "HCOPy:IMMediate": self._hcopy,
+        }
+
+        self.errors = []
+        self.esr = 0
+        self.ese = 0
+        self.sre = 0
+        self.files = {}  # ntpath.normcase(full path) -> (full path, data)
+        self.dirs = {ntpath.normcase(self.default_dir): self.default_dir}
+        self.reset()
+
+    def reset(self):
+        """
+        *RST, restore the default instrument setup. Files and the error queue are kept.
+        """
+        self.state = {}  # (path, indices) -> value
+        self.traces = {}  # trace name -> {"channel": int, "param": str, "format": str}
+        self.trace_order = []
+        self.selected = {}  # channel -> selected trace name
+        self.sweep_cnt = {}  # channel -> number of completed sweeps
+        self.segments = {}  # channel -> number of sweep segments
+        self.busy_until = 0.0
+        self.data_dtype = None
+        self.byte_order = "<"
+        self.cwd = self.default_dir
+        self._add_trace("Trc1", 1, "S21")
+
+    # Command parsing
+
+    def _mnemonics(self, node):
+        try:
+            return self._lookup[id(node)]
+        except KeyError:
+            d = {}
+            for key in node.keys():
+                if key == node.leaf:
+                    continue
+                d[key.upper()] = key
+                d[re.match(r"[^a-z]*", key).group().upper()] = key  # The short form
+            self._lookup[id(node)] = d
+            return d
+
+    _mnemonic_re = re.compile(r"([*@]?[A-Za-z_]+?)(\d*)$")
+
+    def resolve(self, header):
+        """
+        Look up a command header in the command tree.
+
+        :param header: An absolute command header, like SENS2:SWE:POIN
+        :return: (node, path, indices), path is the long form without suffixes, SENSe:SWEep:POINts, indices contains
+                 the suffix of each countable node in the path, 1 if omitted.
+        """
+        node = self.cmd_tree
+        path = []
+        indices = []
+        for token in header.split(":"):
+            m = self._mnemonic_re.match(token)
+            key = m and self._mnemonics(node).get(m.group(1).upper())
+            if not key:
+                raise SCPIError(-113, "Undefined header")
+            node = node[key]
+            path.append(key)
+            if node.is_countable:
+                indices.append(int(m.group(2) or 1))
+            elif m.group(2):
+                raise SCPIError(-113, "Undefined header")
+        return node, ":".join(path), tuple(indices)
+
+    def process(self, message):
+        """
+        Execute a program message, which may contain several commands separated by semicolons.
+
+        :param message: The message, without the terminating newline
+        :return: The response, or None if the message didn't contain any queries
+        """
+        responses = []
+        prefix = ""
+        for unit in split_outside(message, ";"):
+            unit = unit.strip()
+            if not unit:
+                continue
+            header, _, args = unit.partition(" ")
+            if header[0] == ":":
+                header = header[1:]
+            elif header[0] != "*":
+                header = prefix + header  # Relative to the previous command, IEEE 488.2 7.6.1
+            if header[0] != "*":
+                prefix = header[:header.rfind(":") + 1]
+            try:
+                r = self.execute(header, args)
+            except SCPIError as e:
+                self.add_error(e.code, e.msg + ";" + unit.lstrip(":"))
+                continue
+            if r is not None:
+                responses.append(r)
+        if responses:
+            return ";".join(responses)
+        return None
+
+    def execute(self, header, args):
+        """
+        Execute a single command.
+
+        :param header: The absolute command header, ending with ? for queries
+        :param args: The argument string
+        :return: The response of queries, otherwise None
+        """
+        is_query = header[-1] == "?"
+        if is_query:
+            header = header[:-1]
+        node, path, idx = self.resolve(header)
+        args = [x.strip() for x in split_outside(args, ",")] if args.strip() else []
+        if is_query:
+            if not node.has_query:
+                raise SCPIError(-113, "Undefined header")
+            handler = self._queries.get(path)
+            if handler:
+                return handler(idx, args)
+            return self.get_setting(path, idx, args)
+        if not node.has_set:
+            raise SCPIError(-113, "Undefined header")
+        handler = self._setters.get(path)
+        if handler:
+            handler(idx, args)
+        else:
+            self.set_setting(path, idx, args)
+
+    def get_setting(self, path, idx, args=()):
+        if args and path in self.min_max and args[0].upper()[:3] in ("MIN", "MAX"):
+            return self.min_max[path][args[0].upper()[:3] == "MAX"]
+        return self.state.get((path, idx), self.defaults.get(path, "0"))
+
+    def set_setting(self, path, idx, args):
+        value = ",".join(args)
+        if value.upper() in ("ON", "OFF"):
+            value = "1" if value.upper() == "ON" else "0"
+        elif path in self.min_max and value.upper()[:3] in ("MIN", "MAX", "DEF"):
+            value = self.defaults[path] if value.upper()[:3] == "DEF" else self.get_setting(path, idx, args)
+        self.state[(path, idx)] = value
+
+    def setting_float(self, path, idx):
+        return to_float(self.get_setting(path, idx))
+
+    # Status reporting
+
+    def add_error(self, code, msg):
+        self.errors.append((code, msg))
+        self.esr |= 32 if -200 < code <= -100 else 16
+
+    def _q_error_all(self, idx, args):
+        errors, self.errors = self.errors, []
+        if not errors:
+            return '0,"No error"'
+        return ",".join('%d,"%s"' % e for e in errors)
+
+    def _q_error_next(self, idx, args):
+        if not self.errors:
+            return '0,"No error"'
+        return '%d,"%s"' % self.errors.pop(0)
+
+    def _clear_status(self, idx, args):
+        self.errors = []
+        self.esr = 0
+
+    def _wait_sweep(self):
+        delay = self.busy_until - timeit.default_timer()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _q_opc(self, idx, args):
+        self._wait_sweep()
+        return "1"
+
+    def _opc(self, idx, args):
+        self._wait_sweep()  # The operation complete bit is set when the pending sweeps have finished
+        self.esr |= 1
+
+    def _q_esr(self, idx, args):
+        esr, self.esr = self.esr, 0
+        return str(esr)
+
+    def status_byte(self):
+        """
+        The status byte, with the error queue (4), event status (32) and request service (64) bits.
+        """
+        stb = 4 if self.errors else 0
+        if self.esr & self.ese:
+            stb |= 32
+        if stb & self.sre:
+            stb |= 64
+        return stb
+
+    def _q_stb(self, idx, args):
+        return str(self.status_byte())
+
+    def _ese(self, idx, args):
+        self.ese = int(to_float(args[0]))
+
+    def _sre(self, idx, args):
+        self.sre = int(to_float(args[0]))
+
+    # Data format
+
+    def _format_data(self, idx, args):
+        fmt = args[0].upper()
+        if fmt.startswith("ASC"):
+            self.data_dtype = None
+        elif fmt.startswith("REAL"):
+            bits = int(args[1]) if len(args) > 1 else 32
+            if bits not in (32, 64):
+                raise SCPIError(-224, "Illegal parameter value")
+            self.data_dtype = numpy.dtype("f%d" % (bits // 8))
+        else:
+            raise SCPIError(-224, "Illegal parameter value")
+
+    def _format_border(self, idx, args):
+        self.byte_order = "<" if args[0].upper().startswith("SWAP") else ">"
+
+    def format_data(self, x):
+        """
+        Format an array according to FORMat:DATA and FORMat:BORDer
+        """
+        x = numpy.asarray(x).ravel()
+        if self.data_dtype is None:
+            return ",".join(["%.10g" % v for v in x.tolist()])
+        return block(x.astype(self.data_dtype.newbyteorder(self.byte_order)).tostring())
+
+    # Channels, traces and trace data
+
+    def _add_trace(self, name, channel, param):
+        if name not in self.traces:
+            self.trace_order.append(name)
+        self.traces[name] = {"channel": channel, "param": param.upper(), "format": "MLOG", "markers": {},
+                             "limits": [], "limit_check": False}
+        self.selected[channel] = name
+
+    def _trace(self, name):
+        try:
+            return self.traces[name]
+        except KeyError:
+            raise SCPIError(-114, "Header suffix out of range")
+
+    def _trace_name(self, args):
+        if not args:
+            raise SCPIError(-109, "Missing parameter")
+        name = unquote(args[0])
+        self._trace(name)
+        return name
+
+    def _selected_name(self, channel):
+        name = self.selected.get(channel)
+        if name not in self.traces:
+            raise SCPIError(-114, "Header suffix out of range")
+        return name
+
+    def _selected_trace(self, channel):
+        return self.traces[self._selected_name(channel)]
+
+    def channel_traces(self, channel):
+        return [name for name in self.trace_order if self.traces[name]["channel"] == channel]
+
+    def _par_sdefine(self, idx, args):
+        if len(args) < 2:
+            raise SCPIError(-109, "Missing parameter")
+        self._add_trace(unquote(args[0]), idx[0], unquote(args[1]))
+
+    def _par_measure(self, idx, args):
+        self._trace(unquote(args[0]))["param"] = unquote(args[1]).upper()
+
+    def _par_select(self, idx, args):
+        name = self._trace_name(args)
+        if self.traces[name]["channel"] != idx[0]:
+            raise SCPIError(-114, "Header suffix out of range")
+        self.selected[idx[0]] = name
+
+    def _par_delete(self, idx, args):
+        name = self._trace_name(args)
+        del self.traces[name]
+        self.trace_order.remove(name)
+
+    def _par_delete_all(self, idx, args):
+        for name in self.channel_traces(idx[0]):
+            self._par_delete(idx, [name])
+
+    def _trace_rename(self, idx, args):
+        old = self._trace_name(args)
+        new = unquote(args[1])
+        self.traces[new] = self.traces.pop(old)
+        self.trace_order[self.trace_order.index(old)] = new
+        for ch, name in self.selected.items():
+            if name == old:
+                self.selected[ch] = new
+
+    def _calc_format(self, idx, args):
+        self._selected_trace(idx[0])["format"] = args[0].upper()
+
+    def _marker(self, idx):
+        """
+        :return: The marker CALCulate<Ch>:MARKer<Mk> of the selected trace, {"state": bool, "x": float}
+        """
+        markers = self._selected_trace(idx[0])["markers"]
+        if idx[1] not in markers:
+            f = self.stimulus(idx[0])
+            markers[idx[1]] = {"state": False, "x": float(f[len(f) // 2])}
+        return markers[idx[1]]
+
+    def _marker_state(self, idx, args):
+        self._marker(idx)["state"] = args[0].upper() in ("1", "ON")
+
+    def _marker_x(self, idx, args):
+        marker = self._marker(idx)
+        marker["x"] = to_float(args[0])
+        marker["state"] = True  # Setting the position creates the marker
+
+    def _q_marker_y(self, idx, args):
+        marker = self._marker(idx)
+        if not marker["state"]:
+            raise SCPIError(-200, "Execution error;marker not enabled")
+        f = self.stimulus(idx[0])
+        y = self.fdata(self._selected_name(idx[0]))[numpy.abs(f - marker["x"]).argmin()]
+        return ",".join(repr(float(v)) for v in numpy.atleast_1d(y))
+
+    # Limit lines of the selected trace, segments (type, start, stop, start value, stop value)
+
+    def _limit_data(self, idx, args):
+        if not args or len(args) % 5:
+            raise SCPIError(-109, "Missing parameter")
+        values = [to_float(x) for x in args]
+        self._selected_trace(idx[0])["limits"].extend(
+            (int(values[i]), ) + tuple(values[i + 1:i + 5]) for i in xrange(0, len(values), 5))
+
+    def _limit_delete_all(self, idx, args):
+        self._selected_trace(idx[0])["limits"] = []
+
+    def _limit_state(self, idx, args):
+        self._selected_trace(idx[0])["limit_check"] = args[0].upper() in ("1", "ON")
+
+    def _q_limit_fail(self, idx, args):
+        trace = self._selected_trace(idx[0])
+        if not trace["limit_check"]:
+            return "0"
+        f = self.stimulus(idx[0])
+        y = numpy.asarray(self.fdata(self._selected_name(idx[0])), numpy.float64)
+        for line_type, start, stop, start_value, stop_value in trace["limits"]:
+            inside = (f >= start) & (f <= stop)
+            if stop > start:
+                limit = start_value + (f[inside] - start) * (stop_value - start_value) / (stop - start)
+            else:
+                limit = min(start_value, stop_value) if line_type == 1 else max(start_value, stop_value)
+            if line_type == 1 and numpy.any(y[inside] > limit) or line_type == 2 and numpy.any(y[inside] < limit):
+                return "1"
+        return "0"
+
+    # Sweep segments, the segment settings are stored in self.state with the indices (channel, segment)
+
+    def _segment_settings(self, channel):
+        return [key for key in self.state if key[0].startswith("SENSe:SEGMent:") and len(key[1]) == 2
+                and key[1][0] == channel]
+
+    def _move_segments(self, channel, first, offset):
+        """
+        Renumber the settings of the segments from number first and up by offset.
+        """
+        moved = {}
+        for key in self._segment_settings(channel):
+            if key[1][1] >= first:
+                moved[(key[0], (channel, key[1][1] + offset))] = self.state.pop(key)
+        self.state.update(moved)
+
+    def _segment_insert(self, idx, args):
+        ch, n = idx[0], idx[1]
+        count = self.segments.get(ch, 0)
+        if not 1 <= n <= count + 1:
+            raise SCPIError(-222, "Data out of range;segment %d" % n)
+        if len(args) < 7:
+            raise SCPIError(-109, "Missing parameter")
+        args = args + ["AUTO", "NORMal", "STEPped"][len(args) - 7:]
+        start, stop, points, power, time, _, ifbw, _, selectivity, mode = args[:10]
+        points, ifbw = int(to_float(points)), to_float(ifbw)
+        time = points / ifbw if time.upper() == "AUTO" else to_float(time)
+        self._move_segments(ch, n, 1)
+        for path, value in (("FREQuency:STARt", repr(to_float(start))), ("FREQuency:STOP", repr(to_float(stop))),
+                            ("SWEep:POINts", str(points)), ("POWer", repr(to_float(power))),
+                            ("SWEep:TIME", repr(time)), ("BWIDth:RESolution", repr(ifbw)),
+                            ("BWIDth:RESolution:SELect", re.match(r"[^a-z]*", selectivity).group().upper()),
+                            ("SWEep:GENeration", re.match(r"[^a-z]*", mode).group().upper()), ("STATe", "1")):
+            self.state[("SENSe:SEGMent:" + path, (ch, n))] = value
+        self.segments[ch] = count + 1
+
+    def _segment_delete(self, idx, args):
+        ch, n = idx[0], idx[1]
+        if not 1 <= n <= self.segments.get(ch, 0):
+            raise SCPIError(-222, "Data out of range;segment %d" % n)
+        for key in self._segment_settings(ch):
+            if key[1][1] == n:
+                del self.state[key]
+        self._move_segments(ch, n + 1, -1)
+        self.segments[ch] -= 1
+
+    def _segment_delete_all(self, channel):
+        for key in self._segment_settings(channel):
+            del self.state[key]
+        self.segments[channel] = 0
+
+    def _q_par_catalog(self, idx, args):
+        return quote(",".join("%s,%s" % (name, self.traces[name]["param"]) for name in self.channel_traces(idx[0])))
+
+    def _q_channel_catalog(self, idx, args):
+        channels = sorted(set(t["channel"] for t in self.traces.values()))
+        return quote(",".join("%d,Ch%d" % (ch, ch) for ch in channels))
+
+    def _init_immediate(self, idx, args):
+        ch = idx[0]
+        self.sweep_cnt[ch] = self.sweep_cnt.get(ch, 0) + int(self.setting_float("SENSe:SWEep:COUNt", (ch,)))
+        self.busy_until = max(self.busy_until, timeit.default_timer()) + self.sweep_time
+
+    def stimulus(self, channel):
+        """
+        :return: The stimulus frequencies of the channel, according to the SENSe<Ch>:SWEep:POINts and
+                 SENSe<Ch>:FREQuency settings
+        """
+        idx = (channel, 1)
+        points = int(self.setting_float("SENSe:SWEep:POINts", idx[:1]))
+        start = self.setting_float("SENSe:FREQuency:STARt", idx)
+        stop = self.setting_float("SENSe:FREQuency:STOP", idx)
+        if self.get_setting("SENSe:SWEep:TYPE", idx[:1]).upper().startswith("LOG"):
+            return numpy.logspace(numpy.log10(start), numpy.log10(stop), points)
+        return numpy.linspace(start, stop, points)
+
+    @staticmethod
+    def s_parameter(f, i, j):
+        """
+        The simulated DUT: reflection parameters are a mismatched load, transmission parameters a lossy line
+        with 2 ns delay.
+        """
+        if i == j:
+            return 0.1 + 0.05 * i * numpy.exp(-2j * numpy.pi * f * 0.5e-9)
+        return 10 ** (-(1 + 2 * f / 1e10) / 20) * numpy.exp(-2j * numpy.pi * f * 2e-9)
+
+    def sdata(self, name, sweep=None):
+        """
+        The complex trace data of a trace, with a little noise which is different in each sweep.
+
+        :param sweep: The sweep number, counted from 1 since *RST. The latest sweep if None.
+        """
+        trace = self._trace(name)
+        f = self.stimulus(trace["channel"])
+        m = re.match(r"S(\d)(\d)", trace["param"])
+        s = self.s_parameter(f, *((int(m.group(1)), int(m.group(2))) if m else (2, 1)))
+        if sweep is None:
+            sweep = self.sweep_cnt.get(trace["channel"], 0)
+        rng = numpy.random.RandomState((self.seed * 1000003 + sweep * 7919 + zlib.crc32(name)) & 0xffffffff)
+        noise = rng.normal(scale=1e-3, size=(len(f), 2))
+        return s + noise[:, 0] + 1j * noise[:, 1]
+
+    def fdata(self, name, sweep=None):
+        """
+        The formatted trace data, according to CALCulate:FORMat
+        """
+        s = self.sdata(name, sweep)
+        fmt = self.traces[name]["format"][:4]
+        if fmt == "MLIN":
+            return numpy.abs(s)
+        if fmt == "PHAS":
+            return numpy.angle(s, deg=True)
+        if fmt == "REAL":
+            return s.real
+        if fmt == "IMAG":
+            return s.imag
+        if fmt in ("POL", "SMIT", "ISM"):
+            return numpy.column_stack((s.real, s.imag))
+        return 20 * numpy.log10(numpy.abs(s))
+
+    def trace_data(self, name, fmt, sweep=None):
+        fmt = fmt.upper()
+        if fmt.startswith("FDAT"):
+            return self.fdata(name, sweep)
+        return self.sdata(name, sweep).view(numpy.float64)  # Interleaved real and imaginary parts
+
+    def _q_calc_data(self, idx, args):
+        if not args:
+            raise SCPIError(-109, "Missing parameter")
+        return self.format_data(self.trace_data(self._selected_name(idx[0]), args[0]))
+
+    def nsweep_count(self, channel):
+        """
+        :return: The number of sweeps available with CALCulate<Ch>:DATA:NSWeep, from the last INITiate
+        """
+        return min(self.sweep_cnt.get(channel, 0), int(self.setting_float("SENSe:SWEep:COUNt", (channel,))))
+
+    def _q_nsweep(self, idx, args, first):
+        if len(args) < 2:
+            raise SCPIError(-109, "Missing parameter")
+        n = int(to_float(args[1]))
+        available = self.nsweep_count(idx[0])
+        if not 1 <= n <= available:
+            raise SCPIError(-222, "Data out of range")
+        total = self.sweep_cnt[idx[0]]
+        sweep = total - available + n if first else total - n + 1
+        return self.format_data(self.trace_data(self._selected_name(idx[0]), args[0], sweep))
+
+    def _q_nsweep_first(self, idx, args):
+        return self._q_nsweep(idx, args, first=True)
+
+    def _q_nsweep_last(self, idx, args):
+        return self._q_nsweep(idx, args, first=False)
+
+    def _q_traces_data(self, names, args):
+        if not args:
+            raise SCPIError(-109, "Missing parameter")
+        data = [self.trace_data(name, args[0]) for name in names]
+        return self.format_data(numpy.concatenate(data) if data else [])
+
+    def _q_calc_data_all(self, idx, args):
+        return self._q_traces_data(self.trace_order, args)
+
+    def _q_calc_data_channel(self, idx, args):
+        return self._q_traces_data(self.channel_traces(idx[0]), args)
+
+    def channel_s_params(self, channel):
+        """
+        :return: The S-parameters measured in the channel, in the order of CALCulate<Ch>:DATA:CALL?
+        """
+        params = set(self.traces[name]["param"] for name in self.channel_traces(channel))
+        return sorted(p for p in params if re.match(r"S\d\d$", p))
+
+    def _q_calc_data_call(self, idx, args):
+        traces = dict((self.traces[name]["param"], name) for name in self.channel_traces(idx[0]))
+        return self._q_traces_data([traces[p] for p in self.channel_s_params(idx[0])], args)
+
+    def _q_calc_data_trace(self, idx, args):
+        if len(args) < 2:
+            raise SCPIError(-109, "Missing parameter")
+        return self.format_data(self.trace_data(self._trace_name(args), args[1]))
+
+    # Mass memory
+
+    def full_path(self, path):
+        return ntpath.normpath(ntpath.join(self.cwd, unquote(path)))
+
+    def add_file(self, path, data):
+        """
+        Store a file on the simulated instrument, like MMEMory:DATA.
+        """
+        path = self.full_path(path)
+        if ntpath.normcase(ntpath.dirname(path)) not in self.dirs:
+            raise SCPIError(-250, "Mass storage error;directory not found")
+        self.files[ntpath.normcase(path)] = (path, str(data))
+
+    def remove_file(self, path):
+        del self.files[ntpath.normcase(self.full_path(path))]
+
+    def _file(self, args):
+        if not args:
+            raise SCPIError(-109, "Missing parameter")
+        try:
+            return self.files[ntpath.normcase(self.full_path(args[0]))]
+        except KeyError:
+            raise SCPIError(-256, "File name not found")
+
+    def _mmem_data(self, idx, args):
+        if len(args) < 2:
+            raise SCPIError(-109, "Missing parameter")
+        self.add_file(args[0], parse_block(args[1]))
+
+    def _mmem_delete(self, idx, args):
+        self.remove_file(self._file(args)[0])
+
+    def _mmem_copy(self, idx, args):
+        path, data = self._file(args)
+        target = self.full_path(args[1])
+        if ntpath.normcase(target) in self.dirs:
+            target = ntpath.join(target, ntpath.basename(path))
+        self.add_file(target, data)
+
+    def _mmem_move(self, idx, args):
+        self._mmem_copy(idx, args)
+        self._mmem_delete(idx, args)
+
+    def _mmem_cdir(self, idx, args):
+        if not args or args[0].upper().startswith("DEF"):
+            self.cwd = self.default_dir
+            return
+        path = self.full_path(args[0])
+        if ntpath.normcase(path) not in self.dirs:
+            raise SCPIError(-250, "Mass storage error;directory not found")
+        self.cwd = path
+
+    def _mmem_mdir(self, idx, args):
+        path = self.full_path(args[0])
+        self.dirs[ntpath.normcase(path)] = path
+
+    def _mmem_rdir(self, idx, args):
+        path = ntpath.normcase(self.full_path(args[0]))
+        if path not in self.dirs:
+            raise SCPIError(-250, "Mass storage error;directory not found")
+        del self.dirs[path]
+
+    def _q_mmem_catalog(self, idx, args):
+        path = ntpath.normcase(self.full_path(args[0]) if args else self.cwd)
+        if path not in self.dirs:
+            raise SCPIError(-250, "Mass storage error;directory not found")
+        entries = [(".", "<DIR>", ""), ("..", "<DIR>", "")]
+        for d in sorted(self.dirs.values()):
+            if ntpath.normcase(ntpath.dirname(d)) == path:
+                entries.append((ntpath.basename(d), "<DIR>", ""))
+        used = 0
+        for f, data in sorted(self.files.values()):
+            used += len(data)
+            if ntpath.normcase(ntpath.dirname(f)) == path:
+                entries.append((ntpath.basename(f), "", len(data)))
+        # <used>, <free>, followed by <name>, <DIR> or empty, <size>, for each entry
+        return quote("%d, %d, " % (used, self.disk_size - used) + "".join("%s, %s, %s," % e for e in entries))
+
+    def _mmem_store_ports(self, idx, args):
+        if len(args) < 5:
+            raise SCPIError(-109, "Missing parameter")
+        ch = int(to_float(args[0]))
+        ports = [int(to_float(x)) for x in args[4:]]
+        f = self.stimulus(ch)
+        lines = ["! Simulated %s" % self.identity, "# HZ S RI R 50"]
+        s = [self.s_parameter(f, i, j) for i in ports for j in ports]
+        for n in xrange(len(f)):
+            lines.append(" ".join(["%.6f" % f[n]] + ["%.9g %.9g" % (x[n].real, x[n].imag) for x in s]))
+        self.add_file(args[1], "\n".join(lines) + "\n")
+
+    def _hcopy(self, idx, args):
+        self.add_file(self.get_setting("MMEMory:NAME", ()), "\x89PNG\r\n\x1a\n" + "\0" * 1024)
+
+
+class _SCPIRequestHandler(SocketServer.BaseRequestHandler):
+    """
+    Reads newline terminated program messages from the connection and writes the responses.
+    """
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.rfile = self.request.makefile("rb", 65536)
+        with self.server.lock:
+            self.server.connections.add(self.request)
+
+    def finish(self):
+        with self.server.lock:
+            self.server.connections.discard(self.request)
+        self.rfile.close()
+
+    def read_message(self):
+        """
+        Read a program message, including any newlines inside block data. A quote without a closing quote
+        before the end of the line is a literal character, as in Bob's.txt.
+
+        :return: The message without the terminating newline, or None if the connection was closed
+        """
+        msg = self.rfile.readline()
+        if not msg:
+            return None
+        pos = 0
+        while True:
+            m = _special_re.search(msg, pos)
+            if not m:
+                break
+            i = m.start()
+            if msg[i] == "#":
+                n = msg[i + 1:i + 2]
+                if not n.isdigit() or n == "0":  # Indefinite length block, terminated by the newline
+                    break
+                header_end = i + 2 + int(n)
+                end = header_end + int(msg[i + 2:header_end] or 0)
+                if end >= len(msg):  # The block data contains newlines, read the rest of the block and message
+                    msg += self.rfile.read(end - len(msg))
+                    msg += self.rfile.readline()
+                pos = end
+            else:
+                end = msg.find(msg[i], i + 1)
+                pos = end + 1 if end >= 0 else i + 1
+        return msg[:-1] if msg[-1:] == "\n" else msg
+
+    def handle(self):
+        try:
+            self._handle()
+        except socket.error:
+            pass  # The connection was closed
+
+    def _handle(self):
+        server = self.server
+        while True:
+            msg = self.read_message()
+            if msg is None:
+                return
+            with server.lock:
+                response = server.instrument.process(msg)
+            if response is None:
+                continue
+            response += "\n"
+            delay = server.latency
+            if server.bandwidth:
+                delay += len(response) / float(server.bandwidth)
+            if delay > 0:
+                time.sleep(delay)
+            self.request.sendall(response)
+
+
+_special_re = re.compile(r"['\"#]")
+
+
+class _Server(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class InstrumentSimulator(object):
+    """
+    A TCP server accepting SCPI connections for a SimulatedInstrument. All connections share the same
+    instrument state, as on the real instrument.
+    """
+    def __init__(self, host="127.0.0.1", port=5025, latency=0.0, bandwidth=None, instrument=None):
+        """
+        :param host: The address to listen on
+        :param port: The port to listen on, 0 selects a free port, see InstrumentSimulator.port
+        :param latency: Delay in seconds before each response is sent
+        :param bandwidth: Response bandwidth limit in bytes per second, unlimited if None
+        :param instrument: The simulated instrument, a new SimulatedInstrument if None
+        :type instrument: SimulatedInstrument
+        """
+        self.instrument = instrument if instrument is not None else SimulatedInstrument()
+        self._server = _Server((host, port), _SCPIRequestHandler)
+        self._server.instrument = self.instrument
+        self._server.lock = threading.Lock()
+        self._server.connections = set()
+        self._server.latency = latency
+        self._server.bandwidth = bandwidth
+        self._thread = None
+
+    @property
+    def address(self):
+        return self._server.server_address
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    @property
+    def latency(self):
+        return self._server.latency
+
+    @latency.setter
+    def latency(self, latency):
+        self._server.latency = latency
+
+    @property
+    def bandwidth(self):
+        return self._server.bandwidth
+
+    @bandwidth.setter
+    def bandwidth(self, bandwidth):
+        self._server.bandwidth = bandwidth
+
+    def start(self):
+        """
+        Serve connections in a background thread.
+
+        :return: self
+        """
+        self._thread = threading.Thread(target=self._server.serve_forever, name="InstrumentSimulator")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        """
+        Stop the server, and close all open connections.
+        """
+        self._server.shutdown()
+        self._server.server_close()
+        with self._server.lock:
+            for conn in self._server.connections:
+                try:
+                    conn.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+class _HiSLIPSession(object):
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.async_sock = None
+        self.async_lock = threading.Lock()  # Serializes the messages sent on the asynchronous channel
+        self.max_message_size = 1 << 20  # The client's maximum message size
+        self.srq_asserted = False
+
+    def send_async(self, msg_type, control=0, param=0, payload=""):
+        with self.async_lock:
+            if self.async_sock is not None:
+                send_message(self.async_sock, msg_type, control, param, payload)
+
+
+class _HiSLIPRequestHandler(_SCPIRequestHandler):
+    """
+    Handles the synchronous and asynchronous channels of HiSLIP sessions, IVI-6.1. The first message on
+    the connection, Initialize or AsyncInitialize, determines the channel.
+    """
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self.server.lock:
+            self.server.connections.add(self.request)
+
+    def finish(self):
+        with self.server.lock:
+            self.server.connections.discard(self.request)
+
+    def _handle(self):
+        msg_type, control, param, payload = recv_message(self.request)
+        if msg_type == INITIALIZE:
+            session = _HiSLIPSession(next(self.server.session_ids))
+            with self.server.lock:
+                self.server.sessions[session.session_id] = session
+            send_message(self.request, INITIALIZE_RESPONSE, int(self.server.overlapped),
+                                (PROTOCOL_VERSION << 16) | session.session_id)
+            try:
+                self._handle_sync(session)
+            finally:
+                with self.server.lock:
+                    self.server.sessions.pop(session.session_id, None)
+        elif msg_type == ASYNC_INITIALIZE:
+            with self.server.lock:
+                session = self.server.sessions.get(param & 0xffff)
+            if session is None:
+                send_message(self.request, FATAL_ERROR, 2, payload="Invalid session ID")
+                return
+            session.async_sock = self.request
+            send_message(self.request, ASYNC_INITIALIZE_RESPONSE, 0, struct.unpack(">H", "RS")[0])
+            self._handle_async(session)
+        else:
+            send_message(self.request, FATAL_ERROR, 1, payload="Expected Initialize")
+
+    def _handle_sync(self, session):
+        server = self.server
+        parts = []
+        while True:
+            msg_type, control, message_id, payload = recv_message(self.request)
+            if msg_type == DATA:
+                parts.append(str(payload))
+                continue
+            if msg_type == DEVICE_CLEAR_COMPLETE:
+                parts = []
+                send_message(self.request, DEVICE_CLEAR_ACKNOWLEDGE, int(server.overlapped))
+                continue
+            if msg_type == TRIGGER:
+                continue
+            if msg_type != DATA_END:
+                send_message(self.request, ERROR, 1, payload="Unexpected message type")
+                continue
+            parts.append(str(payload))
+            msg, parts = "".join(parts), []
+            with server.lock:
+                response = server.instrument.process(msg)
+                stb = server.instrument.status_byte()
+            if response is not None:
+                response += "\n"
+                if server.latency > 0:
+                    time.sleep(server.latency)
+                size = session.max_message_size
+                for pos in xrange(0, len(response), size):
+                    last = pos + size >= len(response)
+                    send_message(self.request, DATA_END if last else DATA, 0, message_id,
+                                        response[pos:pos + size])
+            # Request service when an enabled status bit is set, IEEE 488.2 11.3.2
+            asserted = bool(stb & server.instrument.sre & ~64)
+            if asserted and not session.srq_asserted:
+                session.send_async(ASYNC_SERVICE_REQUEST, stb | 64)
+            session.srq_asserted = asserted
+
+    def _handle_async(self, session):
+        server = self.server
+        while True:
+            msg_type, control, param, payload = recv_message(self.request)
+            if msg_type == ASYNC_MAXIMUM_MESSAGE_SIZE:
+                session.max_message_size = struct.unpack(">Q", str(payload))[0]
+                session.send_async(ASYNC_MAXIMUM_MESSAGE_SIZE_RESPONSE,
+                                   payload=struct.pack(">Q", server.max_message_size))
+            elif msg_type == ASYNC_STATUS_QUERY:
+                with server.lock:
+                    stb = server.instrument.status_byte()
+                session.send_async(ASYNC_STATUS_RESPONSE, stb)
+            elif msg_type == ASYNC_DEVICE_CLEAR:
+                session.send_async(ASYNC_DEVICE_CLEAR_ACKNOWLEDGE, int(server.overlapped))
+            elif msg_type == ASYNC_LOCK:
+                session.send_async(ASYNC_LOCK_RESPONSE, 1)  # Success
+            elif msg_type == ASYNC_REMOTE_LOCAL_CONTROL:
+                session.send_async(ASYNC_REMOTE_LOCAL_RESPONSE)
+            else:
+                session.send_async(ERROR, 1, payload="Unexpected message type")
+
+
+class HiSLIPSimulator(InstrumentSimulator):
+    """
+    A HiSLIP server for a SimulatedInstrument, for testing HiSLIPInterface. Service requests are sent on the
+    asynchronous channel when an enabled bit is set in the status byte, see *SRE.
+    The synchronous channel processes the messages in order, so overlapped and synchronized mode only
+    differ in the mode reported to the client.
+
+    sim = HiSLIPSimulator(port=0).start()
+    znb = ZNB(HiSLIPInterface("127.0.0.1", port=sim.port))
+    """
+    max_message_size = 1 << 20  # The server's maximum message size
+
+    def __init__(self, host="127.0.0.1", port=4880, latency=0.0, instrument=None, overlapped=True):
+        """
+        :param overlapped: Report overlapped mode to the clients, otherwise synchronized mode
+        """
+        self.instrument = instrument if instrument is not None else SimulatedInstrument()
+        self._server = _Server((host, port), _HiSLIPRequestHandler)
+        self._server.instrument = self.instrument
+        self._server.lock = threading.Lock()
+        self._server.connections = set()
+        self._server.latency = latency
+        self._server.bandwidth = None
+        self._server.overlapped = overlapped
+        self._server.max_message_size = self.max_message_size
+        self._server.sessions = {}
+        self._server.session_ids = itertools.count(1)
+        self._thread = None
+
+
+def main():
+    p = argparse.ArgumentParser(description="Simulated R&S ZNB, accepting SCPI commands on a raw socket.")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=None, help="5025, or 4880 with --hislip")
+    p.add_argument("--hislip", action="store_true", help="Serve HiSLIP instead of the raw socket protocol")
+    p.add_argument("--latency", type=float, default=0.0, help="Response delay in seconds")
+    p.add_argument("--bandwidth", type=float, default=None, help="Response bandwidth in bytes per second")
+    p.add_argument("--sweep-time", type=float, default=0.0, help="Duration of a sweep in seconds")
+    p.add_argument("--cmd-list", default=default_cmd_list, help="GPIB Explorer command list")
+    a = p.parse_args()
+    instrument = SimulatedInstrument(a.cmd_list, sweep_time=a.sweep_time)
+    if a.hislip:
+        sim = HiSLIPSimulator(a.host, 4880 if a.port is None else a.port, a.latency, instrument)
+    else:
+        sim = InstrumentSimulator(a.host, 5025 if a.port is None else a.port, a.latency, a.bandwidth, instrument)
+    print "Simulating %s on %s:%d" % ((sim.instrument.identity,) + sim.address)
+    try:
+        sim.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Regression tests for the transports and the response parsing, run against the instrument simulator in
+tools.simulator over SocketInterface and HiSLIPInterface:
+
+python -m pytest tools/test_simulator.py
+
+@author: Lukas Sandström
+"""
+
+import numpy
+import pytest
+
+from RSSscpi import ZNB, SocketInterface, HiSLIPInterface, ConnectionPool
+from RSSscpi.ZNB import File, Directory
+from tools.simulator import InstrumentSimulator, HiSLIPSimulator
+
+TRANSPORTS = {
+    "socket": (InstrumentSimulator, SocketInterface),
+    "hislip": (HiSLIPSimulator, HiSLIPInterface),
+}
+
+
+@pytest.fixture(params=sorted(TRANSPORTS))
+def setup(request):
+    """
+    A simulator and a ZNB connected to it, over each transport
+    """
+    simulator, interface = TRANSPORTS[request.param]
+    sim = simulator(port=0).start()
+    res = interface("127.0.0.1", port=sim.port)
+    znb = ZNB(res)
+    znb.init()
+    yield sim, znb
+    res.close()
+    sim.stop()
+
+
+def test_binary_fetch(setup):
+    sim, znb = setup
+    ch = znb.get_channel(1)
+    trace = ch.create_trace("Trc2", "S21")
+    znb.OPC.q()  # The simulator has processed the commands
+    expected = sim.instrument.sdata("Trc2")
+    for fmt, byte_order in ((ZNB.DATA_FORMAT_REAL64, "SWAPped"), (ZNB.DATA_FORMAT_REAL32, "NORMal"),
+                            (ZNB.DATA_FORMAT_ASCII, "SWAPped")):
+        znb.set_data_format(fmt, byte_order)
+        numpy.testing.assert_allclose(trace.fetch_data(), expected, rtol=1e-6)
+        numpy.testing.assert_allclose(ch.stimulus(), sim.instrument.stimulus(1))
+    assert int(znb.SENSe(1).SWEep.POINts().q()) == len(expected)  # Nothing is left unread
+
+
+def test_pipeline(setup):
+    sim, znb = setup
+    with znb.pipeline():
+        znb.SENSe(1).SWEep.POINts().w(51)
+        points = znb.SENSe(1).SWEep.POINts().q_async()
+        idn = znb.IDN.q_async()
+        data = znb.get_channel(1).CALC.DATA.TRACe().q_async("Trc1", "SDATa", fmt="{:q}, {:s}")
+    assert int(points) == 51
+    assert str(idn).strip() == sim.instrument.identity
+    assert len(data.result().numpy_complex()) == 51
+
+
+def test_quoted_strings(setup):
+    sim, znb = setup
+    ch = znb.get_channel(1)
+    ch.name = "Bob's channel"
+    assert "Bob's channel" in ch.name
+    f = znb.filesystem.file("Bob's.txt")
+    f.write("It's here")
+    assert f.read() == "It's here"
+    assert "Bob's.txt" in [x.filename for x in znb.filesystem.listdir()]
+    assert str(znb.IDN.q()).strip() == sim.instrument.identity  # The responses are still in sync
+
+
+def test_unmatched_quote_in_response(setup):
+    sim, znb = setup
+    znb.MMEMory.NAME().w("'Bob's.png'", fmt="{:s}")  # Stored as is by the simulator, without doubling the quote
+    assert str(znb.MMEMory.NAME().q()) == "Bob's.png"
+    assert str(znb.IDN.q()).strip() == sim.instrument.identity
+
+
+def test_listdir(setup):
+    sim, znb = setup
+    fs = znb.filesystem
+    fs.mkdir("sub")
+    for name in ("a.s2p", "b.s2p"):
+        fs.file(name).write("x" * 10)
+    entries = fs.listdir()
+    assert sorted(x.filename for x in entries if isinstance(x, File)) == ["a.s2p", "b.s2p"]
+    assert [x.path for x in entries if isinstance(x, Directory) and x.path.endswith("sub")]
+    fs.file("c.s2p").write("")  # Invalidates the cached listing
+    assert "c.s2p" in [x.filename for x in fs.listdir() if isinstance(x, File)]
+
+
+def test_single_instrument_per_session():
+    sim = InstrumentSimulator(port=0).start()
+    try:
+        pool = ConnectionPool()
+        znb = pool.get_instrument("127.0.0.1", sim.port)
+        assert pool.get_instrument("127.0.0.1", sim.port) is znb
+        with pytest.raises(ValueError):
+            ZNB(pool.open_resource("127.0.0.1", sim.port))
+        pool.close_all()
+    finally:
+        sim.stop()